@@ -0,0 +1,143 @@
+#ifndef BINARYFORMAT_H
+#define BINARYFORMAT_H
+
+#include <cstdint>
+
+// 3DO2SCM BINARY OUTPUT LAYOUT (--format=bin)
+
+// Alternative to the JSON output for handing a converted unit over to scm/supcom_exporter.py.
+// Multi-byte data is written in little-endian ("Intel") format. Records are packed (no padding).
+
+// The file is a BinHeader, followed by the unit name, followed by mNumModels models. Each model is:
+//
+//   uint32_t textureWidth, textureHeight
+//   uint32_t atlasFormat                   BinAtlasRgba or BinAtlasIndexed
+//   section  pieces     (BinPiece)
+//   section  names      (char)         piece and texture names, not NUL terminated
+//   section  vertices   (BinVertex)    all pieces' vertices, piece by piece
+//   section  primitives (BinPrimitive) all pieces' primitives, piece by piece
+//   section  indices    (uint32_t)     all primitives' vertex indices, primitive by primitive
+//
+// followed, for BinAtlasRgba (--atlas=rgba), by
+//
+//   section  albedo     (char)         raw RGBA atlas, textureWidth*textureHeight*4 bytes
+//   section  specteam   (char)         raw RGBA atlas, textureWidth*textureHeight*4 bytes
+//
+// or for BinAtlasIndexed (--atlas=indexed), by
+//
+//   section  atlas       (uint8_t)     colour index per pixel, textureWidth*textureHeight bytes
+//   section  logoMask    (uint8_t)     1 for pixels coloured by team, textureWidth*textureHeight bytes
+//   section  albedoLut   (uint32_t)    RGBA albedo per [logoMask][colour index], 2*256 entries
+//   section  specteamLut (uint32_t)    RGBA specteam per [logoMask][colour index], 2*256 entries
+//
+// The indexed form is a quarter of the size; albedo = albedoLut[logoMask][atlas], and likewise specteam. The lookup
+// tables are built from PALETTE.PAL, so a reader needs nothing else to expand the atlas.
+//
+// where each section is
+//
+//   uint32_t elementSize, elementCount
+//   elementSize*elementCount bytes of data
+//
+// Pieces are in depth first pre-order, so the root piece is first and every parent precedes its children.
+
+// 3DO2SCM BATCH OUTPUT (--batch)
+
+// Each unit is written as a BinFrameHeader, followed by the unit name, followed by mPayloadLength bytes of payload.
+// For BinFrameOk the payload is exactly what converting the unit on its own would write to stdout, in the format
+// chosen by --format. For BinFrameError it is an error message, and for BinFrameNotFound it is empty.
+// Frames are written in the order the units finish, which need not be the order they were asked for.
+// With --metrics, a unit's line is appended to the metrics file before its frame is written.
+
+static const char BinMagic[4] = { '3', 'D', 'O', 'B' };
+static const std::uint32_t BinVersion = 3;
+
+static const std::uint32_t BinAtlasRgba = 0;
+static const std::uint32_t BinAtlasIndexed = 1;
+
+static const char BinFrameMagic[4] = { '3', 'D', 'O', 'F' };
+
+static const std::uint32_t BinFrameOk = 0;
+static const std::uint32_t BinFrameNotFound = 1;
+static const std::uint32_t BinFrameError = 2;
+
+#pragma pack(1)
+
+struct BinFrameHeader
+{
+    // The FOURCC '3DOF'
+    char mMagic[4];
+
+    // BinFrameOk, BinFrameNotFound or BinFrameError
+    std::uint32_t mStatus;
+
+    // Number of bytes of unit name that follow the header
+    std::uint32_t mUnitNameLength;
+
+    // Number of bytes of payload that follow the unit name
+    std::uint32_t mPayloadLength;
+};
+
+struct BinHeader
+{
+    // The FOURCC '3DOB'
+    char mMagic[4];
+
+    // BinVersion
+    std::uint32_t mVersion;
+
+    // Number of models (top level 3do objects) that follow
+    std::uint32_t mNumModels;
+
+    // Number of bytes of unit name that follow the header
+    std::uint32_t mUnitNameLength;
+};
+
+struct BinPiece
+{
+    // Index of the parent piece, -1 for the root
+    std::int32_t mParentIndex;
+
+    // Position relative to the parent piece, in 3do fixed point units (1/65536)
+    std::int32_t mPosition[3];
+
+    // Name, as a slice of the names section
+    std::uint32_t mNameOffset;
+    std::uint32_t mNameLength;
+
+    // Slices of the vertices and primitives sections that belong to this piece
+    std::uint32_t mFirstVertex;
+    std::uint32_t mNumVertices;
+    std::uint32_t mFirstPrimitive;
+    std::uint32_t mNumPrimitives;
+
+    // -1 if the piece has no selection primitive
+    std::int32_t mSelectionPrimitiveIndex;
+};
+
+struct BinVertex
+{
+    // Position relative to the piece, in 3do fixed point units (1/65536)
+    std::int32_t mPosition[3];
+};
+
+struct BinPrimitive
+{
+    // Slice of the indices section. Indices are relative to the piece's first vertex
+    std::uint32_t mFirstIndex;
+    std::uint32_t mNumIndices;
+
+    // -1 if the primitive is not coloured
+    std::int32_t mColorIndex;
+
+    // Texture name as a slice of the names section. mTextureNameLength is -1 if there is no texture
+    std::uint32_t mTextureNameOffset;
+    std::int32_t mTextureNameLength;
+
+    // Location of the primitive's texture in the atlas
+    double mUVMin[2];
+    double mUVMax[2];
+};
+
+#pragma pack()
+
+#endif // BINARYFORMAT_H
@@ -0,0 +1,257 @@
+#include "GafCatalog.h"
+
+#include <algorithm>
+#include <filesystem>
+#include <fstream>
+#include <iostream>
+
+#include <sys/stat.h>
+
+#ifdef _WIN32
+#include <process.h>
+#else
+#include <unistd.h>
+#endif
+
+#include <rwe/Gaf.h>
+#include <rwe/rwe_string.h>
+
+static const char CATALOG_MAGIC[] = "3DO2SCM GAF CATALOG";
+static const int CATALOG_VERSION = 1;
+
+static bool StatFile(const std::string& path, std::uint64_t& size, std::int64_t& mtime)
+{
+#ifdef _WIN32
+    struct _stat64 st;
+    if (_stat64(path.c_str(), &st) != 0)
+    {
+        return false;
+    }
+#else
+    struct stat st;
+    if (stat(path.c_str(), &st) != 0)
+    {
+        return false;
+    }
+#endif
+    size = st.st_size;
+    mtime = st.st_mtime;
+    return true;
+}
+
+static int ProcessId()
+{
+#ifdef _WIN32
+    return _getpid();
+#else
+    return getpid();
+#endif
+}
+
+// catalogs written by older builds on windows have CRLF line endings
+static bool GetLine(std::istream& is, std::string& line)
+{
+    if (!std::getline(is, line))
+    {
+        return false;
+    }
+    if (!line.empty() && line.back() == '\r')
+    {
+        line.pop_back();
+    }
+    return true;
+}
+
+GafCatalog::GafCatalog(const std::string& catalogFile) :
+    m_catalogFile(catalogFile),
+    m_dirty(false)
+{
+    load();
+}
+
+void GafCatalog::load()
+{
+    std::ifstream fs(m_catalogFile, std::ios_base::binary);
+    std::string line;
+    if (!GetLine(fs, line) || line != std::string(CATALOG_MAGIC) + '\t' + std::to_string(CATALOG_VERSION))
+    {
+        // missing, or written by another version. start afresh
+        return;
+    }
+
+    Archive* archive = NULL;
+    while (GetLine(fs, line))
+    {
+        std::vector<std::string> fields = rwe::split(line, '\t');
+        if (fields.size() == 4 && fields[0] == "A")
+        {
+            archive = &m_archives[fields[3]];
+            archive->path = fields[3];
+            archive->size = std::stoull(fields[1]);
+            archive->mtime = std::stoll(fields[2]);
+            archive->textures.clear();
+        }
+        else if (fields.size() == 5 && fields[0] == "T" && archive)
+        {
+            archive->textures.push_back(Texture{ fields[4], std::stoull(fields[1]), unsigned(std::stoul(fields[2])), unsigned(std::stoul(fields[3])) });
+        }
+    }
+}
+
+void GafCatalog::save() const
+{
+    // write to a temporary and rename, so that a concurrent reader never sees a partial catalog.
+    // the temporary is per process so that concurrent writers don't interleave
+    const std::string tmpFile = m_catalogFile + "." + std::to_string(ProcessId()) + ".tmp";
+    {
+        std::ofstream fs(tmpFile, std::ios_base::binary | std::ios_base::trunc);
+        fs << CATALOG_MAGIC << '\t' << CATALOG_VERSION << '\n';
+        for (const auto& it : m_archives)
+        {
+            const Archive& archive = it.second;
+            fs << "A\t" << archive.size << '\t' << archive.mtime << '\t' << archive.path << '\n';
+            for (const Texture& texture : archive.textures)
+            {
+                fs << "T\t" << texture.entryOffset << '\t' << texture.width << '\t' << texture.height << '\t' << texture.name << '\n';
+            }
+        }
+        if (!fs.good())
+        {
+            std::cerr << "unable to write GAF catalog '" << m_catalogFile << "'" << std::endl;
+            fs.close();
+            std::error_code ec;
+            std::filesystem::remove(tmpFile, ec);
+            return;
+        }
+    }
+
+    std::error_code ec;
+    std::filesystem::rename(tmpFile, m_catalogFile, ec);
+    if (ec)
+    {
+        std::cerr << "unable to write GAF catalog '" << m_catalogFile << "': " << ec.message() << std::endl;
+        std::filesystem::remove(tmpFile, ec);
+    }
+}
+
+void GafCatalog::indexArchive(Archive& archive) const
+{
+    archive.textures.clear();
+
+    std::ifstream fs(archive.path, std::ios_base::binary);
+    if (!fs.good())
+    {
+        return;
+    }
+
+    try
+    {
+        rwe::GafArchive gaf(&fs, archive.path);
+        for (const rwe::GafArchive::Entry& entry : gaf.entries())
+        {
+            Texture texture{ entry.name, entry.offset, 0u, 0u };
+            if (!entry.frameOffsets.empty())
+            {
+                rwe::GafFrameData frameHeader = gaf.readFrameHeader(entry.frameOffsets.front());
+                texture.width = frameHeader.width;
+                texture.height = frameHeader.height;
+            }
+            archive.textures.push_back(texture);
+        }
+    }
+    catch (rwe::GafException& e)
+    {
+        // not a gaf. recorded with no textures so that it isn't rescanned until it changes
+        std::cerr << "skipping '" << archive.path << "': " << e.what() << std::endl;
+        archive.textures.clear();
+    }
+}
+
+void GafCatalog::update(const std::vector<std::string>& taDataDirs)
+{
+    m_textureLocations.clear();
+
+    for (const std::string& tadata : taDataDirs)
+    {
+        std::filesystem::path directory = std::filesystem::path(tadata) / "textures";
+        if (!std::filesystem::is_directory(directory))
+        {
+            continue;
+        }
+        // the iterator's order is the filesystem's
+        std::vector<std::string> paths;
+        for (const auto& dirEntry : std::filesystem::recursive_directory_iterator(directory))
+        {
+            if (dirEntry.is_regular_file())
+            {
+                paths.push_back(dirEntry.path().string());
+            }
+        }
+        std::sort(paths.begin(), paths.end());
+
+        for (const std::string& path : paths)
+        {
+            std::uint64_t size;
+            std::int64_t mtime;
+            if (!StatFile(path, size, mtime))
+            {
+                continue;
+            }
+
+            auto it = m_archives.find(path);
+            if (it == m_archives.end() || it->second.size != size || it->second.mtime != mtime)
+            {
+                Archive& archive = m_archives[path];
+                archive.path = path;
+                archive.size = size;
+                archive.mtime = mtime;
+                indexArchive(archive);
+                it = m_archives.find(path);
+                m_dirty = true;
+            }
+
+            for (const Texture& texture : it->second.textures)
+            {
+                // first archive wins
+                m_textureLocations.emplace(texture.name, Location{ &it->second, &texture });
+            }
+        }
+    }
+
+    // forget archives that have been deleted
+    for (auto it = m_archives.begin(); it != m_archives.end(); )
+    {
+        std::uint64_t size;
+        std::int64_t mtime;
+        if (StatFile(it->first, size, mtime))
+        {
+            ++it;
+        }
+        else
+        {
+            it = m_archives.erase(it);
+            m_dirty = true;
+        }
+    }
+
+    if (m_dirty)
+    {
+        save();
+        m_dirty = false;
+    }
+}
+
+const GafCatalog::Location* GafCatalog::find(const std::string& textureName) const
+{
+    auto it = m_textureLocations.find(textureName);
+    return it == m_textureLocations.end() ? NULL : &it->second;
+}
+
+bool GafCatalog::IsLogoArchive(const std::string& archivePath)
+{
+    // not sure how to correctly determine whether or not a gaf should be coloured by team colour.
+    // we'll just make all gafs found in logos.gaf coloured by team.
+    std::string archiveName = archivePath;
+    std::transform(archiveName.begin(), archiveName.end(), archiveName.begin(), [](unsigned char c) { return std::tolower(c); });
+    return archiveName.find("logo") != std::string::npos;
+}
@@ -0,0 +1,71 @@
+#ifndef GAFCATALOG_H
+#define GAFCATALOG_H
+
+#include <cstdint>
+#include <map>
+#include <string>
+#include <vector>
+
+// Persistent index of the GAF archives under the <tadata>/textures directories.
+//
+// Maps each texture name to the archive that holds it, the offset of its entry header and the dimensions of its
+// first frame, so that a texture can be extracted by opening only its own archive. Archives are re-indexed only
+// when their size or modification time changes. scm/gafcatalog.py reads and writes the same file.
+//
+// The catalog file is UTF-8 text, one tab separated record per line:
+//
+//   3DO2SCM GAF CATALOG <version>
+//   A <size> <mtime> <archive path>                  an archive. mtime in seconds since the unix epoch
+//   T <entry offset> <width> <height> <name>         a texture in the preceding archive
+//
+class GafCatalog
+{
+public:
+    struct Texture
+    {
+        std::string name;
+        std::size_t entryOffset;
+        unsigned width;
+        unsigned height;
+    };
+
+    struct Archive
+    {
+        std::string path;
+        std::uint64_t size;
+        std::int64_t mtime;
+        std::vector<Texture> textures;
+    };
+
+    struct Location
+    {
+        const Archive* archive;
+        const Texture* texture;
+    };
+
+private:
+    const std::string m_catalogFile;
+    std::map<std::string, Archive> m_archives;
+    std::map<std::string, Location> m_textureLocations;
+    bool m_dirty;
+
+public:
+    explicit GafCatalog(const std::string& catalogFile);
+
+    // rescan the textures directories, re-indexing new or changed archives, and save the catalog if anything changed.
+    // textures are looked up in the archives found by the most recent scan. the first archive taking precedence is that
+    // of the first tadata dir, then of the lowest path within it, ordered by its bytes: scm/gafcatalog.py orders them
+    // the same, so that both find a texture in the same archive
+    void update(const std::vector<std::string>& taDataDirs);
+
+    const Location* find(const std::string& textureName) const;
+
+    static bool IsLogoArchive(const std::string& archivePath);
+
+private:
+    void load();
+    void save() const;
+    void indexArchive(Archive& archive) const;
+};
+
+#endif // GAFCATALOG_H
@@ -0,0 +1,147 @@
+#include "Metrics.h"
+
+#include <ctime>
+#include <fstream>
+#include <iomanip>
+
+#ifdef _WIN32
+#include <windows.h>
+#include <psapi.h>
+#else
+#include <sys/resource.h>
+#include <time.h>
+#endif
+
+static void WriteJsonString(std::ostream& os, const std::string& s)
+{
+    os << '"';
+    for (char c : s)
+    {
+        if (c == '"' || c == '\\')
+        {
+            os << '\\' << c;
+        }
+        else if ((unsigned char)c < 0x20)
+        {
+            os << "\\u" << std::hex << std::setw(4) << std::setfill('0') << int(c) << std::dec << std::setfill(' ');
+        }
+        else
+        {
+            os << c;
+        }
+    }
+    os << '"';
+}
+
+Metrics::Stage::Stage(Metrics& metrics, const std::string& name) :
+    m_metrics(metrics),
+    m_name(name),
+    m_wallStart(std::chrono::steady_clock::now()),
+    m_cpuStart(Metrics::ThreadCpuSeconds())
+{ }
+
+Metrics::Stage::~Stage()
+{
+    std::chrono::duration<double> wall = std::chrono::steady_clock::now() - m_wallStart;
+    m_metrics.addTime(m_name, wall.count(), Metrics::ThreadCpuSeconds() - m_cpuStart);
+}
+
+void Metrics::addTime(const std::string& stage, double wallSeconds, double cpuSeconds)
+{
+    Time& time = m_stages[stage];
+    time.wall += wallSeconds;
+    time.cpu += cpuSeconds;
+}
+
+void Metrics::addCount(const std::string& name, double value)
+{
+    m_counts[name] += value;
+}
+
+void Metrics::setCount(const std::string& name, double value)
+{
+    m_counts[name] = value;
+}
+
+double Metrics::count(const std::string& name) const
+{
+    auto it = m_counts.find(name);
+    return it == m_counts.end() ? 0.0 : it->second;
+}
+
+bool Metrics::write(const std::string& filename, const std::string& unitName) const
+{
+    std::ofstream fs(filename, std::ios_base::app);
+    fs << std::setprecision(9) << "{\"unit\":";
+    WriteJsonString(fs, unitName);
+    fs << ",\"tool\":\"3do2scm\",\"stages\":{";
+    for (auto it = m_stages.begin(); it != m_stages.end(); ++it)
+    {
+        if (it != m_stages.begin())
+        {
+            fs << ',';
+        }
+        WriteJsonString(fs, it->first);
+        fs << ":{\"wall_s\":" << it->second.wall << ",\"cpu_s\":" << it->second.cpu << '}';
+    }
+    fs << "},\"counts\":{";
+    for (auto it = m_counts.begin(); it != m_counts.end(); ++it)
+    {
+        if (it != m_counts.begin())
+        {
+            fs << ',';
+        }
+        WriteJsonString(fs, it->first);
+        fs << ':' << it->second;
+    }
+    fs << "},\"peak_rss_bytes\":" << PeakRssBytes() << "}\n";
+    return fs.good();
+}
+
+double Metrics::ThreadCpuSeconds()
+{
+#ifdef _WIN32
+    FILETIME creationTime, exitTime, kernelTime, userTime;
+    if (!GetThreadTimes(GetCurrentThread(), &creationTime, &exitTime, &kernelTime, &userTime))
+    {
+        return 0.0;
+    }
+    ULARGE_INTEGER kernel, user;
+    kernel.LowPart = kernelTime.dwLowDateTime;
+    kernel.HighPart = kernelTime.dwHighDateTime;
+    user.LowPart = userTime.dwLowDateTime;
+    user.HighPart = userTime.dwHighDateTime;
+    return double(kernel.QuadPart + user.QuadPart) * 1e-7;
+#else
+    struct timespec cpuTime;
+    if (clock_gettime(CLOCK_THREAD_CPUTIME_ID, &cpuTime) != 0)
+    {
+        return 0.0;
+    }
+    return double(cpuTime.tv_sec) + double(cpuTime.tv_nsec) * 1e-9;
+#endif
+}
+
+std::uint64_t Metrics::PeakRssBytes()
+{
+#ifdef _WIN32
+    PROCESS_MEMORY_COUNTERS counters;
+    if (!GetProcessMemoryInfo(GetCurrentProcess(), &counters, sizeof(counters)))
+    {
+        return 0u;
+    }
+    return counters.PeakWorkingSetSize;
+#else
+    struct rusage usage;
+    if (getrusage(RUSAGE_SELF, &usage) != 0)
+    {
+        return 0u;
+    }
+#ifdef __APPLE__
+    return std::uint64_t(usage.ru_maxrss);
+#else
+    // kilobytes
+    return std::uint64_t(usage.ru_maxrss) * 1024u;
+#endif
+#endif
+}
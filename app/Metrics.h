@@ -0,0 +1,63 @@
+#ifndef METRICS_H
+#define METRICS_H
+
+#include <chrono>
+#include <cstdint>
+#include <map>
+#include <string>
+
+// Timings and counts for --metrics.
+//
+// Accumulates the wall and CPU time of named stages and named counts over a run, and appends them to a file as one
+// line of JSON per unit:
+//
+//   {"unit":"ARMACA","tool":"3do2scm","stages":{"parse_3do":{"wall_s":0.001,"cpu_s":0.001},...},
+//    "counts":{"vertices":123,...},"peak_rss_bytes":4567890}
+//
+// A stage's CPU time is that of the thread that ran it, so units converted concurrently by --batch --jobs don't
+// count each other's work. peak_rss_bytes is always the whole process's: in --batch mode it covers every unit the
+// process has converted so far, not just the one on the line.
+//
+class Metrics
+{
+public:
+    // times the enclosing scope as the named stage
+    class Stage
+    {
+        Metrics& m_metrics;
+        const std::string m_name;
+        const std::chrono::steady_clock::time_point m_wallStart;
+        const double m_cpuStart;
+
+    public:
+        Stage(Metrics& metrics, const std::string& name);
+        ~Stage();
+    };
+
+private:
+    struct Time
+    {
+        double wall;
+        double cpu;
+    };
+
+    std::map<std::string, Time> m_stages;
+    std::map<std::string, double> m_counts;
+
+public:
+    void addTime(const std::string& stage, double wallSeconds, double cpuSeconds);
+    void addCount(const std::string& name, double value);
+    void setCount(const std::string& name, double value);
+    double count(const std::string& name) const;
+
+    // append a line to filename. returns false if it can't be written
+    bool write(const std::string& filename, const std::string& unitName) const;
+
+    // CPU time used by the calling thread, in seconds
+    static double ThreadCpuSeconds();
+
+    // peak resident set size of this process, in bytes. 0 if unknown
+    static std::uint64_t PeakRssBytes();
+};
+
+#endif // METRICS_H
@@ -0,0 +1,94 @@
+#include "SkylinePacker.h"
+
+#include <algorithm>
+
+SkylinePacker::SkylinePacker(int width, int height) :
+    m_width(width),
+    m_height(height)
+{
+    m_skyline.push_back(Segment{ 0, 0, width });
+}
+
+int SkylinePacker::fitAt(std::size_t idx, int width, int height) const
+{
+    const int x = m_skyline[idx].x;
+    if (x + width > m_width)
+    {
+        return -1;
+    }
+
+    int y = 0;
+    int remaining = width;
+    for (std::size_t n = idx; remaining > 0; ++n)
+    {
+        y = std::max(y, m_skyline[n].y);
+        if (y + height > m_height)
+        {
+            return -1;
+        }
+        remaining -= m_skyline[n].width;
+    }
+    return y;
+}
+
+bool SkylinePacker::insert(int width, int height, int& x, int& y)
+{
+    if (width <= 0 || height <= 0)
+    {
+        x = y = 0;
+        return width >= 0 && height >= 0;
+    }
+
+    int bestY = -1;
+    std::size_t bestIdx = 0;
+    for (std::size_t idx = 0; idx < m_skyline.size(); ++idx)
+    {
+        int fitY = fitAt(idx, width, height);
+        if (fitY >= 0 && (bestY < 0 || fitY < bestY))
+        {
+            bestY = fitY;
+            bestIdx = idx;
+        }
+    }
+    if (bestY < 0)
+    {
+        return false;
+    }
+
+    x = m_skyline[bestIdx].x;
+    y = bestY;
+
+    // raise the skyline over [x, x+width)
+    m_skyline.insert(m_skyline.begin() + bestIdx, Segment{ x, y + height, width });
+    for (std::size_t n = bestIdx + 1; n < m_skyline.size(); )
+    {
+        Segment& seg = m_skyline[n];
+        const int covered = x + width - seg.x;
+        if (covered <= 0)
+        {
+            break;
+        }
+        if (covered < seg.width)
+        {
+            seg.x += covered;
+            seg.width -= covered;
+            break;
+        }
+        m_skyline.erase(m_skyline.begin() + n);
+    }
+
+    // merge neighbouring segments at the same height
+    for (std::size_t n = 0; n + 1 < m_skyline.size(); )
+    {
+        if (m_skyline[n].y == m_skyline[n + 1].y)
+        {
+            m_skyline[n].width += m_skyline[n + 1].width;
+            m_skyline.erase(m_skyline.begin() + n + 1);
+        }
+        else
+        {
+            ++n;
+        }
+    }
+    return true;
+}
@@ -0,0 +1,36 @@
+#ifndef SKYLINEPACKER_H
+#define SKYLINEPACKER_H
+
+#include <vector>
+
+// Bottom-left skyline rectangle packer.
+//
+// Keeps the upper outline ("skyline") of the rectangles placed so far as a list of horizontal segments, and puts
+// each new rectangle at the lowest (then leftmost) position where it rests on the skyline. Cost per insert is
+// linear in the number of segments, independent of the atlas size. Works best with rectangles inserted in order
+// of decreasing size.
+class SkylinePacker
+{
+    struct Segment
+    {
+        int x;
+        int y;
+        int width;
+    };
+
+    const int m_width;
+    const int m_height;
+    std::vector<Segment> m_skyline;
+
+public:
+    SkylinePacker(int width, int height);
+
+    // find a place for a width x height rectangle and mark it used. returns false if it doesn't fit
+    bool insert(int width, int height, int& x, int& y);
+
+private:
+    // lowest y at which a rectangle of the given width can sit with its left edge at segment idx, or -1
+    int fitAt(std::size_t idx, int width, int height) const;
+};
+
+#endif // SKYLINEPACKER_H
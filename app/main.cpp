@@ -1,3 +1,6 @@
+#include <algorithm>
+#include <condition_variable>
+#include <deque>
 #include <iostream>
 #include <filesystem>
 #include <fstream>
@@ -5,11 +8,23 @@
 #include <list>
 #include <set>
 #include <memory>
+#include <mutex>
 #include <sstream>
+#include <thread>
 
 #include <rwe/_3do.h>
 #include <rwe/Gaf.h>
+#include <rwe/rwe_string.h>
 #include <scm/ScmFile_format.h>
+#include "BinaryFormat.h"
+#include "GafCatalog.h"
+#include "Metrics.h"
+#include "SkylinePacker.h"
+
+#ifdef _WIN32
+#include <fcntl.h>
+#include <io.h>
+#endif
 
 const double SCALE = 65536.0;
 static const std::string COLOR_INDEX_NAME_PREFIX("__colorIndex");
@@ -96,82 +111,68 @@ class CompositeTexture : public rwe::GafReaderAdapter
     const int m_width;
     const int m_height;
     std::shared_ptr<char> m_buffer;
-    std::shared_ptr<char> m_occupied;
     std::shared_ptr<char> m_isLogo;
     std::vector<std::uint32_t> m_paletteRgba;
 
     std::map< std::string, LayerData > m_textures;
     LayerData* m_currentTexture;
-    bool m_currentTextureIsLogo;
 
 public:
 
-    class BufferFull : public std::runtime_error
-    {
-    public:
-        BufferFull() :
-            std::runtime_error("cannot place texture. buffer full")
-        { }
-    };
-
-    CompositeTexture(int width, int height, const std::string &colourPalette) :
+    CompositeTexture(int width, int height, const std::vector<std::uint32_t>& paletteRgba) :
         m_width(width),
         m_height(height),
         m_buffer(new char[width * height]),
-        m_occupied(new char[width * height]),
         m_isLogo(new char[width * height]),
-        m_currentTexture(NULL),
-        m_currentTextureIsLogo(false)
+        m_paletteRgba(paletteRgba),
+        m_currentTexture(NULL)
 
     {
         std::memset(m_buffer.get(), 0, width * height);
-        std::memset(m_occupied.get(), 0, width * height);
         std::memset(m_isLogo.get(), 0, width * height);
-        m_paletteRgba = LoadPalette(colourPalette);
     }
 
-    virtual void setCurrentTextureIsLogo(bool isLogo)
+    // reserve the width x height area at (x,y) for the named texture
+    void place(const std::string& name, int x, int y, unsigned width, unsigned height, bool isLogo)
     {
-        m_currentTextureIsLogo = isLogo;
+        LayerData& tex = m_textures[name];
+        tex.x = x;
+        tex.y = y;
+        tex.width = width;
+        tex.height = height;
+        tex.transparencyKey = 0;
+        tex.data = m_buffer.get() + x + y * m_width;
+
+        for (unsigned row = 0; row < height; ++row)
+        {
+            std::memset(m_isLogo.get() + x + (y + row) * m_width, isLogo, width);
+        }
     }
 
     virtual void beginEntity(const std::string& name)
     {
         auto it = m_textures.find(name);
-        if (it == m_textures.end())
-        {
-            m_textures[name].data = NULL;
-        }
-
-        m_currentTexture = &m_textures[name];
+        m_currentTexture = it == m_textures.end() ? NULL : &it->second;
     }
 
     virtual void beginFrame(const rwe::GafFrameData& header)
     {
-        if (m_currentTexture && m_currentTexture->data == NULL)
+        if (m_currentTexture)
         {
-            m_currentTexture->width = header.width;
-            m_currentTexture->height = header.height;
             m_currentTexture->transparencyKey = header.transparencyIndex;
-            FindPlacement(*m_currentTexture);
         }
     }
 
     virtual void frameLayer(const LayerData& data)
     {
-        if (m_currentTexture && m_currentTexture->data)
+        if (m_currentTexture)
         {
-            for (unsigned col = 0; col < m_currentTexture->width; ++col)
+            // the placement was sized from the catalog. clip in case the archive has changed since
+            const unsigned width = std::min(m_currentTexture->width, data.width);
+            const unsigned height = std::min(m_currentTexture->height, data.height);
+            for (unsigned row = 0; row < height; ++row)
             {
-                for (unsigned row = 0; row < m_currentTexture->height; ++row)
-                {
-                    char p = data.data[col + m_currentTexture->width * row];
-                    unsigned idxDest = col + m_width * row;
-                    if (idxDest + m_currentTexture->x < m_width * m_height)
-                    {
-                        m_currentTexture->data[col + m_width * row] = p;
-                    }
-                }
+                std::memcpy(m_currentTexture->data + m_width * row, data.data + data.width * row, width);
             }
             // keep the first layer only
             m_currentTexture = NULL;
@@ -180,31 +181,18 @@ public:
 
     virtual void addColorIndex(const std::string& colorIndexTextureName)
     {
-        if (m_textures.count(colorIndexTextureName) > 0u)
+        auto it = m_textures.find(colorIndexTextureName);
+        if (it == m_textures.end())
         {
             return;
         }
 
+        LayerData& tex = it->second;
         int colorIndex = GetIndexFromColorIndexName(colorIndexTextureName);
-        auto & tex = m_textures[colorIndexTextureName];
-        tex.width = 4;
-        tex.height = 4;
         tex.transparencyKey = colorIndex-1u;
-        tex.data = NULL;
-        m_currentTextureIsLogo = false;
-
-        FindPlacement(tex);   // points tex.data to a free spot
-
-        for (unsigned col = 0; col < tex.width; ++col)
+        for (unsigned row = 0; row < tex.height; ++row)
         {
-            for (unsigned row = 0; row < tex.height; ++row)
-            {
-                unsigned idxDest = col + m_width * row;
-                if (idxDest + tex.x < m_width * m_height)
-                {
-                    tex.data[col + m_width * row] = colorIndex;
-                }
-            }
+            std::memset(tex.data + m_width * row, colorIndex, tex.width);
         }
     }
 
@@ -243,47 +231,68 @@ public:
         b = word.rgba.b;
     }
 
-    void saveTextures(std::ostream& os) const
+    // albedo and specteam RGBA for every palette index, for ordinary [0] and logo [1] pixels
+    typedef std::uint8_t RgbaLut[2][256][4];
+
+    void makeLookupTables(RgbaLut& albedoLut, RgbaLut& specteamLut) const
     {
-        // raw colour indexed
-        // raw rgba
-        for (unsigned idx = 0u; idx < m_width * m_height; ++idx)
+        for (unsigned index = 0u; index < 256u; ++index)
         {
-            std::uint8_t r, g, b;
+            std::uint8_t r = 0u, g = 0u, b = 0u;
             double h, s, v;
-            colourLookup(m_buffer.get()[idx], r, g, b);
+            if (index < m_paletteRgba.size())
+            {
+                colourLookup(index, r, g, b);
+            }
             rgb2hsv(r, g, b, h, s, v);
-            bool isLogoPixel = this->m_isLogo.get()[idx] && s > 0.333;
 
-            if (isLogoPixel)
+            for (unsigned isLogo = 0u; isLogo < 2u; ++isLogo)
             {
-                r = g = b = 0u;
+                bool isLogoPixel = isLogo && s > 0.333;
+
+                albedoLut[isLogo][index][0] = isLogoPixel ? 0u : r;
+                albedoLut[isLogo][index][1] = isLogoPixel ? 0u : g;
+                albedoLut[isLogo][index][2] = isLogoPixel ? 0u : b;
+                albedoLut[isLogo][index][3] = 255u;
+
+                specteamLut[isLogo][index][0] = 0u;
+                specteamLut[isLogo][index][1] = 0u;
+                specteamLut[isLogo][index][2] = 0u;
+                specteamLut[isLogo][index][3] = isLogoPixel ? 255-char(255.0*v) : 0;
             }
-            os.put(r);
-            os.put(g);
-            os.put(b);
-            os.put(255);
         }
     }
 
-    void saveLogos(std::ostream& os) const
+    // raw rgba albedo and specteam, in one pass over the atlas
+    void saveTextures(std::string& albedo, std::string& specteam) const
     {
-        // raw rgba
-        for (unsigned idx = 0u; idx < m_width * m_height; ++idx)
-        {
-            std::uint8_t r, g, b;
-            double h, s, v;
-            colourLookup(m_buffer.get()[idx], r, g, b);
-            rgb2hsv(r, g, b, h, s, v);
-            bool isLogoPixel = this->m_isLogo.get()[idx] && s > 0.333;
+        RgbaLut albedoLut, specteamLut;
+        makeLookupTables(albedoLut, specteamLut);
 
-            os.put(0);
-            os.put(0);
-            os.put(0);
-            os.put(isLogoPixel ? 255-char(255.0*v) : 0);
+        const std::size_t numPixels = std::size_t(m_width) * m_height;
+        albedo.resize(4u * numPixels);
+        specteam.resize(4u * numPixels);
+
+        const std::uint8_t* index = (const std::uint8_t*)m_buffer.get();
+        const char* isLogo = m_isLogo.get();
+        for (std::size_t idx = 0u; idx < numPixels; ++idx)
+        {
+            const unsigned lut = isLogo[idx] ? 1u : 0u;
+            std::memcpy(&albedo[4u * idx], albedoLut[lut][index[idx]], 4u);
+            std::memcpy(&specteam[4u * idx], specteamLut[lut][index[idx]], 4u);
         }
     }
 
+    // colour indexed atlas, one byte per pixel
+    const char* indexBuffer() const {
+        return m_buffer.get();
+    }
+
+    // 1 for pixels of textures that are coloured by team
+    const char* logoMask() const {
+        return m_isLogo.get();
+    }
+
     void getTextureUV(const std::string& name, double uvMin[2], double uvMax[2]) const
     {
         auto it = m_textures.find(name);
@@ -300,46 +309,6 @@ public:
         uvMax[0] = double(tex.x+tex.width) / double(m_width);
         uvMax[1] = double(tex.y+tex.height) / double(m_height);
     }
-
-private:
-    bool IsOccupied(const LayerData& tex, bool markOccupied)
-    {
-        for (unsigned int col = 0; col < tex.width; ++col)
-        {
-            for (unsigned int row = 0; row < tex.height; ++row)
-            {
-                unsigned int idx = tex.x + col + (tex.y + row) * m_width;
-                if (markOccupied)
-                {
-                    m_occupied.get()[idx] = true;
-                    m_isLogo.get()[idx] = m_currentTextureIsLogo;
-                }
-                else if (idx >= m_width * m_height || m_occupied.get()[idx])
-                {
-                    return true;
-                }
-            }
-        }
-        return false;
-    }
-
-    void FindPlacement(LayerData& tex)
-    {
-        for (tex.x = 0; tex.x+tex.width <= m_width; ++tex.x)
-        {
-            for (tex.y = 0; tex.y+tex.height <= m_height; ++tex.y)
-            {
-                if (!IsOccupied(tex,false))
-                {
-                    tex.data = m_buffer.get() + tex.x + tex.y * m_width;
-                    IsOccupied(tex, true);
-                    return;
-                }
-            }
-        }
-        throw BufferFull();
-    }
-
 };
 
 std::string JsonKey(const std::string& k)
@@ -465,6 +434,130 @@ void ToJsonBinary(std::ostream& os, const std::string& s)
     os << '"';
 }
 
+struct BinModel
+{
+    std::vector<BinPiece> pieces;
+    std::string names;
+    std::vector<BinVertex> vertices;
+    std::vector<BinPrimitive> primitives;
+    std::vector<std::uint32_t> indices;
+};
+
+std::uint32_t AddBinName(BinModel& model, const std::string& name)
+{
+    std::uint32_t offset = model.names.size();
+    model.names += name;
+    return offset;
+}
+
+void ToBinary(BinModel& model, const rwe::_3do::Object& obj, std::int32_t parentIndex, const CompositeTexture& textures)
+{
+    const std::int32_t pieceIndex = model.pieces.size();
+    model.pieces.emplace_back();
+    {
+        BinPiece& piece = model.pieces.back();
+        piece.mParentIndex = parentIndex;
+        piece.mPosition[0] = obj.x;
+        piece.mPosition[1] = obj.y;
+        piece.mPosition[2] = obj.z;
+        piece.mNameOffset = AddBinName(model, obj.name);
+        piece.mNameLength = obj.name.size();
+        piece.mFirstVertex = model.vertices.size();
+        piece.mNumVertices = obj.vertices.size();
+        piece.mFirstPrimitive = model.primitives.size();
+        piece.mNumPrimitives = obj.primitives.size();
+        piece.mSelectionPrimitiveIndex = obj.selectionPrimitiveIndex ? std::int32_t(*obj.selectionPrimitiveIndex) : -1;
+    }
+
+    for (const rwe::_3do::Vertex& vert : obj.vertices)
+    {
+        model.vertices.push_back(BinVertex{ { vert.x, vert.y, vert.z } });
+    }
+
+    for (const rwe::_3do::Primitive& prim : obj.primitives)
+    {
+        BinPrimitive binPrim;
+        binPrim.mFirstIndex = model.indices.size();
+        binPrim.mNumIndices = prim.vertices.size();
+        binPrim.mColorIndex = prim.colorIndex ? std::int32_t(*prim.colorIndex) : -1;
+        binPrim.mTextureNameOffset = 0u;
+        binPrim.mTextureNameLength = -1;
+        binPrim.mUVMin[0] = binPrim.mUVMin[1] = binPrim.mUVMax[0] = binPrim.mUVMax[1] = 0.0;
+
+        if (prim.textureName)
+        {
+            textures.getTextureUV(*prim.textureName, binPrim.mUVMin, binPrim.mUVMax);
+            binPrim.mTextureNameOffset = AddBinName(model, *prim.textureName);
+            binPrim.mTextureNameLength = prim.textureName->size();
+        }
+        else if (prim.colorIndex)
+        {
+            textures.getTextureUV(GetColorIndexName(*prim.colorIndex), binPrim.mUVMin, binPrim.mUVMax);
+        }
+
+        model.indices.insert(model.indices.end(), prim.vertices.begin(), prim.vertices.end());
+        model.primitives.push_back(binPrim);
+    }
+
+    for (const rwe::_3do::Object& child : obj.children)
+    {
+        ToBinary(model, child, pieceIndex, textures);
+    }
+}
+
+void WriteBinSection(std::ostream& os, std::uint32_t elementSize, std::uint32_t elementCount, const void* data)
+{
+    os.write((const char*)&elementSize, sizeof(elementSize));
+    os.write((const char*)&elementCount, sizeof(elementCount));
+    os.write((const char*)data, std::streamsize(elementSize) * elementCount);
+}
+
+template <typename T>
+void WriteBinSection(std::ostream& os, const std::vector<T>& data)
+{
+    WriteBinSection(os, sizeof(T), data.size(), data.data());
+}
+
+void WriteBinSection(std::ostream& os, const std::string& data)
+{
+    WriteBinSection(os, 1u, data.size(), data.data());
+}
+
+void ToBinary(std::ostream& os, const rwe::_3do::Object& obj, const CompositeTexture& textures, bool indexedAtlas)
+{
+    BinModel model;
+    ToBinary(model, obj, -1, textures);
+
+    std::uint32_t textureDims[2] = { std::uint32_t(textures.getWidth()), std::uint32_t(textures.getHeight()) };
+    std::uint32_t atlasFormat = indexedAtlas ? BinAtlasIndexed : BinAtlasRgba;
+    os.write((const char*)textureDims, sizeof(textureDims));
+    os.write((const char*)&atlasFormat, sizeof(atlasFormat));
+    WriteBinSection(os, model.pieces);
+    WriteBinSection(os, model.names);
+    WriteBinSection(os, model.vertices);
+    WriteBinSection(os, model.primitives);
+    WriteBinSection(os, model.indices);
+
+    if (indexedAtlas)
+    {
+        const std::uint32_t numPixels = textureDims[0] * textureDims[1];
+        CompositeTexture::RgbaLut albedoLut, specteamLut;
+        textures.makeLookupTables(albedoLut, specteamLut);
+
+        WriteBinSection(os, 1u, numPixels, textures.indexBuffer());
+        WriteBinSection(os, 1u, numPixels, textures.logoMask());
+        WriteBinSection(os, 4u, 2u * 256u, albedoLut);
+        WriteBinSection(os, 4u, 2u * 256u, specteamLut);
+    }
+    else
+    {
+        std::string albedo, specteam;
+        textures.saveTextures(albedo, specteam);
+        WriteBinSection(os, albedo);
+        WriteBinSection(os, specteam);
+    }
+}
+
 void GetAllTextureNames(const rwe::_3do::Object& obj, std::set<std::string> &accumulator)
 {
     for (const auto &prim : obj.primitives)
@@ -486,47 +579,79 @@ void GetAllTextureNames(const rwe::_3do::Object& obj, std::set<std::string> &acc
 }
 
 
-std::shared_ptr<CompositeTexture> MakeTextures(const rwe::_3do::Object& obj, const std::vector<std::string> &taDataDirs)
+void CountGeometry(const rwe::_3do::Object& obj, Metrics& metrics)
 {
-    std::set<std::string> allTextures;
-    GetAllTextureNames(obj, allTextures);
+    metrics.addCount("pieces", 1.0);
+    metrics.addCount("vertices", double(obj.vertices.size()));
+    metrics.addCount("primitives", double(obj.primitives.size()));
+    for (const auto& prim : obj.primitives)
+    {
+        if (prim.vertices.size() >= 3u)
+        {
+            metrics.addCount("triangles", double(prim.vertices.size() - 2u));
+        }
+    }
 
-    std::list< std::shared_ptr<std::ifstream> > filestreams;
-    std::list< std::shared_ptr<rwe::GafArchive> > gafs;
-    std::map< std::string, std::shared_ptr<rwe::GafArchive> > gafByTextureName;
+    for (const auto& child : obj.children)
+    {
+        CountGeometry(child, metrics);
+    }
+}
 
-    for (const std::string tadata : taDataDirs)
+
+// GAF archives opened by MakeTextures.
+// Normally only the entries a unit needs are read, and the archives are closed once it is converted. With keepOpen
+// (--batch) archives are read whole and stay open for the units that follow. Not thread safe: one per thread.
+class ArchiveCache
+{
+    struct OpenArchive
+    {
+        std::shared_ptr<std::ifstream> stream;
+        std::shared_ptr<rwe::GafArchive> gaf;
+    };
+
+    const bool m_keepOpen;
+    std::map<std::string, OpenArchive> m_archives;
+
+public:
+    explicit ArchiveCache(bool keepOpen) :
+        m_keepOpen(keepOpen)
+    { }
+
+    // the archive at path, holding at least the entries at entryOffsets. NULL if it can't be opened
+    std::shared_ptr<rwe::GafArchive> open(const std::string& path, const std::vector<std::size_t>& entryOffsets)
     {
-        std::filesystem::path directory = std::filesystem::path(tadata) / "textures";
-        if (!std::filesystem::is_directory(directory))
+        auto it = m_archives.find(path);
+        if (it != m_archives.end())
         {
-            continue;
+            return it->second.gaf;
         }
-        for (const auto& dirEntry : std::filesystem::recursive_directory_iterator(directory))
-        {
-            if (!dirEntry.is_regular_file())
-            {
-                continue;
-            }
-            std::shared_ptr<std::ifstream> fs(new std::ifstream(dirEntry, std::ios_base::binary));
-            if (fs->good())
-            {
-                std::shared_ptr<rwe::GafArchive> gaf(new rwe::GafArchive(fs.get(), dirEntry.path().string()));
 
-                for (const rwe::GafArchive::Entry& entry : gaf->entries())
-                {
-                    if (allTextures.count(entry.name)>0 && gafByTextureName.count(entry.name)==0u)
-                    {
-                        gafByTextureName[entry.name] = gaf;
-                    }
-                }
+        std::shared_ptr<std::ifstream> fs(new std::ifstream(path, std::ios_base::binary));
+        if (!fs->good())
+        {
+            return std::shared_ptr<rwe::GafArchive>();
+        }
+        std::shared_ptr<rwe::GafArchive> gaf(m_keepOpen ?
+            new rwe::GafArchive(fs.get(), path) :
+            new rwe::GafArchive(fs.get(), path, entryOffsets));
+        m_archives[path] = OpenArchive{ fs, gaf };
+        return gaf;
+    }
 
-                filestreams.push_back(fs);
-                gafs.push_back(gaf);
-            }
+    // done with the current unit
+    void release()
+    {
+        if (!m_keepOpen)
+        {
+            m_archives.clear();
         }
     }
+};
 
+
+std::vector<std::uint32_t> LoadTaPalette(const std::vector<std::string> &taDataDirs)
+{
     std::filesystem::path palettesFile;
     for (const std::string tadata : taDataDirs)
     {
@@ -541,70 +666,153 @@ std::shared_ptr<CompositeTexture> MakeTextures(const rwe::_3do::Object& obj, con
     {
         throw std::runtime_error("Unable to find PALETTE.PAL");
     }
+    return LoadPalette(palettesFile.string());
+}
+
+
+std::shared_ptr<CompositeTexture> MakeTextures(const rwe::_3do::Object& obj, const std::vector<std::uint32_t>& palette, const GafCatalog& catalog, ArchiveCache& archives, Metrics& metrics)
+{
+    std::set<std::string> allTextures;
+    GetAllTextureNames(obj, allTextures);
+
+    // open only the archives that hold this model's textures
+    std::map< std::string, std::shared_ptr<rwe::GafArchive> > gafByTextureName;
+    {
+        Metrics::Stage stage(metrics, "gaf_open");
+        std::map< std::string, std::vector<std::size_t> > entryOffsetsByArchive;
+        for (const auto& tex : allTextures)
+        {
+            const GafCatalog::Location* location = catalog.find(tex);
+            if (location)
+            {
+                entryOffsetsByArchive[location->archive->path].push_back(location->texture->entryOffset);
+            }
+        }
+
+        for (const auto& tex : allTextures)
+        {
+            const GafCatalog::Location* location = catalog.find(tex);
+            if (location)
+            {
+                const std::string& path = location->archive->path;
+                std::shared_ptr<rwe::GafArchive> gaf = archives.open(path, entryOffsetsByArchive[path]);
+                if (gaf)
+                {
+                    gafByTextureName[tex] = gaf;
+                }
+            }
+        }
+    }
+
+    // sizes of all textures, from the catalog's frame headers. colour indices are 4x4 swatches
+    struct AtlasItem
+    {
+        std::string name;
+        unsigned width;
+        unsigned height;
+        bool isLogo;
+        int x;
+        int y;
+    };
+    std::vector<AtlasItem> items;
+    for (const auto& tex : allTextures)
+    {
+        const GafCatalog::Location* location = catalog.find(tex);
+        if (location && gafByTextureName.count(tex) > 0u)
+        {
+            items.push_back(AtlasItem{ tex, location->texture->width, location->texture->height, GafCatalog::IsLogoArchive(location->archive->path), 0, 0 });
+        }
+        else if (IsColorIndexName(tex))
+        {
+            items.push_back(AtlasItem{ tex, 4u, 4u, false, 0, 0 });
+        }
+    }
+
+    // largest first packs tightest
+    std::stable_sort(items.begin(), items.end(), [](const AtlasItem& a, const AtlasItem& b) {
+        if (a.width * a.height != b.width * b.height)
+        {
+            return a.width * a.height > b.width * b.height;
+        }
+        return a.height > b.height;
+    });
+
+    // pick the smallest atlas that everything fits in
+    std::size_t totalArea = 0u;
+    for (const AtlasItem& item : items)
+    {
+        totalArea += item.width * item.height;
+    }
 
     for (int szx = 64; szx <= 2048; szx *= 2)
     {
         for (int szy = szx; szy <= 2 * szx; szy *= 2)
         {
-            try
+            if (std::size_t(szx) * szy < totalArea)
             {
-                std::shared_ptr<CompositeTexture> textures(new CompositeTexture(szx, szy, palettesFile.string()));
-                for (const auto& tex : allTextures)
+                continue;
+            }
+
+            bool fits = true;
+            {
+                Metrics::Stage stage(metrics, "atlas_packing");
+                SkylinePacker packer(szx, szy);
+                for (AtlasItem& item : items)
                 {
-                    auto it = gafByTextureName.find(tex);
-                    if (it != gafByTextureName.end())
-                    {
-                        // valid texture
-                        auto entry = it->second->findEntry(tex);
-                        if (entry)
-                        {
-                            textures->beginEntity(tex);
-
-                            // not sure how to correctly determine whether or not a gaf should be coloured by team colour.
-                            // we'll just make all gafs found in logos.gaf coloured by team.
-                            std::string archiveName = it->second->archiveName();
-                            std::transform(archiveName.begin(), archiveName.end(), archiveName.begin(), [](unsigned char c) { return std::tolower(c); });
-                            textures->setCurrentTextureIsLogo(archiveName.find("logo") != std::string::npos);
-
-                            it->second->extract(*entry, *textures);
-                            textures->endEntity();
-                        }
-                    }
-                    else if (IsColorIndexName(tex))
+                    if (!packer.insert(item.width, item.height, item.x, item.y))
                     {
-                        // no texture by that name, but it does appear to be a color index
-                        textures->addColorIndex(tex);
+                        fits = false;
+                        break;
                     }
                 }
-                return textures;
             }
-            catch (CompositeTexture::BufferFull&)
+            if (!fits)
             {
+                continue;
+            }
+            metrics.addCount("atlas_pixels", double(szx) * szy);
+            metrics.addCount("atlas_used_pixels", double(totalArea));
+            metrics.addCount("textures", double(items.size()));
+
+            // decode each texture once, straight into its place
+            Metrics::Stage stage(metrics, "texture_extract");
+            std::shared_ptr<CompositeTexture> textures(new CompositeTexture(szx, szy, palette));
+            for (const AtlasItem& item : items)
+            {
+                textures->place(item.name, item.x, item.y, item.width, item.height, item.isLogo);
             }
+
+            for (const AtlasItem& item : items)
+            {
+                auto it = gafByTextureName.find(item.name);
+                if (it != gafByTextureName.end())
+                {
+                    // valid texture
+                    auto entry = it->second->findEntry(item.name);
+                    if (entry)
+                    {
+                        textures->beginEntity(item.name);
+                        it->second->extract(*entry, *textures);
+                        textures->endEntity();
+                    }
+                }
+                else
+                {
+                    // no texture by that name, but it does appear to be a color index
+                    textures->addColorIndex(item.name);
+                }
+            }
+            return textures;
         }
     }
     return std::shared_ptr<CompositeTexture>();
 }
 
 
-int main(int argc, char **argv)
+std::vector<rwe::_3do::Object> Load3do(const std::string& unitName, const std::vector<std::string>& taDataDirs, Metrics& metrics)
 {
-    if (argc < 3)
-    {
-        std::cerr << "USAGE: " << argv[0] << " <unit name> <tadata path 1> <tadata path 2> ..." << std::endl;
-        std::cerr << "eg: " << argv[0] << " ARMACA_dead d:\\temp\\ccdata d:\\temp\\totala1" << std::endl;
-        return 1;
-    }
-
-    const std::string unitName = argv[1];
+    Metrics::Stage stage(metrics, "parse_3do");
     std::vector<rwe::_3do::Object> _3doData;
-
-    std::vector<std::string> taDataDirs;
-    for (int idxArg = 2; idxArg < argc; ++idxArg)
-    {
-        taDataDirs.push_back(argv[idxArg]);
-    }
-
     for (const std::string &tadata: taDataDirs)
     {
         const std::string objects3d = tadata + "\\objects3d\\";
@@ -615,34 +823,373 @@ int main(int argc, char **argv)
             break;
         }
     }
+    for (auto& obj : _3doData)
+    {
+        CountGeometry(obj, metrics);
+    }
+    return _3doData;
+}
 
-    if (!_3doData.empty())
+
+// write a unit's models to os, as JSON or in the binary format of BinaryFormat.h
+// MakeTextures returns null when the textures don't fit in the largest atlas
+std::shared_ptr<CompositeTexture> RequireTextures(std::shared_ptr<CompositeTexture> textures, const std::string& unitName)
+{
+    if (!textures)
+    {
+        throw std::runtime_error("textures of " + unitName + " don't fit in the largest atlas");
+    }
+    return textures;
+}
+
+void WriteUnit(std::ostream& os, const std::string& unitName, const std::vector<rwe::_3do::Object>& _3doData,
+    bool binaryFormat, bool indexedAtlas, const std::vector<std::uint32_t>& palette, const GafCatalog& catalog, ArchiveCache& archives,
+    Metrics& metrics)
+{
+    if (binaryFormat)
+    {
+        BinHeader header;
+        std::copy(BinMagic, BinMagic + 4, header.mMagic);
+        header.mVersion = BinVersion;
+        header.mNumModels = _3doData.size();
+        header.mUnitNameLength = unitName.size();
+        os.write((const char*)&header, sizeof(header));
+        os.write(unitName.data(), unitName.size());
+
+        for (auto& obj : _3doData)
+        {
+            std::shared_ptr<CompositeTexture> textures = RequireTextures(MakeTextures(obj, palette, catalog, archives, metrics), unitName);
+            Metrics::Stage stage(metrics, "emit_bin");
+            ToBinary(os, obj, *textures, indexedAtlas);
+        }
+    }
+    else
     {
-        std::cout << "{" << JsonKey(unitName) << "[";
+        os << "{" << JsonKey(unitName) << "[";
         for (auto& obj : _3doData)
         {
-            std::shared_ptr<CompositeTexture> textures = MakeTextures(obj, taDataDirs);
-            std::ostringstream albedo, specteam;
+            std::shared_ptr<CompositeTexture> textures = RequireTextures(MakeTextures(obj, palette, catalog, archives, metrics), unitName);
+            Metrics::Stage stage(metrics, "emit_json");
+            std::string albedo, specteam;
+            textures->saveTextures(albedo, specteam);
+
+            os << "{" << JsonKey("root");
+            ToJson(os, obj, *textures);
+            os << ',' << JsonKey("albedo");
+            ToJsonBinary(os, albedo);
+            os << ',' << JsonKey("specteam");
+            ToJsonBinary(os, specteam);
+            os << ',' << JsonKey("texture_dims") << '[' << textures->getWidth() << ',' << textures->getHeight() << ']';
+            os << "}";
+            if (&obj != &_3doData.back())
             {
-                textures->saveTextures(albedo);
-                textures->saveLogos(specteam);
+                os << ',';
             }
+        }
+        os << "]}";
+    }
+    archives.release();
 
-            std::cout << "{" << JsonKey("root");
-            ToJson(std::cout, obj, *textures);
-            std::cout << ',' << JsonKey("albedo");
-            ToJsonBinary(std::cout, albedo.str());
-            std::cout << ',' << JsonKey("specteam");
-            ToJsonBinary(std::cout, specteam.str());
-            std::cout << ',' << JsonKey("texture_dims") << '[' << textures->getWidth() << ',' << textures->getHeight() << ']';
-            std::cout << "}";
-            if (&obj != &_3doData.back())
+    metrics.setCount("models", double(_3doData.size()));
+    if (metrics.count("atlas_pixels") > 0.0)
+    {
+        metrics.setCount("atlas_fill_ratio", metrics.count("atlas_used_pixels") / metrics.count("atlas_pixels"));
+    }
+}
+
+
+std::string TrimWhitespace(const std::string& s)
+{
+    const char* whitespace = " \t\r\n";
+    std::size_t first = s.find_first_not_of(whitespace);
+    if (first == std::string::npos)
+    {
+        return std::string();
+    }
+    return s.substr(first, s.find_last_not_of(whitespace) - first + 1);
+}
+
+
+// --batch: convert many units with one GAF catalog, palette and set of open archives per worker thread.
+// Unit names come from unitNames or, if that is empty, from stdin, one per line. Each unit's output is written to
+// stdout as a frame (see BinaryFormat.h) as soon as it is done.
+class BatchConverter
+{
+    const std::vector<std::string>& m_taDataDirs;
+    const bool m_binaryFormat;
+    const bool m_indexedAtlas;
+    const std::string m_metricsFile;
+    const GafCatalog& m_catalog;
+    const std::vector<std::uint32_t> m_palette;
+
+    std::mutex m_queueMutex;
+    std::condition_variable m_queueChanged;
+    std::deque<std::string> m_queue;
+    bool m_queueClosed;
+
+    std::mutex m_outputMutex;
+    bool m_allFound;
+
+public:
+    BatchConverter(const std::vector<std::string>& taDataDirs, bool binaryFormat, bool indexedAtlas, const std::string& metricsFile,
+        const GafCatalog& catalog, const std::vector<std::uint32_t>& palette) :
+        m_taDataDirs(taDataDirs),
+        m_binaryFormat(binaryFormat),
+        m_indexedAtlas(indexedAtlas),
+        m_metricsFile(metricsFile),
+        m_catalog(catalog),
+        m_palette(palette),
+        m_queueClosed(false),
+        m_allFound(true)
+    { }
+
+    // returns false if any unit wasn't found or couldn't be converted
+    bool run(const std::vector<std::string>& unitNames, unsigned numThreads)
+    {
+        std::vector<std::thread> workers;
+        for (unsigned n = 0; n < numThreads; ++n)
+        {
+            workers.emplace_back(&BatchConverter::work, this);
+        }
+
+        if (!unitNames.empty())
+        {
+            for (const std::string& unitName : unitNames)
             {
-                std::cout << ',';
+                push(unitName);
+            }
+        }
+        else
+        {
+            std::string line;
+            while (std::getline(std::cin, line))
+            {
+                line = TrimWhitespace(line);
+                if (!line.empty())
+                {
+                    push(line);
+                }
             }
         }
-        std::cout << "]}";
-        return 0;
+        close();
+
+        for (std::thread& worker : workers)
+        {
+            worker.join();
+        }
+        return m_allFound;
+    }
+
+private:
+    void push(const std::string& unitName)
+    {
+        std::lock_guard<std::mutex> lock(m_queueMutex);
+        m_queue.push_back(unitName);
+        m_queueChanged.notify_one();
+    }
+
+    void close()
+    {
+        std::lock_guard<std::mutex> lock(m_queueMutex);
+        m_queueClosed = true;
+        m_queueChanged.notify_all();
+    }
+
+    // next unit name, or false once the queue is closed and empty
+    bool pop(std::string& unitName)
+    {
+        std::unique_lock<std::mutex> lock(m_queueMutex);
+        m_queueChanged.wait(lock, [this] { return !m_queue.empty() || m_queueClosed; });
+        if (m_queue.empty())
+        {
+            return false;
+        }
+        unitName = m_queue.front();
+        m_queue.pop_front();
+        return true;
+    }
+
+    void work()
+    {
+        ArchiveCache archives(true);
+        std::string unitName;
+        while (pop(unitName))
+        {
+            Metrics metrics;
+            std::ostringstream payload;
+            std::uint32_t status = BinFrameOk;
+            try
+            {
+                std::vector<rwe::_3do::Object> _3doData = Load3do(unitName, m_taDataDirs, metrics);
+                if (_3doData.empty())
+                {
+                    status = BinFrameNotFound;
+                }
+                else
+                {
+                    WriteUnit(payload, unitName, _3doData, m_binaryFormat, m_indexedAtlas, m_palette, m_catalog, archives, metrics);
+                }
+            }
+            catch (std::exception& e)
+            {
+                status = BinFrameError;
+                payload.str(e.what());
+            }
+            writeFrame(unitName, status, payload.str(), metrics);
+        }
+    }
+
+    void writeFrame(const std::string& unitName, std::uint32_t status, const std::string& payload, const Metrics& metrics)
+    {
+        BinFrameHeader header;
+        std::copy(BinFrameMagic, BinFrameMagic + 4, header.mMagic);
+        header.mStatus = status;
+        header.mUnitNameLength = unitName.size();
+        header.mPayloadLength = payload.size();
+
+        std::lock_guard<std::mutex> lock(m_outputMutex);
+        // metrics first, so that a reader of the frames finds the unit's metrics line once its frame has arrived
+        if (!m_metricsFile.empty() && !metrics.write(m_metricsFile, unitName))
+        {
+            std::cerr << "unable to write metrics to '" << m_metricsFile << "'" << std::endl;
+        }
+
+        std::cout.write((const char*)&header, sizeof(header));
+        std::cout.write(unitName.data(), unitName.size());
+        std::cout.write(payload.data(), payload.size());
+        std::cout.flush();
+
+        if (status != BinFrameOk)
+        {
+            m_allFound = false;
+        }
+    }
+};
+
+
+int main(int argc, char **argv)
+{
+    bool binaryFormat = false;
+    bool indexedAtlas = false;
+    bool batch = false;
+    unsigned numThreads = std::max(1u, std::thread::hardware_concurrency());
+    std::string catalogFile = (std::filesystem::temp_directory_path() / "3do2scm_gafcatalog.txt").string();
+    std::string metricsFile;
+    std::vector<std::string> unitNames;
+    std::vector<std::string> positionalArgs;
+    for (int idxArg = 1; idxArg < argc; ++idxArg)
+    {
+        const std::string arg = argv[idxArg];
+        if (rwe::startsWith(arg, "--gaf-catalog="))
+        {
+            catalogFile = arg.substr(std::string("--gaf-catalog=").size());
+        }
+        else if (rwe::startsWith(arg, "--metrics="))
+        {
+            metricsFile = arg.substr(std::string("--metrics=").size());
+        }
+        else if (arg == "--batch")
+        {
+            batch = true;
+        }
+        else if (rwe::startsWith(arg, "--jobs="))
+        {
+            numThreads = std::max(1, std::stoi(arg.substr(std::string("--jobs=").size())));
+        }
+        else if (rwe::startsWith(arg, "--unit="))
+        {
+            unitNames.push_back(arg.substr(std::string("--unit=").size()));
+        }
+        else if (arg == "--atlas=indexed")
+        {
+            indexedAtlas = true;
+        }
+        else if (arg == "--atlas=rgba")
+        {
+            indexedAtlas = false;
+        }
+        else if (arg == "--format=bin")
+        {
+            binaryFormat = true;
+        }
+        else if (arg == "--format=json")
+        {
+            binaryFormat = false;
+        }
+        else
+        {
+            positionalArgs.push_back(arg);
+        }
+    }
+
+    if (positionalArgs.size() < (batch ? 1u : 2u))
+    {
+        std::cerr << "USAGE: " << argv[0] << " [--format=json|bin] [--atlas=rgba|indexed] [--gaf-catalog=<file>] [--metrics=<file>] <unit name> <tadata path 1> <tadata path 2> ..." << std::endl;
+        std::cerr << "       " << argv[0] << " --batch [--jobs=<n>] [--unit=<unit name> ...] [other options] <tadata path 1> <tadata path 2> ..." << std::endl;
+        std::cerr << "eg: " << argv[0] << " ARMACA_dead d:\\temp\\ccdata d:\\temp\\totala1" << std::endl;
+        std::cerr << "--batch converts each --unit, or each unit named on a line of stdin, writing a frame per unit to stdout" << std::endl;
+        return 1;
+    }
+
+#ifdef _WIN32
+    if (binaryFormat || batch)
+    {
+        _setmode(_fileno(stdout), _O_BINARY);
+    }
+#endif
+
+    if (batch)
+    {
+        const std::vector<std::string>& taDataDirs = positionalArgs;
+        GafCatalog catalog(catalogFile);
+        catalog.update(taDataDirs);
+
+        std::vector<std::uint32_t> palette;
+        try
+        {
+            palette = LoadTaPalette(taDataDirs);
+        }
+        catch (std::exception& e)
+        {
+            std::cerr << e.what() << std::endl;
+            return 1;
+        }
+
+        BatchConverter converter(taDataDirs, binaryFormat, indexedAtlas, metricsFile, catalog, palette);
+        return converter.run(unitNames, numThreads) ? 0 : 1;
+    }
+
+    const std::string unitName = positionalArgs[0];
+    std::vector<std::string> taDataDirs(positionalArgs.begin() + 1, positionalArgs.end());
+    Metrics metrics;
+
+    std::vector<rwe::_3do::Object> _3doData = Load3do(unitName, taDataDirs, metrics);
+
+    GafCatalog catalog(catalogFile);
+    int result = 1;
+    if (!_3doData.empty())
+    {
+        {
+            Metrics::Stage stage(metrics, "gaf_scan");
+            catalog.update(taDataDirs);
+        }
+
+        ArchiveCache archives(false);
+        try
+        {
+            WriteUnit(std::cout, unitName, _3doData, binaryFormat, indexedAtlas, LoadTaPalette(taDataDirs), catalog, archives, metrics);
+            std::cout.flush();
+            result = 0;
+        }
+        catch (std::exception& e)
+        {
+            std::cerr << e.what() << std::endl;
+        }
+    }
+
+    if (!metricsFile.empty() && !metrics.write(metricsFile, unitName))
+    {
+        std::cerr << "unable to write metrics to '" << metricsFile << "'" << std::endl;
     }
-    return 1;
+    return result;
 }
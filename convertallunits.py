@@ -1,38 +1,691 @@
 import argparse
+import asyncio
+import concurrent.futures
+import concurrent.futures.process
+import cProfile
 import glob
 import json
+import multiprocessing
 import os
-import scm.supcom_exporter 
-import subprocess
+import shutil
+import struct
+import scm.binary_3do
+import scm.buildcache
+import scm.gafcatalog
+import scm.parse3do
+import scm.supcom_exporter
 import sys
+import tempfile
+import time
 
-cwd = os.getcwd()
-
-parser = argparse.ArgumentParser()
-parser.add_argument('--input-spec', help=r'search spec for fbi files for units to convert, eg "d:\temp\ccdata\UNITS\*.fbi"')
-parser.add_argument('--converter-cmd', help='path to 3do2scm.exe executable, eg "c:\\3do2scm.exe"', required=False, default=os.path.join(cwd,"3do2scm.exe"))
-parser.add_argument('--tadata-paths', help='paths under which to search for 3do files, eg "d:\\temp\\totala1 d:\\temp\\ccdata"', nargs='+')
-args = parser.parse_args()
-
-units_dir = os.path.join(cwd,'UNITS')
-if not os.path.exists(units_dir):
-    os.mkdir(units_dir)
-
-for fn in glob.glob(args.input_spec):
-    print("----", fn)
-    unit,_ = os.path.splitext(os.path.basename(fn))
-    target_dir = os.path.join(units_dir,unit)
-    if not os.path.exists(target_dir):
-        os.mkdir(target_dir)
-    os.chdir(target_dir)
-    
-    for suffix in ("", "_dead"):
+try:
+    import resource
+except ImportError:
+    # windows
+    resource = None
+    import ctypes
+    import ctypes.wintypes
+
+# The conversion of each model is pipelined in two stages:
+#
+#   converter   one 3do2scm --batch process, converting up to --jobs models at a time on its threads
+#   exporter    scm.supcom_exporter.export, run in a pool of --jobs worker processes
+#
+# The stages are joined by a queue of at most --jobs converter outputs, so the converters stall (rather than
+# hold an unbounded number of atlases in memory) when the exporters fall behind.  The converter process keeps
+# the GAF catalog, palette and open archives across models, so a model costs no process start or rescan.
+#
+# Builds are incremental.  Each stage's inputs are recorded in a scm.buildcache.BuildCache:
+#
+#   converter   the .3do, the GAF archive and entry digest of every texture it uses, PALETTE.PAL, the converter
+#               executable and the handover format
+#   exporter    the converter output, the exporter's sources and its --lods and --lod-atlases options
+#
+# and its outputs kept there by content.  A model whose recorded inputs haven't changed is skipped if its
+# outputs are intact, or else restored from the cache; a stage whose inputs have been seen before is not run.
+#
+# --metrics appends a line of json per model, with the converter's own metrics (3do2scm --metrics) and the
+# exporter's per-stage wall and cpu times and counts.  Peak memory is the process's, not the model's own: the
+# converter's peak_rss_bytes is that of the converter process over every model it has converted so far, and the
+# exporter's worker_peak_rss_bytes that of the worker process that exported the model, over every model it has.
+# --profile N keeps cProfile dumps of the N models that took longest to export.
+
+
+def export_converter_output(converter_output, fmt, output_dir, lods, lod_atlases, collect_metrics=False, profile_file=None):
+    """
+    exporter stage. runs in a worker process.
+    returns (paths of the files written, metrics or None).  metrics are per unit, as from supcom_exporter.export
+    """
+
+    metrics = { } if collect_metrics else None
+    profile = cProfile.Profile() if profile_file else None
+    if profile:
+        profile.enable()
+
+    try:
+        load_stages = { }
+        with scm.supcom_exporter.stage_timer(load_stages, "load"):
+            if fmt == 'bin':
+                _3do_data = scm.binary_3do.load(converter_output)
+            else:
+                _3do_data = json.loads(converter_output)
+        written = scm.supcom_exporter.export(_3do_data, output_dir, metrics, lods, lod_atlases)
+    finally:
+        # a failed export is still profiled, and the worker isn't left with the profiler enabled
+        if profile:
+            profile.disable()
+            profile.dump_stats(profile_file)
+
+    if metrics is not None:
+        for unit_metrics in metrics.values():
+            unit_metrics["stages"].update(load_stages)
+            unit_metrics["worker_peak_rss_bytes"] = peak_rss_bytes()
+    return written, metrics
+
+
+def lod_budget(text):
+    # as scm.supcom_exporter.LOD_TRIANGLE_BUDGETS: an int is a number of triangles, a float a fraction of lod0's
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+def peak_rss_bytes():
+    """ peak resident set size (on windows, peak working set) of this process, or None where it isn't available """
+    if resource is None:
+        return windows_peak_working_set()
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes, except on macos
+    return maxrss if sys.platform == 'darwin' else maxrss*1024
+
+
+def windows_peak_working_set():
+    """ as app/Metrics.cpp's Metrics::PeakRssBytes on windows """
+    class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+        _fields_ = [
+            ("cb", ctypes.wintypes.DWORD),
+            ("PageFaultCount", ctypes.wintypes.DWORD),
+            ("PeakWorkingSetSize", ctypes.c_size_t),
+            ("WorkingSetSize", ctypes.c_size_t),
+            ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+            ("PagefileUsage", ctypes.c_size_t),
+            ("PeakPagefileUsage", ctypes.c_size_t),
+        ]
+
+    try:
+        GetCurrentProcess = ctypes.windll.kernel32.GetCurrentProcess
+        GetProcessMemoryInfo = ctypes.windll.psapi.GetProcessMemoryInfo
+    except (AttributeError, OSError):
+        return None
+    GetCurrentProcess.restype = ctypes.wintypes.HANDLE
+    GetProcessMemoryInfo.argtypes = [ ctypes.wintypes.HANDLE, ctypes.POINTER(PROCESS_MEMORY_COUNTERS), ctypes.wintypes.DWORD ]
+    GetProcessMemoryInfo.restype = ctypes.wintypes.BOOL
+    counters = PROCESS_MEMORY_COUNTERS()
+    counters.cb = ctypes.sizeof(counters)
+    if not GetProcessMemoryInfo(GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+        return None
+    return counters.PeakWorkingSetSize
+
+
+class MetricsLog:
+    """ --metrics and --profile """
+
+    def __init__(self, metrics_file, profile_count, profile_dir):
+        self.file = open(metrics_file, 'at', encoding='utf-8') if metrics_file else None
+        self.profile_count = profile_count
+        self.profile_dir = profile_dir
+        self.profiles = []      # (export seconds, profile file)
+        self.tmp_dir = tempfile.mkdtemp(prefix="convertallunits") if self.file else None
+        if profile_count > 0:
+            os.makedirs(profile_dir, exist_ok=True)
+
+    def converter_metrics_file(self, generation):
+        """ file for the 3do2scm --metrics of a converter process, or None """
+        return os.path.join(self.tmp_dir, "converter{}.jsonl".format(generation)) if self.file else None
+
+    def profile_file(self, model):
+        return os.path.join(self.profile_dir, model + ".prof") if self.profile_count > 0 else None
+
+    def add_profile(self, seconds, profile_file):
+        # keep the slowest
+        self.profiles.append((seconds, profile_file))
+        self.profiles.sort(reverse=True)
+        for _,discarded in self.profiles[self.profile_count:]:
+            os.remove(discarded)
+        del self.profiles[self.profile_count:]
+
+    def write(self, record):
+        if self.file:
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+def tool_digests(args):
+    """ digests standing for the versions of the converter and exporter """
+    converter_path = shutil.which(args.converter_cmd) or args.converter_cmd
+    if getattr(sys, 'frozen', False):
+        # packaged by pyinstaller (pybuild.bat). the exporter is inside the executable
+        exporter_digest = scm.buildcache.file_digest(sys.executable)
+    else:
+        exporter_digest = scm.buildcache.inputs_digest([
+            scm.buildcache.file_digest(module.__file__) for module in (scm.binary_3do, scm.supcom_exporter) ])
+    return scm.buildcache.file_digest(converter_path), exporter_digest
+
+
+def gaf_entry_digest(cache, entry_digests, path, entry_offset):
+    """
+    scm.gafcatalog.entry_digest, kept in cache (and in the dictionary entry_digests for this run) keyed by the
+    archive's path, size and modification time, so a texture's pixels are only hashed again when its archive changes
+    """
+
+    stat = os.stat(path)
+    key = scm.buildcache.inputs_digest({ "gaf_entry": [ path, entry_offset, stat.st_size, stat.st_mtime_ns ] })
+    if key not in entry_digests:
+        action = cache.get_action(key)
+        if action is None:
+            action = { "digest": scm.gafcatalog.entry_digest(path, entry_offset) }
+            cache.put_action(key, action)
+        entry_digests[key] = action["digest"]
+    return entry_digests[key]
+
+
+def converter_inputs(args, catalog, cache, entry_digests, model, _3do_path, converter_digest):
+    """
+    everything the converter's output for model depends on.
+    raises OSError, ValueError or struct.error if the .3do or a GAF archive is unreadable
+    """
+
+    with open(_3do_path, 'rb') as file:
+        _3do_data = file.read()
+
+    # the texture 3do2scm reads is the one its own catalog finds.  this key only describes it if catalog finds the
+    # same archive: the two must agree on which archive a name is looked up in (GafCatalog::update)
+    textures = { }
+    for name in sorted(scm.parse3do.texture_names(_3do_data)):
+        location = catalog.find(name)
+        if location is None:
+            # a colour index, or a missing texture
+            textures[name] = None
+        else:
+            archive, texture = location
+            textures[name] = [ archive.path, gaf_entry_digest(cache, entry_digests, archive.path, texture.entry_offset) ]
+
+    palette_digest = None
+    for tadata in args.tadata_paths:
+        palette_path = os.path.join(tadata, "palettes", "PALETTE.PAL")
+        if os.path.isfile(palette_path):
+            palette_digest = scm.buildcache.file_digest(palette_path)
+            break
+
+    return {
+        "model": model,
+        "3do": [ _3do_path, scm.buildcache.bytes_digest(_3do_data) ],
+        "textures": textures,
+        "palette": palette_digest,
+        "converter": converter_digest,
+        "format": args.format,
+    }
+
+
+def export_key(model, converter_output_digest, exporter_digest):
+    return scm.buildcache.inputs_digest({
+        "model": model, "converter_output": converter_output_digest, "exporter": exporter_digest })
+
+
+def outputs_intact(output_dir, outputs):
+    for filename,digest in outputs.items():
+        path = os.path.join(output_dir, filename)
+        if not os.path.isfile(path) or scm.buildcache.file_digest(path) != digest:
+            return False
+    return True
+
+
+def build_target(model, output_dir):
+    return { "model": model, "output_dir": os.path.abspath(output_dir) }
+
+
+def try_skip(cache, job):
+    """
+    "up to date" if the model's outputs are up to date, "restored from cache" if they could be restored from
+    the cache, otherwise None
+    """
+
+    record = cache.get_build(build_target(job["model"], job["output_dir"]))
+    if record is not None and record["convert_key"] == job["convert_key"] and record["exporter"] == job["exporter"] \
+            and outputs_intact(job["output_dir"], record["outputs"]):
+        return "up to date"
+
+    convert_action = cache.get_action(job["convert_key"])
+    if convert_action is None:
+        return None
+    export_action = cache.get_action(export_key(job["model"], convert_action["converter_output"], job["exporter"]))
+    if export_action is None:
+        return None
+    for filename,digest in export_action["outputs"].items():
+        if not cache.restore(digest, os.path.join(job["output_dir"], filename)):
+            return None
+
+    record_build(cache, job, export_action["outputs"])
+    return "restored from cache"
+
+
+def record_build(cache, job, outputs):
+    cache.put_build(build_target(job["model"], job["output_dir"]), {
+        "convert_key": job["convert_key"],
+        "exporter": job["exporter"],
+        "inputs": job["inputs"],
+        "outputs": outputs })
+
+
+class WorkerContext:
+    """ A multiprocessing context that keeps the processes it starts, so that the pool's workers can be killed """
+
+    def __init__(self, context):
+        self.context = context
+        self.processes = []
+
+    def Process(self, *args, **kwargs):
+        # forget workers that have exited, eg recycled after --max-tasks-per-worker
+        self.processes = [ process for process in self.processes if process.exitcode is None ]
+        process = self.context.Process(*args, **kwargs)
+        self.processes.append(process)
+        return process
+
+    def __getattr__(self, name):
+        return getattr(self.context, name)
+
+    def terminate(self):
+        for process in self.processes:
+            if process.pid is not None and process.exitcode is None:
+                process.terminate()
+
+
+def make_export_pool(args):
+    """ @return: (process pool, the WorkerContext holding its workers) """
+
+    if sys.version_info >= (3, 11):
+        # recycle workers, to return the memory of large models to the system.  as the pool would, spawn them:
+        # a forked worker can't be recycled
+        context = WorkerContext(multiprocessing.get_context("spawn"))
+        return concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs, mp_context=context,
+            max_tasks_per_child=args.max_tasks_per_worker), context
+    context = WorkerContext(multiprocessing.get_context())
+    return concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs, mp_context=context), context
+
+
+class ExportPool:
+    """
+    The exporters' process pool.  A process pool can't cancel a task that is running, so when an export times out
+    the pool's processes are killed and a new pool started.  The other exports that were running in it fail with
+    BrokenProcessPool, and are submitted again to the new one
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.pool, self.workers = make_export_pool(args)
+        self.generation = 0
+
+    async def run(self, timeout, *call):
+        while True:
+            generation = self.generation
+            future = asyncio.get_running_loop().run_in_executor(self.pool, *call)
+            try:
+                return await asyncio.wait_for(future, timeout=timeout)
+            except asyncio.TimeoutError:
+                self.kill(generation)
+                raise
+            except concurrent.futures.process.BrokenProcessPool:
+                if generation == self.generation:
+                    raise
+                # killed for another export's timeout
+
+    def kill(self, generation):
+        # unless another timeout has already replaced the pool
+        if generation != self.generation:
+            return
+        self.workers.terminate()
+        # quick: its processes are gone
+        self.pool.shutdown(wait=True, cancel_futures=True)
+        self.pool, self.workers = make_export_pool(self.args)
+        self.generation += 1
+
+    def shutdown(self):
+        # nothing is left running that is wanted, so don't wait on a worker that may be hung
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+class ConverterExited(RuntimeError):
+    def __init__(self, message, killed):
+        RuntimeError.__init__(self, message)
+        self.killed = killed
+
+
+class ConverterProcess:
+    """
+    One 3do2scm --batch process.  Models are asked for a line at a time on its stdin, and their output read from
+    the frames it writes to stdout as they finish, in whatever order that is
+    """
+
+    def __init__(self, proc, name, metrics_file):
+        self.proc = proc
+        self.name = name
+        self.metrics_file = metrics_file
+        self.metrics_stream = None
+        self.metrics_line = ""
+        self.metrics = { }      # unit: its line of 3do2scm --metrics, until its frame arrives
+        self.pending = { }      # unit: future of (converter output, metrics or None)
+        self.killed = False
+        self.reader = asyncio.ensure_future(self.read_frames())
+
+    @staticmethod
+    async def start(args, metrics_file):
+        cmd = [args.converter_cmd, '--batch', '--jobs={}'.format(args.jobs), '--format='+args.format, '--atlas=indexed',
+            '--gaf-catalog='+args.gaf_catalog]
+        if metrics_file:
+            cmd.append('--metrics='+metrics_file)
+        cmd += args.tadata_paths
+        proc = await asyncio.create_subprocess_exec(*cmd, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=None)
+        return ConverterProcess(proc, os.path.basename(args.converter_cmd), metrics_file)
+
+    def running(self):
+        return not self.reader.done()
+
+    async def convert(self, model):
+        future = asyncio.get_running_loop().create_future()
+        self.pending[model] = future
+        try:
+            self.proc.stdin.write(os.fsencode(model) + b'\n')
+            await self.proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # exited.  read_frames fails the future
+            pass
+        return await future
+
+    async def read_frames(self):
+        try:
+            while True:
+                status, unit_name_length, payload_length = scm.binary_3do.frame_header(
+                    await self.proc.stdout.readexactly(scm.binary_3do.FRAME_HEADER_SIZE))
+                unit = os.fsdecode(await self.proc.stdout.readexactly(unit_name_length))
+                payload = await self.proc.stdout.readexactly(payload_length)
+                future = self.pending.pop(unit, None)
+                if future is None or future.done():
+                    # timed out
+                    continue
+                if status == scm.binary_3do.FRAME_OK:
+                    future.set_result((payload, self.unit_metrics(unit)))
+                elif status == scm.binary_3do.FRAME_NOT_FOUND:
+                    future.set_exception(RuntimeError("not found"))
+                else:
+                    future.set_exception(RuntimeError(payload.decode('utf-8', errors='replace')))
+        except (asyncio.IncompleteReadError, scm.binary_3do.BinaryFormatError):
+            pass
+        finally:
+            returncode = await self.proc.wait()
+            if self.metrics_stream:
+                self.metrics_stream.close()
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConverterExited("{} exited with status {}".format(self.name, returncode), self.killed))
+            self.pending = { }
+
+    def unit_metrics(self, unit):
+        """ the unit's line of 3do2scm --metrics, without "unit" and "tool", or None """
+
+        if not self.metrics_file:
+            return None
+        try:
+            if self.metrics_stream is None:
+                self.metrics_stream = open(self.metrics_file, 'rt', encoding='utf-8', errors='surrogateescape')
+            # the unit's line was written before its frame.  another unit's may be part written
+            for line in self.metrics_stream:
+                self.metrics_line += line
+                if self.metrics_line.endswith('\n'):
+                    record = json.loads(self.metrics_line)
+                    self.metrics_line = ""
+                    self.metrics[record.pop("unit")] = record
+                    del record["tool"]
+        except (OSError, ValueError):
+            return None
+        return self.metrics.pop(unit, None)
+
+    async def kill(self):
+        self.killed = True
+        if self.proc.returncode is None:
+            self.proc.kill()
+        await self.reader
+
+    async def close(self):
+        # the converter exits once it has finished what it was asked for
+        self.proc.stdin.close()
+        await self.reader
+
+
+class Converter:
+    """
+    The converter: a 3do2scm --batch process, which keeps the GAF catalog, palette and open archives in memory
+    across models and converts up to --jobs at a time on its own threads.  It is started when the first model
+    that isn't cached needs converting.  A model can't be cancelled once asked for, so when one times out the
+    process is killed, and the other models it was converting are asked of a new one.  If it exits by itself, the
+    models it was converting are tried once more
+    """
+
+    def __init__(self, args, metrics_log):
+        self.args = args
+        self.metrics_log = metrics_log
+        self.process = None
+        self.starting = asyncio.Lock()
+        self.generation = 0
+
+    async def current(self):
+        async with self.starting:
+            if self.process is None or not self.process.running():
+                self.process = await ConverterProcess.start(self.args, self.metrics_log.converter_metrics_file(self.generation))
+                self.generation += 1
+            return self.process
+
+    async def convert(self, model, timeout):
+        """ @return: (converter output, its metrics or None) """
+
+        if model != model.strip() or '\n' in model:
+            raise RuntimeError("name can't be passed to 3do2scm --batch")
+
+        retried = False
+        while True:
+            process = await self.current()
+            try:
+                return await asyncio.wait_for(process.convert(model), timeout=timeout)
+            except asyncio.TimeoutError:
+                await process.kill()
+                raise
+            except ConverterExited as e:
+                # killed for another model's timeout, so ask a new process.  or it crashed, maybe on this model
+                if not e.killed:
+                    if retried:
+                        raise
+                    retried = True
+
+    async def close(self):
+        if self.process is not None:
+            await self.process.close()
+
+    async def kill(self):
+        if self.process is not None:
+            await self.process.kill()
+
+
+async def converter_stage(args, cache, metrics_log, converter, jobs, exports):
+    while jobs:
+        job = jobs.pop()
+        model = job["model"]
+        job["metrics"] = { "unit": model, "tool": "convertallunits", "status": "converted" }
+
+        convert_action = None if args.force else cache.get_action(job["convert_key"])
+        converter_output = cache.get_bytes(convert_action["converter_output"]) if convert_action else None
+        if converter_output is None:
+            start = time.perf_counter()
+            try:
+                converter_output, converter_metrics = await converter.convert(model, args.timeout)
+            except asyncio.TimeoutError:
+                print("Unable to convert model {}: converter timed out after {}s".format(model, args.timeout))
+                metrics_log.write(dict(job["metrics"], status="converter timed out"))
+                continue
+            except (OSError, RuntimeError) as e:
+                print("Unable to convert model {}: {}".format(model, e))
+                metrics_log.write(dict(job["metrics"], status="converter failed"))
+                continue
+            if metrics_log.file:
+                job["metrics"]["converter"] = converter_metrics or { }
+                job["metrics"]["converter"]["wall_s"] = time.perf_counter() - start
+            if converter_output:
+                cache.put_action(job["convert_key"], { "converter_output": cache.put_bytes(converter_output) })
+        else:
+            job["metrics"]["status"] = "converter output cached"
+
+        if converter_output:
+            # blocks while the exporters are behind
+            await exports.put((job, converter_output))
+
+
+async def exporter_stage(args, cache, metrics_log, pool, exports):
+    while True:
+        job, converter_output = await exports.get()
+        model = job["model"]
         try:
-            json_bytes = subprocess.check_output([args.converter_cmd, unit+suffix] + args.tadata_paths, stderr=None, shell=True)
-            if json_bytes:
-                _3do_data = json.loads(json_bytes)
-                scm.supcom_exporter.export(_3do_data)
-        except subprocess.CalledProcessError as e:
-            print("Unable to convert model {}: {}".format(unit+suffix, e))
-
-os.chdir(cwd)
+            profile_file = metrics_log.profile_file(model)
+            start = time.perf_counter()
+            written, metrics = await pool.run(args.timeout, export_converter_output,
+                converter_output, args.format, job["output_dir"], args.lods, args.lod_atlases, metrics_log.file is not None, profile_file)
+            seconds = time.perf_counter() - start
+            if profile_file:
+                metrics_log.add_profile(seconds, profile_file)
+            if metrics is not None:
+                job["metrics"]["exporter"] = dict(metrics.get(model, { }), wall_s=seconds)
+            metrics_log.write(job["metrics"])
+
+            outputs = { os.path.basename(path): cache.put_file(path) for path in written }
+            converter_output_digest = scm.buildcache.bytes_digest(converter_output)
+            cache.put_action(export_key(model, converter_output_digest, job["exporter"]), { "outputs": outputs })
+            record_build(cache, job, outputs)
+        except asyncio.TimeoutError:
+            print("Unable to export model {}: exporter timed out after {}s".format(model, args.timeout))
+            metrics_log.write(dict(job["metrics"], status="exporter timed out"))
+        except Exception as e:
+            print("Unable to export model {}: {}".format(model, e))
+            metrics_log.write(dict(job["metrics"], status="exporter failed"))
+        finally:
+            exports.task_done()
+
+
+async def convert_all(args, cache, metrics_log, jobs):
+    exports = asyncio.Queue(maxsize=args.jobs)
+    pool = ExportPool(args)
+    converter = Converter(args, metrics_log)
+    try:
+        exporters = [ asyncio.ensure_future(exporter_stage(args, cache, metrics_log, pool, exports)) for _ in range(args.jobs) ]
+        await asyncio.gather(*[ converter_stage(args, cache, metrics_log, converter, jobs, exports) for _ in range(args.jobs) ])
+        await converter.close()
+        await exports.join()
+        for exporter in exporters:
+            exporter.cancel()
+        await asyncio.gather(*exporters, return_exceptions=True)
+    finally:
+        await converter.kill()
+        pool.shutdown()
+
+
+def main():
+    cwd = os.getcwd()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input-spec', help=r'search spec for fbi files for units to convert, eg "d:\temp\ccdata\UNITS\*.fbi"')
+    parser.add_argument('--converter-cmd', help='path to 3do2scm.exe executable, eg "c:\\3do2scm.exe"', required=False, default=os.path.join(cwd,"3do2scm.exe"))
+    parser.add_argument('--tadata-paths', help='paths under which to search for 3do files, eg "d:\\temp\\totala1 d:\\temp\\ccdata"', nargs='+')
+    parser.add_argument('--gaf-catalog', help='file in which the converter caches its index of texture GAF archives', default=os.path.join(cwd,"gafcatalog.txt"))
+    parser.add_argument('--format', help='format in which the converter hands models over to the exporter.  default=bin', choices=['json','bin'], default='bin')
+    parser.add_argument('--jobs', help='number of models to convert concurrently.  default=number of cpus', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--timeout', help='seconds allowed for each stage of converting a model.  default=300', type=float, default=300.0)
+    parser.add_argument('--cache', help='directory of the build cache.  default=cache', default=os.path.join(cwd,"cache"))
+    parser.add_argument('--force', help='convert every model, even those that are up to date', action='store_true')
+    parser.add_argument('--metrics', help='file to append per model timings and counts to, as lines of json')
+    parser.add_argument('--profile', help='keep cProfile dumps of the N models slowest to export', type=int, default=0, metavar='N')
+    parser.add_argument('--profile-dir', help='directory for --profile dumps.  default=profiles', default=os.path.join(cwd,"profiles"))
+    parser.add_argument('--lods', help='triangle budget of each reduced level of detail to write after _lod0.scm: a number of triangles, or a fraction of lod0\'s.  eg 0.5 0.25', type=lod_budget, nargs='*', default=[])
+    parser.add_argument('--lod-atlases', help='also write atlases downscaled by half per level of detail', action='store_true')
+    parser.add_argument('--max-tasks-per-worker', help='models an exporter process converts before it is replaced (python 3.11+).  default=50', type=int, default=50)
+    args = parser.parse_args()
+    args.jobs = max(1, args.jobs)
+
+    units_dir = os.path.join(cwd,'UNITS')
+    if not os.path.exists(units_dir):
+        os.mkdir(units_dir)
+
+    # bring the GAF catalog up to date once, rather than have every concurrent converter rebuild it
+    catalog = scm.gafcatalog.GafCatalog(args.gaf_catalog)
+    catalog.update(args.tadata_paths)
+
+    cache = scm.buildcache.BuildCache(args.cache)
+    converter_digest, exporter_digest = tool_digests(args)
+    exporter_digest = scm.buildcache.inputs_digest({
+        "exporter": exporter_digest, "lods": args.lods, "lod_atlases": args.lod_atlases })
+
+    metrics_log = MetricsLog(args.metrics, args.profile, args.profile_dir)
+
+    jobs = []
+    entry_digests = { }
+    for fn in sorted(glob.glob(args.input_spec)):
+        unit,_ = os.path.splitext(os.path.basename(fn))
+        target_dir = os.path.join(units_dir,unit)
+        if not os.path.exists(target_dir):
+            os.mkdir(target_dir)
+
+        for suffix in ("", "_dead"):
+            model = unit+suffix
+            _3do_path = scm.parse3do.find_3do(model, args.tadata_paths)
+            if _3do_path is None:
+                # no such model (typically a unit without a _dead wreck). don't bother starting the converter
+                continue
+
+            try:
+                inputs = converter_inputs(args, catalog, cache, entry_digests, model, _3do_path, converter_digest)
+            except (OSError, ValueError, struct.error) as e:
+                print("Unable to convert model {}: {}".format(model, e))
+                metrics_log.write({ "unit": model, "tool": "convertallunits", "status": "inputs unreadable" })
+                continue
+
+            job = {
+                "model": model,
+                "output_dir": target_dir,
+                "inputs": inputs,
+                "convert_key": scm.buildcache.inputs_digest(inputs),
+                "exporter": exporter_digest,
+            }
+            status = None if args.force else try_skip(cache, job)
+            if status is None:
+                jobs.append(job)
+            else:
+                print("{}: {}".format(model, status))
+                metrics_log.write({ "unit": model, "tool": "convertallunits", "status": status })
+
+    print("---- converting {} models with {} jobs".format(len(jobs), args.jobs))
+    # converted in glob order
+    jobs.reverse()
+    try:
+        asyncio.run(convert_all(args, cache, metrics_log, jobs))
+    finally:
+        metrics_log.close()
+
+
+if __name__ == "__main__":
+    # the exporter pool's workers are started from the executable when packaged by pyinstaller
+    multiprocessing.freeze_support()
+    main()
@@ -1,268 +1,507 @@
-import copy
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import importlib.util
+import io
+import itertools
+import json
+import marshal
 import numpy
 import os
-import struct
+import re
+import scm.dumpscm
+import scm.scafile
+import scm.scmfile
 import sys
+import time
 
-class Piece:
+class Pieces:
+    """
+    State of all the pieces of a model, as (pieces, 3) arrays that are stepped in lockstep.  xyz are positions,
+    rpw rotations: roll(about +X), pitch(about +Y), yaw(about +Z).  The pose of each frame stepped is kept
+    in float32 history buffers, (frames, pieces, 3); the current pose is always the last frame
+    """
+
+    INITIAL_FRAMES = 256
 
-    def __init__(self, name, parent, xyz0, rpw0):
+    def __init__(self, names, parents, xyz0, rpw0):
         """
-        @param name, parent: strings
+        @param names, parents: lists of strings
+        @param xyz0, rpw0: (pieces, 3) rest pose
         """
 
-        self.xyz0 = copy.copy(list(xyz0))
-        self.rpw0 = copy.copy(list(rpw0))
+        self.names = list(names)
+        self.parents = list(parents)
+        self.index = { name: n for n,name in enumerate(self.names) }
 
-        self.xyz_offset = [0., 0., 0.]
-        self.rpw_offset = [0., 0., 0.]
+        self.xyz0 = numpy.array(xyz0, dtype=numpy.float64).reshape(-1,3)
+        self.rpw0 = numpy.array(rpw0, dtype=numpy.float64).reshape(-1,3)
 
-        self.name = name
-        self.parent = parent
+        self.xyz_offset = numpy.zeros_like(self.xyz0)
+        self.rpw_offset = numpy.zeros_like(self.rpw0)
 
-        self.cur_xyz = [ copy.copy(self.xyz0) ]
-        self.vel_xyz = [0., 0., 0.]
-        self.target_xyz = copy.copy(self.xyz0)
+        self.cur_xyz = self.xyz0.copy()
+        self.vel_xyz = numpy.zeros_like(self.xyz0)
+        self.target_xyz = self.xyz0.copy()
 
-        # rpw: roll(about +X), pitch(about +Y), yaw(about +Z)
-        self.cur_rpw = [ copy.copy(self.rpw0) ]
-        self.rate_rpw = [0., 0., 0.]
-        self.target_rpw = copy.copy(self.rpw0)
+        self.cur_rpw = self.rpw0.copy()
+        self.rate_rpw = numpy.zeros_like(self.rpw0)
+        self.target_rpw = self.rpw0.copy()
+
+        self.xyz_history = numpy.empty((self.INITIAL_FRAMES, len(self.names), 3), dtype=numpy.float32)
+        self.rpw_history = numpy.empty_like(self.xyz_history)
+        self.num_frames = 0
+        self._record()
+
+    def _record(self):
+        if self.num_frames == len(self.xyz_history):
+            # grow geometrically, so recording n frames costs O(n)
+            self.xyz_history = numpy.concatenate([self.xyz_history, numpy.empty_like(self.xyz_history)])
+            self.rpw_history = numpy.concatenate([self.rpw_history, numpy.empty_like(self.rpw_history)])
+        self.xyz_history[self.num_frames] = self.cur_xyz
+        self.rpw_history[self.num_frames] = self.cur_rpw
+        self.num_frames += 1
 
     def reset(self):
-        self.cur_xyz = [ self.cur_xyz[-1] ]
-        self.vel_xyz = [0., 0., 0.]
-        self.target_xyz = copy.copy(self.cur_xyz[-1])
+        # start a new history from the current pose, at rest
+        self.xyz_history[0] = self.cur_xyz
+        self.rpw_history[0] = self.cur_rpw
+        self.num_frames = 1
 
-        # rpw: roll(about +X), pitch(about +Y), yaw(about +Z)
-        self.cur_rpw = [ self.cur_rpw[-1] ]
-        self.rate_rpw = [0., 0., 0.]
-        self.target_rpw = copy.copy(self.cur_rpw[-1])
+        self.vel_xyz[:] = 0.
+        self.target_xyz[:] = self.cur_xyz
+        self.rate_rpw[:] = 0.
+        self.target_rpw[:] = self.cur_rpw
 
     def get_frames(self):
-        return self.cur_xyz, self.cur_rpw
+        """ (xyz, rpw) history, each (frames, pieces, 3) """
+        return self.xyz_history[0:self.num_frames], self.rpw_history[0:self.num_frames]
+
+    def set_move_offset(self, n, axis_idx, x0):
+        self.xyz_offset[n, axis_idx] = x0
+
+    def set_turn_offset(self, n, axis_idx, x0):
+        self.rpw_offset[n, axis_idx] = x0
+
+    def move_now(self, n, axis_idx, target):
+        target += self.xyz_offset[n, axis_idx]
+        self.cur_xyz[n, axis_idx] = self.xyz0[n, axis_idx] + target
+        self.vel_xyz[n, axis_idx] = 0.
+        self.target_xyz[n, axis_idx] = self.cur_xyz[n, axis_idx]
+        self.xyz_history[self.num_frames-1, n, axis_idx] = self.cur_xyz[n, axis_idx]
+
+    def turn_now(self, n, axis_idx, target):
+        target += self.rpw_offset[n, axis_idx]
+        self.cur_rpw[n, axis_idx] = self.rpw0[n, axis_idx] + target
+        self.rate_rpw[n, axis_idx] = 0.
+        self.target_rpw[n, axis_idx] = self.cur_rpw[n, axis_idx]
+        self.rpw_history[self.num_frames-1, n, axis_idx] = self.cur_rpw[n, axis_idx]
+
+    def move_at_speed(self, n, axis_idx, target, speed):
+        target += self.xyz_offset[n, axis_idx]
+        self.vel_xyz[n, axis_idx] = speed
+        self.target_xyz[n, axis_idx] = self.xyz0[n, axis_idx] + target
+
+    def turn_at_speed(self, n, axis_idx, target, speed):
+        target += self.rpw_offset[n, axis_idx]
+        self.rate_rpw[n, axis_idx] = speed
+        self.target_rpw[n, axis_idx] = self.rpw0[n, axis_idx] + target
+
+    @staticmethod
+    def update(x, speed, xtarget, dt):
+        """
+        Advance x towards xtarget at speed for dt seconds, stopping at xtarget rather than overshooting it.
+        Updates x and speed (arrays) in place
+        """
+
+        dxdt = numpy.where((xtarget-x)*speed >= 0., speed, -speed)
+        xupd = x + dxdt*dt
+        overshoot = ((x <= xtarget) & (xtarget <= xupd)) | ((xupd <= xtarget) & (xtarget <= x))
+        x[:] = numpy.where(overshoot, xtarget, xupd)
+        speed[overshoot] = 0.
+
+    def step(self, dt, count=1):
+        # dt in seconds
+        for _ in range(count):
+            self.update(self.cur_xyz, self.vel_xyz, self.target_xyz, dt)
+            self.update(self.cur_rpw, self.rate_rpw, self.target_rpw, dt)
+            self._record()
+
+    def sleep(self, seconds, fps):
+        # step whole frames of 1/fps; at least one, whatever seconds is
+        dt = 1. / fps
+        countdown = max(dt, seconds)
+        steps = 0
+        while countdown > dt-1e-3:
+            steps += 1
+            countdown -= dt
+        self.step(dt, steps)
+
+
+class Timeline:
+    """
+    Motion of all the pieces of a model over time, as piecewise linear segments.  There are 6 channels per
+    piece: channel 6*n+axis is the position of piece n on axis, channel 6*n+3+axis its rotation about axis.
 
-    def set_move_offset(self, axis_idx, x0):
-        self.xyz_offset[axis_idx] = x0
+    Each segment of a channel is (start, origin, velocity, arrival): from time start the channel moves from
+    origin at velocity until arrival, then holds until the next segment starts.  So any time can be evaluated
+    in closed form, at whatever frame rate
+    """
 
-    def set_turn_offset(self, axis_idx, x0):
-        self.rpw_offset[axis_idx] = x0
+    def __init__(self, xyz, rpw):
+        """
+        @param xyz, rpw: (pieces, 3) pose at time 0
+        """
 
-    def move_now(self, axis_idx, target):
-        target +=  self.xyz_offset[axis_idx]
-        self.cur_xyz[-1][axis_idx] = self.xyz0[axis_idx] + target
-        self.vel_xyz[axis_idx] = 0.
-        self.target_xyz[axis_idx] = self.cur_xyz[-1][axis_idx]
+        start = numpy.concatenate([xyz, rpw], axis=1).ravel()
+        self.segments = [ [(0., x, 0., 0.)] for x in start.tolist() ]
+        self.duration = 0.
 
-    def turn_now(self, axis_idx, target):
-        target +=  self.rpw_offset[axis_idx]
-        self.cur_rpw[-1][axis_idx] = self.rpw0[axis_idx] + target
-        self.rate_rpw[axis_idx] = 0.
-        self.target_rpw[axis_idx] = self.cur_rpw[-1][axis_idx]
+    def value(self, channel, t):
+        # only for t at or after the channel's last segment start
+        start, origin, velocity, arrival = self.segments[channel][-1]
+        return origin + velocity*(min(t,arrival) - start)
 
-    def move_at_speed(self, axis_idx, target, speed):
-        target +=  self.xyz_offset[axis_idx]
-        self.vel_xyz[axis_idx] = speed
-        self.target_xyz[axis_idx] = self.xyz0[axis_idx] + target
+    def add(self, channel, t, origin, velocity, arrival):
+        # a segment replaces any other starting at the same time
+        segments = self.segments[channel]
+        if segments[-1][0] == t:
+            segments.pop()
+        segments.append((t, origin, velocity, arrival))
 
-    def turn_at_speed(self, axis_idx, target, speed):
-        target +=  self.rpw_offset[axis_idx]
-        self.rate_rpw[axis_idx] = speed
-        self.target_rpw[axis_idx] = self.rpw0[axis_idx] + target
+    def evaluate(self, times):
+        """ (xyz, rpw) at each of times, each (len(times), pieces, 3) """
 
-    def step(self, dt):
-        # dt in seconds
+        times = numpy.asarray(times, dtype=numpy.float64)
+        values = numpy.empty((len(times), len(self.segments)), dtype=numpy.float64)
+        for channel, segments in enumerate(self.segments):
+            start, origin, velocity, arrival = numpy.array(segments, dtype=numpy.float64).T
+            k = numpy.searchsorted(start, times, side='right') - 1
+            k = numpy.maximum(k, 0)
+            values[:,channel] = origin[k] + velocity[k]*(numpy.minimum(times, arrival[k]) - start[k])
+        values = values.reshape(len(times), -1, 2, 3)
+        return values[:,:,0,:], values[:,:,1,:]
 
-        def update(x, speed, xtarget, dt):
-            # return new_x, new_speed
-            if (xtarget-x)*speed >= 0.:
-                dxdt = speed
-            else:
-                dxdt = -speed
+    def frames(self, fps):
+        """ (xyz, rpw) sampled at fps from 0 to duration, each (frames, pieces, 3) float32 """
 
-            xupd = x + dxdt * dt
-            if (x <= xtarget <= xupd) or (xupd <= xtarget <= x):
-                # overshoot
-                return xtarget, 0.
-            else:
-                return xupd, speed
+        num_frames = int(round(self.duration*fps)) + 1
+        xyz, rpw = self.evaluate(numpy.arange(num_frames) / fps)
+        return xyz.astype(numpy.float32), rpw.astype(numpy.float32)
 
-        self.cur_xyz += [copy.copy(self.cur_xyz[-1])]
-        self.cur_rpw += [copy.copy(self.cur_rpw[-1])]
-        for n in range(3):
-            self.cur_xyz[-1][n],self.vel_xyz[n] = update(self.cur_xyz[-1][n],self.vel_xyz[n],self.target_xyz[n],dt)
-            self.cur_rpw[-1][n],self.rate_rpw[n] = update(self.cur_rpw[-1][n],self.rate_rpw[n],self.target_rpw[n],dt)
+    def end_pose(self):
+        xyz, rpw = self.evaluate([self.duration])
+        return xyz[0], rpw[0]
+
+
+class TimelineCompiler:
+    """
+    Takes the place of Pieces in run_nbos, recording each command as a timeline segment with its exact
+    arrival time instead of stepping the motion frame by frame
+    """
+
+    def __init__(self, pieces, xyz=None, rpw=None):
+        """
+        @param pieces: Pieces, for the rest pose and the offsets
+        @param xyz, rpw: (pieces, 3) pose at time 0.  default is the rest pose
+        """
+
+        self.pieces = pieces
+        self.timeline = Timeline(
+            pieces.xyz0 if xyz is None else xyz,
+            pieces.rpw0 if rpw is None else rpw)
+        self.t = 0.
+
+    def set_move_offset(self, n, axis_idx, x0):
+        self.pieces.set_move_offset(n, axis_idx, x0)
+
+    def set_turn_offset(self, n, axis_idx, x0):
+        self.pieces.set_turn_offset(n, axis_idx, x0)
+
+    def _now(self, channel, x):
+        self.timeline.add(channel, self.t, x, 0., self.t)
+
+    def _at_speed(self, channel, xtarget, speed):
+        # towards xtarget whatever the sign of speed, as Pieces.update
+        x = self.timeline.value(channel, self.t)
+        speed = abs(speed)
+        if speed == 0. or xtarget == x:
+            self.timeline.add(channel, self.t, x, 0., self.t)
+        else:
+            self.timeline.add(channel, self.t, x, speed if xtarget > x else -speed, self.t + abs(xtarget-x)/speed)
+
+    def move_now(self, n, axis_idx, target):
+        self._now(6*n+axis_idx, self.pieces.xyz0[n, axis_idx] + target + self.pieces.xyz_offset[n, axis_idx])
+
+    def turn_now(self, n, axis_idx, target):
+        self._now(6*n+3+axis_idx, self.pieces.rpw0[n, axis_idx] + target + self.pieces.rpw_offset[n, axis_idx])
+
+    def move_at_speed(self, n, axis_idx, target, speed):
+        self._at_speed(6*n+axis_idx, self.pieces.xyz0[n, axis_idx] + target + self.pieces.xyz_offset[n, axis_idx], speed)
+
+    def turn_at_speed(self, n, axis_idx, target, speed):
+        self._at_speed(6*n+3+axis_idx, self.pieces.rpw0[n, axis_idx] + target + self.pieces.rpw_offset[n, axis_idx], speed)
+
+    def sleep(self, seconds, fps):
+        # exact: the frame rate only matters when the timeline is sampled
+        self.t += seconds
+        self.timeline.duration = self.t
+
+
+# whitespace matches nothing, so finditer skips it
+NBOS_TOKEN = re.compile(r"(?P<expression>'[^']*')|(?P<separator>[;,])|(?P<word>[^\s;,']+)|(?P<error>')")
+
+# instructions are tuples (opcode, operands...).  piece operands are names until link_nbos makes them indices
+OP_SCALES, OP_ROTATION_SCALES, OP_SET_TURN_OFFSET, OP_SET_MOVE_OFFSET, OP_MOVE_NOW, OP_MOVE_AT_SPEED, \
+    OP_TURN_NOW, OP_TURN_AT_SPEED, OP_SLEEP = range(9)
+PIECE_OPS = { OP_SET_TURN_OFFSET, OP_SET_MOVE_OFFSET, OP_MOVE_NOW, OP_MOVE_AT_SPEED, OP_TURN_NOW, OP_TURN_AT_SPEED }
+
+AXES = { 'x-axis':0, 'y-axis':1, 'z-axis':2 }
+
+# bump when the instruction format changes, so cached scripts are compiled again
+NBOS_CACHE_VERSION = 1
+
+
+def tokenize_nbos(script):
+    """
+    Split script into statements at ';'.  Within a statement, words are separated by spaces or ','; an
+    expression in single quotes is one word, spaces and all
+    @return: list of (words, text of the statement after its first word)
+    """
+
+    statements = []
+    words, rest = [], 0
+    for match in NBOS_TOKEN.finditer(script + ';'):
+        kind, token = match.lastgroup, match.group()
+        if kind == 'word' or kind == 'expression':
+            if not words:
+                rest = match.end()
+            words.append(token)
+        elif token == ';':
+            if words:
+                statements.append((words, script[rest:match.start()].strip()))
+            words = []
+        elif kind == 'error':
+            raise ValueError("unterminated expression at character {} of the nBOS script".format(match.start()))
+    return statements
 
 
 def parse_nbos(script):
+    """
+    @return: (statements, vars): statements as lists of words, and the text after the first word of each
+    statement, keyed by that word
+    """
+
     statements = []
     vars = { }
-    for _statement in script.split(';'):
-        _statement = _statement.strip()
-        statement = _statement.replace(',', ' ')
-        statement = statement.replace('\n', ' ')
-        words = [w for w in statement.split(' ') if len(w)>0]
-        if len(words) == 0:
-            continue
-        statements += [words]
-        vars[words[0]] = _statement[len(words[0]):].strip()
-
+    for words, rest in tokenize_nbos(script):
+        statements.append(words)
+        vars[words[0]] = rest
     return statements, vars
 
 
-def run_nbos(statements, pieces, vars, fps):
+def assemble_nbos(statements):
     """
-    @param script: string containing the (not)bos script
-    @param pieces: dictionary of Piece objects
+    Translate statements to instructions.  Numbers become floats and quoted expressions code objects, which
+    are evaluated with the script time t, cos and sin
     """
 
-    SCALE_FACTORS = [2.5, 2.5, -2.5]
-    def apply_scale_factor(coord, axis):
-        return coord/SCALE_FACTORS[axis]
-        
-    ROTATION_SCALE_FACTORS = [1.0, -1.0, 1.0]
-    def apply_rotation_factor(coord, axis):
-        return coord*numpy.sign(ROTATION_SCALE_FACTORS[axis])
+    # each distinct expression is compiled once, and stored once in the cache
+    expressions = { }
+    def operand(word):
+        if word[0]=="'" and word[-1]=="'":
+            if word not in expressions:
+                expressions[word] = compile(word[1:-1], '<nbos>', 'eval')
+            return expressions[word]
+        try:
+            return float(word)
+        except ValueError:
+            return float(word[1:-1])
 
-    def str_to_axis_idx(axis_str):
-        return { 'x-axis':0, 'y-axis':1, 'z-axis':2 }[axis_str]
+    def axis(word):
+        try:
+            return AXES[word]
+        except KeyError:
+            raise ValueError("unknown axis '{}'".format(word))
 
-    t = 0.
-    def to_float(number_str):
+    instructions = []
+    for words in statements:
+        command = words[0].lower()
         try:
-            return float(number_str)
-        except ValueError:
-            if number_str[0]=="'" and number_str[-1]=="'":
-                return eval(number_str[1:-1], {'t':t, 'cos':numpy.cos, 'sin':numpy.sin})
+            if command == 'scales':
+                instructions.append((OP_SCALES, tuple(operand(w) for w in words[1:4])))
+
+            elif command == 'rotation-scales':
+                instructions.append((OP_ROTATION_SCALES, tuple(operand(w) for w in words[1:4])))
+
+            elif command in ('scm-file-path', 'not-looped'):
+                pass
+
+            elif command == 'set-turn-offset':
+                instructions.append((OP_SET_TURN_OFFSET, words[1], axis(words[3]), operand(words[4])))
+
+            elif command == 'set-move-offset':
+                instructions.append((OP_SET_MOVE_OFFSET, words[1], axis(words[3]), operand(words[4])))
+
+            elif command in ('move', 'turn'):
+                speed = words[5].lower()
+                if speed == 'now':
+                    op = OP_MOVE_NOW if command == 'move' else OP_TURN_NOW
+                    instructions.append((op, words[1], axis(words[3]), operand(words[4])))
+                elif speed == 'speed':
+                    op = OP_MOVE_AT_SPEED if command == 'move' else OP_TURN_AT_SPEED
+                    instructions.append((op, words[1], axis(words[3]), operand(words[4]), operand(words[6])))
+
+            elif command == 'sleep':
+                instructions.append((OP_SLEEP, operand(words[1])))
+
             else:
-                return float(number_str[1:-1])
+                raise ValueError("unknown nBOS command: '{}'".format(words[0]))
 
-    for words in statements:
-        words[0] = words[0].lower()
+        except IndexError:
+            raise ValueError("incomplete nBOS statement: '{}'".format(' '.join(words)))
+
+    return instructions
 
-        if words[0] == 'scales':
-            SCALE_FACTORS = [ to_float(w) for w in (words[1],words[2],words[3]) ]
 
-        elif words[0] == 'rotation-scales':
-            ROTATION_SCALE_FACTORS = [ to_float(w) for w in (words[1],words[2],words[3]) ]
+# scripts kept assembled in memory, for --watch
+NBOS_MEMORY_CACHE_SIZE = 256
 
-        elif words[0] == 'scm-file-path':
+
+@functools.lru_cache(maxsize=NBOS_MEMORY_CACHE_SIZE)
+def load_nbos(script, cache_dir=None):
+    """
+    Parse and assemble script, or load the result from cache_dir if this script was assembled before.  Entries
+    are keyed by a hash of the script and of the Python version, as code objects only suit the one that made them.
+    The result is also kept in memory, so is shared: it must not be modified
+    @return: (instructions, vars)
+    """
+
+    key = hashlib.sha256(script.encode('utf-8') + importlib.util.MAGIC_NUMBER + bytes([NBOS_CACHE_VERSION])).hexdigest()
+    cache_file = os.path.join(cache_dir, key + '.nbosc') if cache_dir else None
+    if cache_file:
+        try:
+            with open(cache_file, 'rb') as file:
+                instructions, vars = marshal.load(file)
+            return instructions, vars
+        except (OSError, EOFError, ValueError, TypeError):
             pass
-            
-        elif words[0] == 'not-looped':
+
+    statements, vars = parse_nbos(script)
+    instructions = assemble_nbos(statements)
+
+    if cache_file:
+        # write then rename, so that a concurrent reader never sees half a file
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            temp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+            with open(temp_file, 'wb') as file:
+                marshal.dump((instructions, vars), file)
+            os.replace(temp_file, cache_file)
+        except OSError:
             pass
 
-        elif words[0] == 'set-turn-offset':
-            name, axis, position = words[1], str_to_axis_idx(words[3]), to_float(words[4])
-            pieces[name].set_turn_offset(axis, position)
-            
-        elif words[0] == 'set-move-offset':
-            name, axis, position = words[1], str_to_axis_idx(words[3]), to_float(words[4])
-            pieces[name].set_move_offset(axis, position)
-
-        elif words[0] == 'move':
-            name, axis, position, speed = words[1], str_to_axis_idx(words[3]), to_float(words[4]), words[5].lower()
-            if speed=='now':
-                if t>0. or 'not-looped' in vars:
-                    pieces[name].move_now(axis, apply_scale_factor(position, axis))
-            elif speed=='speed':
-                speed = to_float(words[6])
-                pieces[name].move_at_speed(
-                    axis,
-                    apply_scale_factor(position,axis),
-                    apply_scale_factor(speed,axis))
-
-        elif words[0] == 'turn':
-            name, axis, position, speed = words[1], str_to_axis_idx(words[3]), to_float(words[4]), words[5].lower()
-            if speed=='now':
-                if t>0. or 'not-looped' in vars:
-                    pieces[name].turn_now(axis, apply_rotation_factor(position, axis))
-            elif speed=='speed':
-                pieces[name].turn_at_speed(
-                    axis,
-                    apply_rotation_factor(position, axis),
-                    apply_rotation_factor(to_float(words[6]), axis))
-
-        elif words[0] == 'sleep':
-            dt = 1. / fps
-            for name,piece in pieces.items():
-                countdown = to_float(words[1]) / 1000.
-                countdown = max(dt, countdown)
-                while countdown > dt-1e-3:
-                    piece.step(dt)
-                    countdown -= dt
-            t += to_float(words[1]) / 1000.
+    return instructions, vars
 
-        else:
-            raise ValueError("unknown nBOS command: '{}'".format(words[0]))
 
-    return pieces
+def link_nbos(instructions, pieces):
+    """ the instructions with piece names replaced by their indices in pieces (Pieces) """
 
+    linked = []
+    for instruction in instructions:
+        if instruction[0] in PIECE_OPS:
+            try:
+                instruction = (instruction[0], pieces.index[instruction[1]]) + tuple(instruction[2:])
+            except KeyError:
+                raise ValueError("unknown piece '{}'".format(instruction[1]))
+        linked.append(instruction)
+    return linked
 
-def make_sca_header(
-    num_frames, duration, num_bones,
-    bone_names_section_length, bone_links_section_length,
-    frame_size):
 
-    format = '4sllflllll'
-    version = 5
-    bone_names_offset = struct.calcsize(format)
-    bone_links_offset = bone_names_offset + bone_names_section_length
-    first_frame_offset = bone_links_offset + bone_links_section_length
+def run_nbos(program, pieces, vars, fps=None):
+    """
+    @param program: instructions from link_nbos
+    @param pieces: Pieces, stepped at fps; or a TimelineCompiler, for which fps is not needed
+    """
+
+    scale_factors = [2.5, 2.5, -2.5]
+    rotation_signs = [1., -1., 1.]
+    now_at_start = 'not-looped' in vars
+
+    env = { 't': 0., 'cos': numpy.cos, 'sin': numpy.sin }
+    def value(operand):
+        return operand if operand.__class__ is float else eval(operand, env)
+
+    def scales(factors):
+        scale_factors[:] = [ value(f) for f in factors ]
 
-    return struct.pack(
-        format,
-        b'ANIM', version,
-        num_frames, duration, num_bones, 
-        bone_names_offset, bone_links_offset, first_frame_offset,
-        frame_size) 
+    def rotation_scales(factors):
+        rotation_signs[:] = [ numpy.sign(value(f)) for f in factors ]
 
-def make_sca_bone_names_section(bone_names):
-    return bytes('\0'.join(bone_names) + '\0', 'utf-8')
+    def set_turn_offset(n, axis, position):
+        pieces.set_turn_offset(n, axis, value(position))
 
-def make_sca_bone_links_section(bone_links):
-    format = '{}l'.format(len(bone_links))
-    return struct.pack(format, *bone_links)
+    def set_move_offset(n, axis, position):
+        pieces.set_move_offset(n, axis, value(position))
 
-def make_sca_bone_key_frame(pos_xyz, orientation_wxyz):
-    format = '7f'
-    return struct.pack(format, *pos_xyz, *orientation_wxyz)
+    def move_now(n, axis, position):
+        if env['t']>0. or now_at_start:
+            pieces.move_now(n, axis, value(position)/scale_factors[axis])
 
-def make_sca_key_frame(time, pos_xyz_per_bone, orientation_wxyz_per_bone):
-    data = struct.pack('fl', time, 0)
-    for pos_xyz, orientation_wxyz in zip(pos_xyz_per_bone, orientation_wxyz_per_bone):
-        data += make_sca_bone_key_frame(pos_xyz, orientation_wxyz)
-    return data
+    def move_at_speed(n, axis, position, speed):
+        pieces.move_at_speed(n, axis, value(position)/scale_factors[axis], value(speed)/scale_factors[axis])
 
-def make_sca_anim_data(
-    fps,
-    root_delta_xyz, root_delta_wxyz,
-    pos_xyz_per_bone_per_frame, orientation_wxyz_per_bone_per_frame):
+    def turn_now(n, axis, position):
+        if env['t']>0. or now_at_start:
+            pieces.turn_now(n, axis, value(position)*rotation_signs[axis])
 
-    data_head = struct.pack('7f', *root_delta_xyz, *root_delta_wxyz)
-    data = b''
-    for frame_number, (pos_xyz_per_bone, orientation_wxyz_per_bone) in enumerate(zip(
-        pos_xyz_per_bone_per_frame,
-        orientation_wxyz_per_bone_per_frame)):
+    def turn_at_speed(n, axis, position, speed):
+        pieces.turn_at_speed(n, axis, value(position)*rotation_signs[axis], value(speed)*rotation_signs[axis])
 
-        t = float(frame_number) / fps
-        data += make_sca_key_frame(t, pos_xyz_per_bone, orientation_wxyz_per_bone)
+    def sleep(milliseconds):
+        seconds = value(milliseconds) / 1000.
+        pieces.sleep(seconds, fps)
+        env['t'] += seconds
 
-    return data_head, data
+    handlers = [ scales, rotation_scales, set_turn_offset, set_move_offset, move_now, move_at_speed, turn_now, turn_at_speed, sleep ]
+    for instruction in program:
+        handlers[instruction[0]](*instruction[1:])
+
+    return pieces
+
+
+def compile_nbos(program, pieces, vars):
+    """
+    Compile the script into a Timeline.  If it loops, the timeline is of the second time through, which starts
+    from the pose the first ends in
+    @param program: instructions from link_nbos
+    @param pieces: Pieces, at rest
+    """
+
+    compiler = run_nbos(program, TimelineCompiler(pieces), vars)
+    if not 'not-looped' in vars:
+        compiler = run_nbos(program, TimelineCompiler(pieces, *compiler.timeline.end_pose()), vars)
+    return compiler.timeline
+
+
+# frames are encoded and written this many bytes at a time, so long animations don't need the whole file in memory
+SCA_CHUNK_BYTES = 1 << 20
 
 
 def quaternion_multiply(q1, q2):
-    w1, x1, y1, z1 = q1
-    w2, x2, y2, z2 = q2
-    return numpy.array([
+    # quaternions (w,x,y,z) in the last axis
+    w1, x1, y1, z1 = numpy.moveaxis(numpy.asarray(q1), -1, 0)
+    w2, x2, y2, z2 = numpy.moveaxis(numpy.asarray(q2), -1, 0)
+    return numpy.stack([
         w1*w2 - x1*x2 -y1*y2 - z1*z2,
         w1*x2 + x1*w2 + y1*z2 - z1*y2,
         w1*y2 - x1*z2 + y1*w2 + z1*x2,
-        w1*z2 + x1*y2 - y1*x2 + z1*w2])
+        w1*z2 + x1*y2 - y1*x2 + z1*w2], axis=-1)
 
 
 def quaternion_conjugate(q):
-    return numpy.array([q[0], -q[1], -q[2], -q[3]])
+    return numpy.asarray(q) * [1., -1., -1., -1.]
 
 
 def unit_quaternion_divide(q1,q2):
@@ -270,88 +509,158 @@ def unit_quaternion_divide(q1,q2):
 
 
 def rpw_to_quaternion(rpw):
+    """
+    @param rpw: (..., 3) roll, pitch, yaw in degrees
+    @return: (..., 4) quaternions (w,x,y,z), yaw * pitch * roll
+    """
+
     half_angles = numpy.radians(rpw)/2.
     cosines = numpy.cos(half_angles)
     sines = numpy.sin(half_angles)
+    zeros = numpy.zeros_like(cosines[...,0])
 
-    yaw = numpy.array([cosines[2], 0., 0., sines[2]])
-    pitch = numpy.array([cosines[1], 0., sines[1], 0.])
-    roll = numpy.array([cosines[0], sines[0], 0., 0.])
+    yaw = numpy.stack([cosines[...,2], zeros, zeros, sines[...,2]], axis=-1)
+    pitch = numpy.stack([cosines[...,1], zeros, sines[...,1], zeros], axis=-1)
+    roll = numpy.stack([cosines[...,0], sines[...,0], zeros, zeros], axis=-1)
     q = quaternion_multiply(yaw,pitch)
     q = quaternion_multiply(q,roll)
     return q
 
 
-def to_sca(pieces, fps):
+def to_sca(file, pieces, xyz_per_frame, rpw_per_frame, fps, frames=None):
     """
-    @param pieces dictionary of tuples: (Piece() object, xyz history, rpw history)
+    Write the animation to a binary file object, as SScaFileHeader etc of scm/ScaFile_format.h
+    @param pieces: Pieces, for the names and parents of the bones
+    @param xyz_per_frame, rpw_per_frame: (frames, pieces, 3) poses, from Pieces.get_frames or Timeline.frames
+    @param frames: indices of the frames to write, ascending, eg from scm.scafile.reduce_keyframes.  default all
+    @return: bytes written
     """
 
+    if frames is None:
+        frames = numpy.arange(len(xyz_per_frame))
+    num_frames, num_bones = len(frames), len(pieces.names)
+
     # ------- bone names section
-    bone_names = [ name for name,_ in pieces.items() ]
-    bone_names_section = make_sca_bone_names_section(bone_names)
+    bone_names_section = bytes('\0'.join(pieces.names) + '\0', 'utf-8')
 
     # ------- bone links section
-    bone_links = [
-        bone_names.index(pieces[name].parent) if pieces[name].parent in bone_names and pieces[name].parent != name else -1
-        for name in bone_names ]
-    bone_links_section = make_sca_bone_links_section(bone_links)
-
-    # ------- animation data section
-    # num_frames
-    for name,piece in pieces.items():
-        num_frames = len(piece.cur_xyz)
-        break
-
-    # collate and coordinate transform pose data
-    pos_xyz_per_bone_per_frame = numpy.zeros((num_frames,len(bone_names),3),dtype=numpy.float)
-    orientation_wxyz_per_bone_per_frame = numpy.zeros((num_frames,len(bone_names),4),dtype=numpy.float)
-    orientation_wxyz_per_bone_per_frame[:,:,0] = 1.
-    for name,piece in pieces.items():
-        xyz_per_frame, rpw_per_frame = piece.get_frames()
-        for frame_num,xyz in enumerate(xyz_per_frame):
-            bone_num = bone_names.index(name)
-            pos_xyz_per_bone_per_frame[frame_num,bone_num,:] = xyz
-        for frame_num,rpw in enumerate(rpw_per_frame):
-            bone_num = bone_names.index(name)
-            q = rpw_to_quaternion(rpw)
-            orientation_wxyz_per_bone_per_frame[frame_num,bone_num,:] = q
-
-    # root bone delta
-    root_pos_delta = [0., 0., 0.]
-    root_orientation_delta = [1., 0., 0., 0.]
-
-    # finally animation data
-    anim_data_head, anim_data = make_sca_anim_data(
-        fps, root_pos_delta, root_orientation_delta,
-        pos_xyz_per_bone_per_frame, orientation_wxyz_per_bone_per_frame)
+    bone_links = numpy.array([
+        pieces.index[parent] if parent in pieces.index and parent != name else -1
+        for name,parent in zip(pieces.names, pieces.parents) ], dtype='<i4')
+
+    # ------- animation data section.  root bone delta
+    anim_data_head = numpy.zeros(1, dtype=scm.scafile.SCA_ANIM_HEAD_DTYPE)
+    anim_data_head['mPositionDelta'] = [0., 0., 0.]
+    anim_data_head['mOrientDelta'] = [1., 0., 0., 0.]
 
     # -------- header section
-    frame_size = int(len(anim_data)/num_frames)
-    assert(len(anim_data) == frame_size * num_frames)
-    header = make_sca_header(
-        num_frames, float(num_frames-1)/fps, len(bone_names),
-        len(bone_names_section), len(bone_links_section),
-        frame_size)
-    
-    return header + bone_names_section + bone_links_section + anim_data_head + anim_data
+    frame_dtype = scm.scafile.sca_frame_dtype(num_bones)
+    header = numpy.zeros(1, dtype=scm.scafile.SCA_HEADER_DTYPE)
+    header['mMagic'] = scm.scafile.SCA_MAGIC
+    header['mVersion'] = scm.scafile.SCA_VERSION
+    header['mNumFrames'] = num_frames
+    header['mDuration'] = float(frames[-1] - frames[0])/fps
+    header['mNumBones'] = num_bones
+    header['mBoneNamesOffset'] = header.itemsize
+    header['mBoneLinksOffset'] = header.itemsize + len(bone_names_section)
+    header['mFirstFrameOffset'] = header.itemsize + len(bone_names_section) + bone_links.nbytes
+    header['mFrameSize'] = frame_dtype.itemsize
+
+    file.write(header.tobytes())
+    file.write(bone_names_section)
+    file.write(bone_links.tobytes())
+    file.write(anim_data_head.tobytes())
+
+    # finally the frames, a chunk at a time through one buffer
+    chunk_frames = max(1, SCA_CHUNK_BYTES // frame_dtype.itemsize)
+    buffer = numpy.zeros(min(chunk_frames, num_frames), dtype=frame_dtype)
+    for first in range(0, num_frames, chunk_frames):
+        indices = frames[first:first+chunk_frames]
+        chunk = buffer[0:len(indices)]
+        chunk['mTime'] = (indices - frames[0]) / fps
+        chunk['mBones'][:,:,0:3] = xyz_per_frame[indices]
+        chunk['mBones'][:,:,3:7] = rpw_to_quaternion(numpy.asarray(rpw_per_frame[indices], dtype=numpy.float64))
+        file.write(chunk.tobytes())
+
+    return int(header['mFirstFrameOffset'][0]) + anim_data_head.nbytes + num_frames*frame_dtype.itemsize
+
+
+# skeletons kept by each process.  a batch usually has many scripts per model
+SKELETON_CACHE_SIZE = 32
+
+
+@functools.lru_cache(maxsize=SKELETON_CACHE_SIZE)
+def load_skeleton(scm_filename, mtime):
+    """
+    (names, parents, xyz0, rpw0) of the model in scm_filename.  mtime is only part of the cache key, so that
+    a model that has changed is read again
+    """
+
+    with open(scm_filename, 'rb') as file:
+        names, bones = scm.scmfile.read_skeleton(file)
+    parents = [ names[parent] if parent >= 0 else "" for parent in bones['mParentBoneIndex'].tolist() ]
+    rpw0 = [ scm.dumpscm.quaternion_to_euler(*wxyz) for wxyz in bones['mRotation'].tolist() ]
+    return names, parents, bones['mPosition'].copy(), rpw0
 
 
 def construct_pieces(scm_filename):
-    with open(scm_filename, 'rb') as file:
-        bones = scm.dumpscm.load_bones(file)
-        pieces = {
-            name: Piece(name, parent, xyz0, rpw0)
-            for name,(parent,xyz0,wxyz0,rpw0) in bones.items()
-        }
-    return pieces
+    scm_filename = os.path.abspath(scm_filename)
+    return Pieces(*load_skeleton(scm_filename, os.stat(scm_filename).st_mtime_ns))
 
 
-def process_nbos(nbosfile, args):
-    print("NBOS script:{}".format(nbosfile))
+def conversion_options(args, scmfile):
+    """ the options that a script's .sca files depend on, as recorded in its options stamp """
+
+    options = { "scm": os.path.abspath(scmfile), "fps": args.fps, "step": args.step, "reduce": args.reduce }
+    if args.reduce:
+        options["position_tolerance"] = args.position_tolerance
+        options["angle_tolerance"] = args.angle_tolerance
+    return options
+
+
+def nbos_cache_dir(nbosfile, args):
+    """ directory of nbosfile's compiled script and options stamp: --cache-dir, or __nboscache__ beside it """
+    # as Python does with __pycache__
+    return args.cache_dir or os.path.join(os.path.dirname(nbosfile), '__nboscache__')
+
+
+def options_stamp(scafile, cache_dir):
+    """ file in cache_dir recording the conversion_options that scafile's .sca files were written with """
+    key = hashlib.sha256(os.fsencode(os.path.abspath(scafile))).hexdigest()
+    return os.path.join(cache_dir, key + '.options.json')
+
+
+def keeps_options_stamps(args):
+    """ True if the options stamps are kept: they are only read to skip up to date scripts, by --jobs and --watch """
+    return not args.no_cache and (args.jobs is not None or args.watch is not None)
+
+
+def read_options_stamp(stamp):
+    """ the conversion_options recorded in stamp, or None if it can't be read """
+    try:
+        with open(stamp, 'rt', encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def is_up_to_date(outputs, inputs):
+    """ True if every one of outputs exists, and is newer than every one of inputs """
+
+    try:
+        oldest_output = min(os.stat(output).st_mtime_ns for output in outputs)
+    except FileNotFoundError:
+        return False
+    return all(os.stat(input).st_mtime_ns < oldest_output for input in inputs)
+
+
+def read_nbos(nbosfile, args):
+    """ @return: (instructions, vars, path of the SCM) """
+
     with open(nbosfile, 'rt') as file:
         script = file.read()
-    statements, vars = parse_nbos(script)
+
+    instructions, vars = load_nbos(script, None if args.no_cache else nbos_cache_dir(nbosfile, args))
 
     try:
         # command line scm overrides scm-file-path directive in nbos file
@@ -366,54 +675,239 @@ def process_nbos(nbosfile, args):
         # prepend a path if required and available
         scmfile = os.path.join(nbosdir,scmfile)
 
+    return instructions, vars, scmfile
+
+
+def process_nbos(nbosfile, args, skip_up_to_date=False):
+    """
+    Convert nbosfile to .sca.  With skip_up_to_date (and not args.force), a script is not converted if its .sca
+    files are newer than it and its SCM and were written with the same conversion_options, as recorded in its
+    options stamp by an earlier --jobs or --watch run
+    @return: False if the .sca files were up to date
+    """
+
+    print("NBOS script:{}".format(nbosfile))
+    instructions, vars, scmfile = read_nbos(nbosfile, args)
     print("  SCM input:{}".format(scmfile))
+    scafile = args.scafile or os.path.splitext(nbosfile)[0]+'.sca'
+    outputs = [ scafile ]
+    if len(args.fps) > 1:
+        outputs = [ "{}_{:g}fps.sca".format(os.path.splitext(scafile)[0], fps) for fps in args.fps ]
+
+    stamp = options_stamp(scafile, nbos_cache_dir(nbosfile, args))
+    options = conversion_options(args, scmfile)
+    if (skip_up_to_date and not args.force and keeps_options_stamps(args) and read_options_stamp(stamp) == options
+            and is_up_to_date(outputs, [ nbosfile, scmfile ])):
+        print("  up to date")
+        return False
+
     pieces = construct_pieces(scmfile)
-    run_nbos(statements, pieces, vars, args.fps)
-    
-    if not 'not-looped' in vars:
-        # run again using final position as new starting position
-        for _,piece in pieces.items():
-            piece.reset()
-        run_nbos(statements, pieces, vars, args.fps)
+    program = link_nbos(instructions, pieces)
+
+    if args.step:
+        frames_per_fps = []
+        for fps in args.fps:
+            stepped = Pieces(pieces.names, pieces.parents, pieces.xyz0, pieces.rpw0)
+            run_nbos(program, stepped, vars, fps)
+            if not 'not-looped' in vars:
+                # run again using final position as new starting position
+                stepped.reset()
+                run_nbos(program, stepped, vars, fps)
+            frames_per_fps.append(stepped.get_frames())
+    else:
+        # compile once, sample at each frame rate
+        timeline = compile_nbos(program, pieces, vars)
+        frames_per_fps = [ timeline.frames(fps) for fps in args.fps ]
 
-    scafile = args.scafile or os.path.splitext(nbosfile)[0]+'.sca'
-    print("  SCA output:{}".format(scafile))
-    with open(scafile, 'wb') as file:
-        file.write(to_sca(pieces, args.fps))
+    # the stamp is rewritten once every output is, so a conversion that fails part way is never taken as up to date.
+    # a run that doesn't keep stamps still removes it, as it no longer describes the outputs
+    try:
+        os.remove(stamp)
+    except OSError:
+        pass
+
+    for fps, output, (xyz_per_frame, rpw_per_frame) in zip(args.fps, outputs, frames_per_fps):
+        print("  SCA output:{}".format(output))
+
+        frames = None
+        if args.reduce:
+            num_frames = len(xyz_per_frame)
+            keys = numpy.concatenate([xyz_per_frame, rpw_to_quaternion(numpy.asarray(rpw_per_frame, dtype=numpy.float64))], axis=-1)
+            frames = scm.scafile.reduce_keyframes(numpy.arange(num_frames) / fps, keys, args.position_tolerance, args.angle_tolerance)
 
+        with open(output, 'wb') as file:
+            size = to_sca(file, pieces, xyz_per_frame, rpw_per_frame, fps, frames)
 
-def recursive_process_filespec(filespec, args):
+        if args.reduce:
+            full_size = size + (num_frames - len(frames)) * scm.scafile.sca_frame_dtype(len(pieces.names)).itemsize
+            print("  keyframes: {} -> {}, {} -> {} bytes ({:.0%} smaller)".format(
+                num_frames, len(frames), full_size, size, 1. - size/full_size))
+
+    if keeps_options_stamps(args):
+        try:
+            os.makedirs(os.path.dirname(stamp), exist_ok=True)
+            with open(stamp, 'wt', encoding='utf-8') as file:
+                json.dump(options, file)
+        except OSError:
+            # the script is converted again next time
+            pass
+    return True
+
+
+def recursive_find_nbos(filespec):
+    """ filespec if it is an .nbos file, or the .nbos files in it if it is a directory """
 
     if os.path.isfile(filespec) and os.path.splitext(filespec)[-1].lower()==".nbos":
-        process_nbos(filespec, args)
-        
+        yield filespec
+
     elif os.path.isdir(filespec):
         for subdir, dirs, files in os.walk(filespec):
-            for file in files:
-                recursive_process_filespec(os.path.join(subdir,file), args)
+            dirs.sort()
+            for file in sorted(files):
+                if os.path.splitext(file)[-1].lower()==".nbos":
+                    yield os.path.join(subdir,file)
+
+
+def batch_process_nbos(nbosfile, args):
+    """
+    process_nbos for a batch: its messages are returned rather than printed, so that scripts converted
+    concurrently don't interleave theirs, and errors are reported rather than raised
+    @return: (messages, "converted", "up to date" or "failed")
+    """
+
+    messages = io.StringIO()
+    with contextlib.redirect_stdout(messages):
+        try:
+            status = "converted" if process_nbos(nbosfile, args, skip_up_to_date=True) else "up to date"
+        except Exception as e:
+            print("  error: {}: {}".format(type(e).__name__, e))
+            status = "failed"
+    return messages.getvalue(), status
+
+
+def process_batch(nbosfiles, args):
+    """
+    Convert nbosfiles in a pool of args.jobs processes, printing the messages of each as it completes.
+    Scripts found together in a directory usually share a model, so they are handed out in runs to make use
+    of each process's skeleton cache
+    @return: number of scripts that failed
+    """
+
+    jobs = args.jobs or os.cpu_count() or 1
+    counts = { "converted": 0, "up to date": 0, "failed": 0 }
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        chunksize = max(1, len(nbosfiles) // (4*jobs))
+        for messages, status in pool.map(batch_process_nbos, nbosfiles, itertools.repeat(args), chunksize=chunksize):
+            print(messages, end='')
+            counts[status] += 1
+
+    print("{} scripts: {} converted, {} up to date, {} failed".format(
+        len(nbosfiles), counts["converted"], counts["up to date"], counts["failed"]))
+    return counts["failed"]
+
+
+def modification_time(filename):
+    """ st_mtime_ns of filename, or None if it doesn't exist """
+    try:
+        return os.stat(filename).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def watched_inputs(nbosfile, args):
+    """ { file name: modification time } of nbosfile and of its SCM, or of just nbosfile if it can't be read """
+
+    inputs = { nbosfile: modification_time(nbosfile) }
+    try:
+        _, _, scmfile = read_nbos(nbosfile, args)
+        inputs[scmfile] = modification_time(scmfile)
+    except (OSError, ValueError):
+        pass
+    return inputs
+
+
+def watch_nbos(directory, args):
+    """
+    Convert the scripts in directory that are out of date, then poll it every args.poll_interval seconds and
+    convert any script that is new or whose .nbos or SCM has changed, until interrupted.  Skeletons and
+    assembled scripts stay in memory, so a conversion only costs reading what changed
+    """
+
+    print("watching {} every {:g}s.  Ctrl+C to stop".format(directory, args.poll_interval))
+    # nbosfile: its watched_inputs when it was last converted
+    converted = { }
+    while True:
+        found = set()
+        for nbosfile in recursive_find_nbos(directory):
+            found.add(nbosfile)
+            inputs = converted.get(nbosfile)
+            if inputs is not None and all(modification_time(name) == mtime for name,mtime in inputs.items()):
+                continue
+
+            # read the times before converting, so a change made meanwhile is seen next poll
+            start = time.perf_counter()
+            converted[nbosfile] = watched_inputs(nbosfile, args)
+            try:
+                # up to date scripts are skipped on the first pass only. after that, a script is here because it changed
+                if process_nbos(nbosfile, args, skip_up_to_date=inputs is None):
+                    print("  rebuilt in {:.0f} ms".format(1000.*(time.perf_counter() - start)))
+            except Exception as e:
+                print("  error: {}: {}".format(type(e).__name__, e))
+            sys.stdout.flush()
+
+        for nbosfile in set(converted) - found:
+            del converted[nbosfile]
+        time.sleep(args.poll_interval)
 
 
 if __name__ == "__main__":
 
+    # only wait for Enter (so that a console opened by dropping files on the script stays open) when not a batch
+    interactive = True
     try:
 
         import argparse
-        import scm.dumpscm
         import traceback
 
         parser = argparse.ArgumentParser()
         parser.add_argument('filespec', nargs='*', help='path to the .nbos (not)bos file(s) containing the TA annimation script, and/or directories in which to search for .nbos files.')
         parser.add_argument('--scmfile', help='path to the existing file containing .scm supcom model associated with the script. Overrides any "scm-file-path" statement in the nBOS file', default=None)
         parser.add_argument('--scafile', help='path of the new supcom .sca animation file to create.  Default matches the nbosfile but with extension ".sca"', default=None)
-        parser.add_argument('--fps', type=float, help='frames per second.  default=30', default=30.)
+        parser.add_argument('--fps', type=float, nargs='+', help='frames per second.  given several, one .sca is written for each, named <scafile>_<fps>fps.sca.  default=30', default=[30.])
+        parser.add_argument('--reduce', action='store_true', help='drop the keyframes that interpolating between the frames either side reproduces, within --position-tolerance and --angle-tolerance')
+        parser.add_argument('--position-tolerance', type=float, help='with --reduce, the largest position error allowed in a dropped frame.  default=0.001', default=0.001)
+        parser.add_argument('--angle-tolerance', type=float, help='with --reduce, the largest rotation error allowed in a dropped frame, in degrees.  default=0.1', default=0.1)
+        parser.add_argument('--cache-dir', help='directory for compiled scripts, and for the options that --jobs and --watch record the .sca files were written with.  default is __nboscache__ in the directory of each script', default=None)
+        parser.add_argument('--no-cache', action='store_true', help='compile every script, without reading or writing the cache.  --jobs and --watch then convert every script')
+        parser.add_argument('--jobs', type=int, help='batch mode: convert scripts in a pool of this many processes, 0 for one per cpu, and exit without waiting for Enter.  exit status is 1 if any script failed', default=None)
+        parser.add_argument('--force', action='store_true', help='with --jobs or --watch, convert scripts even if their .sca files are newer than them and their .scm, and were written with the same options')
+        parser.add_argument('--watch', metavar='DIR', help='stay running, converting the scripts in DIR whenever they or their .scm change.  filespecs are not needed', default=None)
+        parser.add_argument('--poll-interval', type=float, help='with --watch, seconds between checks for changes.  default=0.25', default=0.25)
+        parser.add_argument('--step', action='store_true', help='simulate the motion in steps of 1/fps, rounding each sleep to whole frames, as earlier versions did.  default is to compile the script into exact piecewise linear motion and sample that')
         args = parser.parse_args()
-
-        for filespec in args.filespec:
-            recursive_process_filespec(filespec, args)
+        interactive = args.jobs is None and args.watch is None
+
+        nbosfiles = [ nbosfile for filespec in args.filespec for nbosfile in recursive_find_nbos(filespec) ]
+        if args.watch is not None:
+            try:
+                watch_nbos(args.watch, args)
+            except KeyboardInterrupt:
+                failures = 0
+        elif interactive:
+            for nbosfile in nbosfiles:
+                process_nbos(nbosfile, args)
+        else:
+            failures = process_batch(nbosfiles, args)
 
     except:
         traceback.print_exc()
-        input("Press Enter to continue ...")
+        if interactive:
+            input("Press Enter to continue ...")
+        else:
+            sys.exit(1)
 
     else:
-        input("Press Enter to continue ...")
+        if interactive:
+            input("Press Enter to continue ...")
+        elif failures:
+            sys.exit(1)
@@ -2,6 +2,7 @@ rem This script packages the python side of the app into an exe.
 rem You still need to build the c++ side using cmake
 rem
 rem NB you need pyinstaller (a python util) on your path. eg by activating a virtualenv.
+rem and the python packages the scripts use: pip install -r requirements.txt
 pyinstaller -F -p scm convertallunits.py
 pyinstaller -F nbos2sca.py
 pause
\ No newline at end of file
@@ -83,14 +83,20 @@ namespace rwe
         return _entries;
     }
 
-    GafArchive::GafArchive(std::istream* stream, const std::string &archiveName):
-        _archiveName(archiveName)
+    void GafArchive::readHeader(std::istream& stream, GafHeader& header)
     {
-        auto header = readRaw<GafHeader>(*stream);
-        if (header.version != GafVersionNumber)
+        header = readRaw<GafHeader>(stream);
+        if (stream.fail() || header.version != GafVersionNumber)
         {
             throw GafException("Invalid GAF version number");
         }
+    }
+
+    GafArchive::GafArchive(std::istream* stream, const std::string &archiveName):
+        _archiveName(archiveName)
+    {
+        GafHeader header;
+        readHeader(*stream, header);
 
         _entries.reserve(header.entries);
 
@@ -107,8 +113,26 @@ namespace rwe
         _stream = stream;
     }
 
+    GafArchive::GafArchive(std::istream* stream, const std::string &archiveName, const std::vector<std::size_t>& entryOffsets):
+        _archiveName(archiveName)
+    {
+        GafHeader header;
+        readHeader(*stream, header);
+
+        _entries.reserve(entryOffsets.size());
+
+        for (auto offset : entryOffsets)
+        {
+            stream->seekg(offset);
+            _entries.push_back(readEntry(*stream));
+        }
+
+        _stream = stream;
+    }
+
     GafArchive::Entry GafArchive::readEntry(std::istream& stream) const
     {
+        std::size_t offset = stream.tellg();
         auto entry = readRaw<GafEntry>(stream);
 
         auto nullPos = std::find(entry.name, entry.name + GafMaxNameLength, '\0');
@@ -124,7 +148,13 @@ namespace rwe
             frames.emplace_back(frameEntry.frameDataOffset);
         }
 
-        return Entry{std::move(name), std::move(frames)};
+        return Entry{std::move(name), std::move(frames), offset};
+    }
+
+    GafFrameData GafArchive::readFrameHeader(std::size_t frameOffset)
+    {
+        _stream->seekg(frameOffset);
+        return readRaw<GafFrameData>(*_stream);
     }
 
     std::optional<std::reference_wrapper<const GafArchive::Entry>> GafArchive::findEntry(const std::string& name) const
@@ -111,6 +111,9 @@ namespace rwe
         {
             std::string name;
             std::vector<std::size_t> frameOffsets;
+
+            /** Offset of the entry's header in the file. */
+            std::size_t offset;
         };
 
     private:
@@ -121,6 +124,9 @@ namespace rwe
     public:
         explicit GafArchive(std::istream* stream, const std::string &archiveName);
 
+        /** Reads only the entries at the given offsets, eg as previously recorded from Entry::offset. */
+        GafArchive(std::istream* stream, const std::string &archiveName, const std::vector<std::size_t>& entryOffsets);
+
         const std::string& archiveName() const {
             return _archiveName;
         }
@@ -131,7 +137,10 @@ namespace rwe
 
         void extract(const Entry& entry, GafReaderAdapter& adapter);
 
+        GafFrameData readFrameHeader(std::size_t frameOffset);
+
     private:
+        static void readHeader(std::istream& stream, GafHeader& header);
         Entry readEntry(std::istream& stream) const;
     };
 }
@@ -0,0 +1,227 @@
+#**************************************************************************************************
+# Benchmarks for the stages of supcom_exporter.export, on synthetic 3do2scm output:
+#
+#   recursive_coordinate_transform, make_scm, scm_mesh.optimizeVertexCache, scm_mesh.save, save_png
+#
+# eg  python scm/benchmark_exporter.py --pieces 50 --vertices 200 --output bench.json
+#     python scm/benchmark_exporter.py --pieces 50 --vertices 200 --baseline bench.json
+#
+# Each stage is timed over --repeat runs, then run once more under tracemalloc for its peak memory.  Results
+# are written as json.  Given a baseline (an earlier --output), stages more than --tolerance slower are
+# reported and the exit status is 1; so it is too if the .scm differs from the baseline's byte for byte.
+#**************************************************************************************************
+
+import argparse
+import copy
+import hashlib
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy
+import supcom_exporter
+
+
+def parse_ngon_mix(spec):
+    """ "3:1,4:2" -> { 3: 1.0, 4: 2.0 }, relative weights of triangles, quads, ... """
+
+    mix = { }
+    for item in spec.split(','):
+        sides, weight = item.split(':')
+        if int(sides) < 3:
+            raise argparse.ArgumentTypeError("primitives need at least 3 sides")
+        mix[int(sides)] = float(weight)
+    return mix
+
+
+def make_3do_data(unitname, pieces, vertices, primitives, ngon_mix, atlas_dims, seed):
+    """
+    Synthetic output of 3do2scm in the JSON form: a tree of pieces, each with random vertices and with
+    primitives drawn from ngon_mix, and a random atlas.  The same arguments always give the same data
+    """
+
+    rnd = random.Random(seed)
+    sides = sorted(ngon_mix)
+    weights = [ ngon_mix[n] for n in sides ]
+
+    def make_piece(name):
+        piece = {
+            "x": rnd.uniform(-10, 10), "y": rnd.uniform(-10, 10), "z": rnd.uniform(-10, 10),
+            "name": name,
+            "vertices": [
+                { "x": rnd.uniform(-20, 20), "y": rnd.uniform(-20, 20), "z": rnd.uniform(-20, 20) }
+                for _ in range(vertices) ],
+            "primitives": [],
+            "children": [] }
+        for _ in range(primitives):
+            n = min(rnd.choices(sides, weights)[0], vertices)
+            u, v = rnd.random()*0.75, rnd.random()*0.75
+            piece["primitives"].append({
+                "vertices": rnd.sample(range(vertices), n),
+                "uvmin": [u, v],
+                "uvmax": [u + 0.25, v + 0.25] })
+        return piece
+
+    root = make_piece(unitname)
+    all_pieces = [ root ]
+    for n in range(1, pieces):
+        piece = make_piece("piece{}".format(n))
+        rnd.choice(all_pieces)["children"].append(piece)
+        all_pieces.append(piece)
+
+    num_bytes = atlas_dims[0]*atlas_dims[1]*4
+    atlas = numpy.random.default_rng(seed).integers(0, 256, num_bytes, dtype=numpy.uint8).tobytes()
+
+    return { unitname: [ { "root": root, "texture_dims": list(atlas_dims), "albedo": atlas } ] }
+
+
+def time_stage(setup, stage, repeat):
+    """
+    Run stage(setup()) repeat times, then once under tracemalloc.  setup is not timed.
+    Returns (stats, result of the last run)
+    """
+
+    times = []
+    for _ in range(repeat):
+        args = setup()
+        start = time.perf_counter()
+        result = stage(*args)
+        times.append(time.perf_counter() - start)
+
+    args = setup()
+    tracemalloc.start()
+    try:
+        stage(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    stats = { "min_s": min(times), "median_s": statistics.median(times), "peak_bytes": peak }
+    return stats, result
+
+
+def run(args):
+    unitname = "BENCH"
+    _3do_data = make_3do_data(unitname, args.pieces, args.vertices, args.primitives, args.ngons, args.atlas, args.seed)
+    model = _3do_data[unitname][0]
+    tex_dims = model["texture_dims"]
+
+    stages = { }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        scm_filename = os.path.join(tmp_dir, "BENCH_lod0.scm")
+        png_filename = os.path.join(tmp_dir, "BENCH_Albedo.png")
+
+        # each stage works on the output of the one before, as in export()
+        stages["recursive_coordinate_transform"], _ = time_stage(
+            lambda: (copy.deepcopy(model["root"]),),
+            supcom_exporter.recursive_coordinate_transform, args.repeat)
+
+        transformed = copy.deepcopy(model["root"])
+        supcom_exporter.recursive_coordinate_transform(transformed)
+        stages["make_scm"], mesh = time_stage(
+            lambda: (transformed,),
+            supcom_exporter.make_scm, args.repeat)
+
+        stages["scm_mesh.optimizeVertexCache"], acmr = time_stage(
+            lambda: (copy.deepcopy(mesh),),
+            lambda mesh: mesh.optimizeVertexCache(), args.repeat)
+        mesh.optimizeVertexCache()
+
+        stages["scm_mesh.save"], _ = time_stage(
+            lambda: (scm_filename,),
+            mesh.save, args.repeat)
+
+        stages["save_png"], _ = time_stage(
+            lambda: (png_filename, model["albedo"], tex_dims),
+            supcom_exporter.save_png, args.repeat)
+
+        with open(scm_filename, 'rb') as file:
+            scm_sha256 = hashlib.sha256(file.read()).hexdigest()
+
+    return {
+        "config": {
+            "pieces": args.pieces,
+            "vertices": args.vertices,
+            "primitives": args.primitives,
+            "ngons": { str(n): w for n,w in sorted(args.ngons.items()) },
+            "atlas": list(args.atlas),
+            "seed": args.seed },
+        "repeat": args.repeat,
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": numpy.__version__,
+            "machine": platform.machine() },
+        "mesh": {
+            "vertices": int(mesh.vertexCount()),
+            "input_vertices": int(mesh.vertcounter),
+            "dedup_ratio": float(mesh.dedupRatio()),
+            "acmr_before": acmr[0],
+            "acmr_after": acmr[1] },
+        "stages": stages,
+        "scm_sha256": scm_sha256 }
+
+
+def compare(results, baseline, tolerance):
+    """ print a comparison with baseline.  returns False if anything regressed """
+
+    ok = True
+    if results["config"] != baseline["config"]:
+        print("baseline was run with a different configuration. timings and .scm are not comparable")
+        return False
+
+    print("{:32} {:>12} {:>12} {:>8}".format("stage", "baseline s", "now s", "ratio"))
+    for name,stats in results["stages"].items():
+        if name not in baseline["stages"]:
+            continue
+        before = baseline["stages"][name]["min_s"]
+        ratio = stats["min_s"] / before if before > 0 else 1.0
+        regressed = ratio > 1.0 + tolerance
+        ok = ok and not regressed
+        print("{:32} {:>12.6f} {:>12.6f} {:>8.2f}{}".format(name, before, stats["min_s"], ratio, "  SLOWER" if regressed else ""))
+
+    if results["scm_sha256"] != baseline["scm_sha256"]:
+        print(".scm differs from the baseline's")
+        ok = False
+    else:
+        print(".scm identical to the baseline's")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the stages of supcom_exporter on synthetic models")
+    parser.add_argument('--pieces', help='pieces (bones) in the model.  default=20', type=int, default=20)
+    parser.add_argument('--vertices', help='vertices per piece.  default=100', type=int, default=100)
+    parser.add_argument('--primitives', help='primitives per piece.  default=80', type=int, default=80)
+    parser.add_argument('--ngons', help='relative frequency of primitives by number of sides.  default=3:2,4:6,5:1,8:1', type=parse_ngon_mix, default=parse_ngon_mix("3:2,4:6,5:1,8:1"))
+    parser.add_argument('--atlas', help='atlas width and height.  default=512 512', type=int, nargs=2, default=[512, 512])
+    parser.add_argument('--seed', help='random seed for the synthetic model.  default=1', type=int, default=1)
+    parser.add_argument('--repeat', help='timed runs of each stage.  default=5', type=int, default=5)
+    parser.add_argument('--output', help='file to write the results to, as json')
+    parser.add_argument('--baseline', help='results of an earlier run to compare with')
+    parser.add_argument('--tolerance', help='fraction by which a stage may be slower than the baseline.  default=0.1', type=float, default=0.1)
+    args = parser.parse_args()
+
+    results = run(args)
+
+    for name,stats in results["stages"].items():
+        print("{:32} min {:10.6f}s  median {:10.6f}s  peak {:>12} bytes".format(name, stats["min_s"], stats["median_s"], stats["peak_bytes"]))
+
+    if args.output:
+        with open(args.output, 'wt') as file:
+            json.dump(results, file, indent=1)
+
+    if args.baseline:
+        with open(args.baseline, 'rt') as file:
+            baseline = json.load(file)
+        if not compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
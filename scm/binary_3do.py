@@ -0,0 +1,208 @@
+#**************************************************************************************************
+# Reader for the binary output of 3do2scm (3do2scm --format=bin).  Layout is described in app/BinaryFormat.h
+#
+# Sections are mapped with numpy.frombuffer/memoryview over the converter's output, so nothing is copied.
+# Each model is returned as a dictionary of arrays that scm.supcom_exporter.export() accepts in place of
+# the "root" hierarchy of the JSON output.
+#**************************************************************************************************
+
+import numpy
+import struct
+
+BIN_MAGIC = b'3DOB'
+BIN_VERSION = 3
+
+BIN_ATLAS_RGBA = 0
+BIN_ATLAS_INDEXED = 1
+
+BIN_HEADER_FORMAT = '<4s3I'
+BIN_SECTION_FORMAT = '<2I'
+
+BIN_PIECE_DTYPE = numpy.dtype([
+    ('mParentIndex', '<i4'),
+    ('mPosition', '<i4', (3,)),
+    ('mNameOffset', '<u4'),
+    ('mNameLength', '<u4'),
+    ('mFirstVertex', '<u4'),
+    ('mNumVertices', '<u4'),
+    ('mFirstPrimitive', '<u4'),
+    ('mNumPrimitives', '<u4'),
+    ('mSelectionPrimitiveIndex', '<i4')])
+
+BIN_VERTEX_DTYPE = numpy.dtype([
+    ('mPosition', '<i4', (3,))])
+
+BIN_PRIMITIVE_DTYPE = numpy.dtype([
+    ('mFirstIndex', '<u4'),
+    ('mNumIndices', '<u4'),
+    ('mColorIndex', '<i4'),
+    ('mTextureNameOffset', '<u4'),
+    ('mTextureNameLength', '<i4'),
+    ('mUVMin', '<f8', (2,)),
+    ('mUVMax', '<f8', (2,))])
+
+# 3do coordinates are 16.16 fixed point
+SCALE = 65536.0
+
+COLOR_INDEX_NAME_PREFIX = "__colorIndex"
+
+
+class BinaryFormatError(ValueError):
+    pass
+
+
+FRAME_MAGIC = b'3DOF'
+FRAME_HEADER_FORMAT = '<4s3I'
+FRAME_HEADER_SIZE = struct.calcsize(FRAME_HEADER_FORMAT)
+
+FRAME_OK = 0
+FRAME_NOT_FOUND = 1
+FRAME_ERROR = 2
+
+
+def frame_header(header):
+    """
+    (status, unit name length, payload length) from the FRAME_HEADER_SIZE bytes that begin each frame of
+    3do2scm --batch output.  The unit name and payload follow.  For FRAME_OK the payload is the unit's output, to
+    be given to load() or json.loads(); for FRAME_ERROR it is an error message
+    """
+
+    magic, status, unit_name_length, payload_length = struct.unpack(FRAME_HEADER_FORMAT, header)
+    if magic != FRAME_MAGIC:
+        raise BinaryFormatError("not a 3do2scm batch frame")
+    return status, unit_name_length, payload_length
+
+
+def _read_section(buffer, offset, dtype):
+    element_size, element_count = struct.unpack_from(BIN_SECTION_FORMAT, buffer, offset)
+    offset += struct.calcsize(BIN_SECTION_FORMAT)
+    if element_size != dtype.itemsize:
+        raise BinaryFormatError("section element size {} does not match expected {}".format(element_size, dtype.itemsize))
+    end = offset + element_size*element_count
+    if end > len(buffer):
+        raise BinaryFormatError("section extends past the end of the data")
+    return numpy.frombuffer(buffer, dtype=dtype, count=element_count, offset=offset), end
+
+
+def expand_indexed_atlas(atlas, logo_mask, lut):
+    """
+    Raw RGBA texture from an indexed atlas (3do2scm --atlas=indexed): each pixel's colour is lut[logo][index].
+    @param atlas: u1 colour index per pixel
+    @param logo_mask: u1, 1 for pixels coloured by team
+    @param lut: the albedo or specteam lookup table, 2*256 RGBA entries
+    """
+
+    lut = numpy.frombuffer(lut, dtype='u1').reshape(2, 256, 4)
+    return lut[numpy.minimum(logo_mask, 1), atlas].reshape(-1).data
+
+
+def load(buffer):
+    """
+    Map the output of 3do2scm --format=bin.  buffer is any object supporting the buffer protocol (bytes,
+    mmap, ...); the returned arrays are views of it.
+    Returns { unitname: [model,...] } with the same shape as the JSON output, where each model is a dictionary
+    of "pieces", "names", "vertices", "primitives", "indices", "albedo", "specteam" and "texture_dims".
+    Indexed atlases are expanded to RGBA here, so albedo and specteam are always raw RGBA
+    """
+
+    buffer = memoryview(buffer).cast('B')
+
+    magic, version, num_models, unit_name_length = struct.unpack_from(BIN_HEADER_FORMAT, buffer, 0)
+    if magic != BIN_MAGIC:
+        raise BinaryFormatError("not a 3do2scm binary file")
+    if version != BIN_VERSION:
+        raise BinaryFormatError("unsupported 3do2scm binary version {}".format(version))
+
+    offset = struct.calcsize(BIN_HEADER_FORMAT)
+    unitname = bytes(buffer[offset:offset+unit_name_length]).decode('utf-8')
+    offset += unit_name_length
+
+    models = []
+    for _ in range(num_models):
+        width, height, atlas_format = struct.unpack_from('<3I', buffer, offset)
+        offset += struct.calcsize('<3I')
+
+        model = { "texture_dims": [width, height] }
+        for key,dtype in (
+            ("pieces", BIN_PIECE_DTYPE),
+            ("names", numpy.dtype('u1')),
+            ("vertices", BIN_VERTEX_DTYPE),
+            ("primitives", BIN_PRIMITIVE_DTYPE),
+            ("indices", numpy.dtype('<u4'))):
+            model[key], offset = _read_section(buffer, offset, dtype)
+        model["names"] = model["names"].data
+
+        if atlas_format == BIN_ATLAS_RGBA:
+            albedo, offset = _read_section(buffer, offset, numpy.dtype('u1'))
+            specteam, offset = _read_section(buffer, offset, numpy.dtype('u1'))
+            model["albedo"] = albedo.data
+            model["specteam"] = specteam.data
+
+        elif atlas_format == BIN_ATLAS_INDEXED:
+            atlas, offset = _read_section(buffer, offset, numpy.dtype('u1'))
+            logo_mask, offset = _read_section(buffer, offset, numpy.dtype('u1'))
+            albedo_lut, offset = _read_section(buffer, offset, numpy.dtype('<u4'))
+            specteam_lut, offset = _read_section(buffer, offset, numpy.dtype('<u4'))
+            if len(atlas) != width*height or len(logo_mask) != width*height or len(albedo_lut) != 512 or len(specteam_lut) != 512:
+                raise BinaryFormatError("indexed atlas sections do not match the texture dimensions")
+            model["albedo"] = expand_indexed_atlas(atlas, logo_mask, albedo_lut)
+            model["specteam"] = expand_indexed_atlas(atlas, logo_mask, specteam_lut)
+
+        else:
+            raise BinaryFormatError("unsupported atlas format {}".format(atlas_format))
+
+        models.append(model)
+
+    return { unitname: models }
+
+
+def piece_name(model, piece_index):
+    piece = model["pieces"][piece_index]
+    start = int(piece['mNameOffset'])
+    return bytes(model["names"][start:start+int(piece['mNameLength'])]).decode('utf-8')
+
+
+def to_tree(model):
+    """
+    Rebuild the "root" hierarchy of the JSON output from a binary model.  This copies everything into Python
+    objects, so is only meant for consumers that need the dictionary form
+    """
+
+    pieces = model["pieces"]
+    names = model["names"]
+    vertices = (model["vertices"]['mPosition'] / SCALE).tolist()
+    indices = model["indices"].tolist()
+
+    objects = []
+    for n,piece in enumerate(pieces):
+        x,y,z = (piece['mPosition'] / SCALE).tolist()
+        obj = { "x": x, "y": y, "z": z, "name": piece_name(model, n) }
+        if piece['mSelectionPrimitiveIndex'] >= 0:
+            obj["selectionPrimitiveIndex"] = int(piece['mSelectionPrimitiveIndex'])
+        first_vertex = int(piece['mFirstVertex'])
+        obj["vertices"] = [
+            { "x": x, "y": y, "z": z }
+            for x,y,z in vertices[first_vertex:first_vertex+int(piece['mNumVertices'])] ]
+
+        obj["primitives"] = []
+        first_primitive = int(piece['mFirstPrimitive'])
+        for prim in model["primitives"][first_primitive:first_primitive+int(piece['mNumPrimitives'])]:
+            primitive = { }
+            if prim['mColorIndex'] >= 0:
+                primitive["colorIndex"] = int(prim['mColorIndex'])
+                primitive["colorIndexTextureName"] = COLOR_INDEX_NAME_PREFIX + str(int(prim['mColorIndex']))
+            if prim['mTextureNameLength'] >= 0:
+                start = int(prim['mTextureNameOffset'])
+                primitive["textureName"] = bytes(names[start:start+int(prim['mTextureNameLength'])]).decode('utf-8')
+            first_index = int(prim['mFirstIndex'])
+            primitive["vertices"] = indices[first_index:first_index+int(prim['mNumIndices'])]
+            primitive["uvmin"] = prim['mUVMin'].tolist()
+            primitive["uvmax"] = prim['mUVMax'].tolist()
+            obj["primitives"].append(primitive)
+
+        obj["children"] = []
+        objects.append(obj)
+        if piece['mParentIndex'] >= 0:
+            objects[piece['mParentIndex']]["children"].append(obj)
+
+    return objects[0]
@@ -0,0 +1,114 @@
+#**************************************************************************************************
+# Content-addressed artifact cache for incremental conversions.
+#
+#   <cache dir>/objects/<2 hex>/<sha256>    artifacts (converter outputs, .scm, .png), named by their digest
+#   <cache dir>/actions/<sha256>.json       results of a build step, named by the digest of its inputs
+#   <cache dir>/builds/<sha256>.json        what was last built for a target, named by the digest of the target
+#
+# A build step (running the converter, running the exporter) is described by a dictionary of its inputs.
+# If an action is recorded for the digest of those inputs, its results can be restored from the objects
+# rather than recomputed.
+#**************************************************************************************************
+
+import hashlib
+import json
+import os
+import tempfile
+
+READ_SIZE = 1 << 20
+
+
+def bytes_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(READ_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def inputs_digest(inputs):
+    """ digest of a json serialisable description of a build step's inputs """
+    return bytes_digest(json.dumps(inputs, sort_keys=True, separators=(',', ':')).encode('utf-8'))
+
+
+def _write_atomic(path, data):
+    # write to a temporary and rename, so that a concurrent reader never sees a partial file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+class BuildCache:
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def object_path(self, digest):
+        return os.path.join(self.cache_dir, "objects", digest[0:2], digest)
+
+    def has_object(self, digest):
+        return os.path.isfile(self.object_path(digest))
+
+    def put_bytes(self, data):
+        digest = bytes_digest(data)
+        if not self.has_object(digest):
+            _write_atomic(self.object_path(digest), data)
+        return digest
+
+    def put_file(self, path):
+        with open(path, 'rb') as file:
+            return self.put_bytes(file.read())
+
+    def get_bytes(self, digest):
+        """ contents of an object, or None if it isn't in the cache """
+        try:
+            with open(self.object_path(digest), 'rb') as file:
+                return file.read()
+        except OSError:
+            return None
+
+    def restore(self, digest, path):
+        """ copy an object to path.  returns False if it isn't in the cache """
+        data = self.get_bytes(digest)
+        if data is None:
+            return False
+        _write_atomic(path, data)
+        return True
+
+    def action_path(self, key):
+        return os.path.join(self.cache_dir, "actions", key + ".json")
+
+    def get_action(self, key):
+        """ results recorded for the inputs digest key, or None """
+        try:
+            with open(self.action_path(key), 'rt', encoding='utf-8') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def put_action(self, key, results):
+        _write_atomic(self.action_path(key), json.dumps(results, sort_keys=True, indent=1).encode('utf-8'))
+
+    def build_path(self, target):
+        return os.path.join(self.cache_dir, "builds", inputs_digest(target) + ".json")
+
+    def get_build(self, target):
+        """ the record of the last build of target (any json serialisable description of it), or None """
+        try:
+            with open(self.build_path(target), 'rt', encoding='utf-8') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def put_build(self, target, record):
+        _write_atomic(self.build_path(target), json.dumps(record, sort_keys=True, indent=1).encode('utf-8'))
@@ -0,0 +1,223 @@
+#**************************************************************************************************
+# Persistent GAF texture catalog.  Reads and writes the same file as app/GafCatalog.cpp:
+#
+#   3DO2SCM GAF CATALOG\t<version>
+#   A\t<size>\t<mtime>\t<archive path>                  an archive. mtime in seconds since the unix epoch
+#   T\t<entry offset>\t<width>\t<height>\t<name>         a texture in the preceding archive
+#
+# Maps texture names to the archive, entry header offset and first frame dimensions, so a texture can be
+# found without opening every GAF.  Archives are re-indexed only when their size or mtime changes.
+#**************************************************************************************************
+
+import collections
+import hashlib
+import os
+import struct
+
+CATALOG_MAGIC = "3DO2SCM GAF CATALOG"
+CATALOG_VERSION = 1
+
+GAF_VERSION_NUMBER = 0x00010100
+GAF_HEADER_FORMAT = '<3I'
+GAF_ENTRY_FORMAT = '<2HI32s'
+GAF_FRAME_ENTRY_FORMAT = '<2I'
+GAF_FRAME_DATA_FORMAT = '<2H2h2BH3I'
+
+Texture = collections.namedtuple('Texture', ['name', 'entry_offset', 'width', 'height'])
+
+
+class Archive:
+
+    def __init__(self, path, size, mtime, textures=None):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.textures = textures or []
+
+    def is_current(self, size, mtime):
+        return self.size == size and self.mtime == mtime
+
+
+def _stat(path):
+    st = os.stat(path)
+    return st.st_size, int(st.st_mtime)
+
+
+def index_archive(path):
+    """
+    List the textures of a GAF archive: for each entry, its name, the offset of its header and the dimensions of
+    its first frame.  Raises ValueError if the file isn't a GAF
+    """
+
+    textures = []
+    with open(path, 'rb') as file:
+        data = file.read(struct.calcsize(GAF_HEADER_FORMAT))
+        if len(data) < struct.calcsize(GAF_HEADER_FORMAT):
+            raise ValueError("Invalid GAF version number")
+        version, num_entries, _ = struct.unpack(GAF_HEADER_FORMAT, data)
+        if version != GAF_VERSION_NUMBER:
+            raise ValueError("Invalid GAF version number")
+
+        entry_offsets = struct.unpack('<{}I'.format(num_entries), file.read(4*num_entries))
+        for entry_offset in entry_offsets:
+            file.seek(entry_offset)
+            num_frames, _, _, name = struct.unpack(GAF_ENTRY_FORMAT, file.read(struct.calcsize(GAF_ENTRY_FORMAT)))
+            name = name.split(b'\0')[0].decode('utf-8', errors='surrogateescape')
+
+            width = height = 0
+            if num_frames > 0:
+                frame_offset, _ = struct.unpack(GAF_FRAME_ENTRY_FORMAT, file.read(struct.calcsize(GAF_FRAME_ENTRY_FORMAT)))
+                file.seek(frame_offset)
+                width, height = struct.unpack(GAF_FRAME_DATA_FORMAT, file.read(struct.calcsize(GAF_FRAME_DATA_FORMAT)))[0:2]
+
+            textures.append(Texture(name, entry_offset, width, height))
+
+    return textures
+
+
+def entry_digest(path, entry_offset):
+    """
+    sha256 hex digest of everything a GAF entry is made of: its header and those of its frames and subframes,
+    and their pixel data.  Changes when the texture does, but not when other entries of the archive do
+    """
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        def read(offset, size):
+            file.seek(offset)
+            data = file.read(size)
+            if len(data) < size:
+                raise ValueError("GAF entry extends past the end of the file")
+            digest.update(data)
+            return data
+
+        entry_size = struct.calcsize(GAF_ENTRY_FORMAT)
+        frame_entry_size = struct.calcsize(GAF_FRAME_ENTRY_FORMAT)
+        num_frames = struct.unpack(GAF_ENTRY_FORMAT, read(entry_offset, entry_size))[0]
+        frame_entries = read(entry_offset + entry_size, num_frames*frame_entry_size)
+
+        # depth first, frames in order
+        frames = [ frame_offset for frame_offset,_ in struct.iter_unpack(GAF_FRAME_ENTRY_FORMAT, frame_entries) ]
+        frames.reverse()
+        while frames:
+            width, height, _, _, _, compressed, num_subframes, _, data_offset, _ = struct.unpack(
+                GAF_FRAME_DATA_FORMAT, read(frames.pop(), struct.calcsize(GAF_FRAME_DATA_FORMAT)))
+            if num_subframes > 0:
+                subframes = struct.unpack('<{}I'.format(num_subframes), read(data_offset, 4*num_subframes))
+                frames.extend(reversed(subframes))
+            elif compressed:
+                # each row is a u16 length followed by that many bytes
+                offset = data_offset
+                for _ in range(height):
+                    row_length, = struct.unpack('<H', read(offset, 2))
+                    read(offset + 2, row_length)
+                    offset += 2 + row_length
+            else:
+                read(data_offset, width*height)
+
+    return digest.hexdigest()
+
+
+class GafCatalog:
+
+    def __init__(self, catalog_file):
+        self.catalog_file = catalog_file
+        self.archives = { }             # path: Archive
+        self.texture_locations = { }    # texture name: (Archive, Texture)
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.catalog_file, 'rt', encoding='utf-8', errors='surrogateescape', newline='\n') as file:
+                lines = file.read().split('\n')
+        except OSError:
+            return
+
+        # catalogs written by older builds on windows have CRLF line endings
+        lines = [ line[:-1] if line.endswith('\r') else line for line in lines ]
+
+        if len(lines) == 0 or lines[0] != "{}\t{}".format(CATALOG_MAGIC, CATALOG_VERSION):
+            # written by another version. start afresh
+            return
+
+        archive = None
+        for line in lines[1:]:
+            fields = line.split('\t')
+            if len(fields) == 4 and fields[0] == "A":
+                archive = Archive(fields[3], int(fields[1]), int(fields[2]))
+                self.archives[archive.path] = archive
+            elif len(fields) == 5 and fields[0] == "T" and archive is not None:
+                archive.textures.append(Texture(fields[4], int(fields[1]), int(fields[2]), int(fields[3])))
+
+    def save(self):
+        # write to a temporary and rename, so that a concurrent reader never sees a partial catalog.
+        # the temporary is per process so that concurrent writers don't interleave
+        tmp_file = "{}.{}.tmp".format(self.catalog_file, os.getpid())
+        try:
+            with open(tmp_file, 'wt', encoding='utf-8', errors='surrogateescape', newline='\n') as file:
+                file.write("{}\t{}\n".format(CATALOG_MAGIC, CATALOG_VERSION))
+                for path in sorted(self.archives):
+                    archive = self.archives[path]
+                    file.write("A\t{}\t{}\t{}\n".format(archive.size, archive.mtime, archive.path))
+                    for texture in archive.textures:
+                        file.write("T\t{}\t{}\t{}\t{}\n".format(texture.entry_offset, texture.width, texture.height, texture.name))
+            os.replace(tmp_file, self.catalog_file)
+        except OSError:
+            try:
+                os.remove(tmp_file)
+            except OSError:
+                pass
+            raise
+
+    def update(self, tadata_paths):
+        """
+        Rescan the textures directories, re-indexing new or changed archives, and save the catalog if anything
+        changed.  Textures are looked up in the archives found by the most recent scan.  The first archive
+        taking precedence is that of the first tadata path, then of the lowest path within it, ordered by its
+        bytes: 3do2scm's GafCatalog orders them the same, so that both find a texture in the same archive
+        """
+
+        dirty = False
+        self.texture_locations = { }
+
+        for tadata in tadata_paths:
+            directory = os.path.join(tadata, "textures")
+            # os.walk's order is the filesystem's
+            paths = [ os.path.join(subdir, filename) for subdir, dirs, files in os.walk(directory) for filename in files ]
+            for path in sorted(paths, key=os.fsencode):
+                try:
+                    size, mtime = _stat(path)
+                except OSError:
+                    continue
+
+                archive = self.archives.get(path)
+                if archive is None or not archive.is_current(size, mtime):
+                    try:
+                        textures = index_archive(path)
+                    except (OSError, ValueError, struct.error) as e:
+                        # not a gaf. recorded with no textures so that it isn't rescanned until it changes
+                        print("skipping '{}': {}".format(path, e))
+                        textures = []
+                    archive = Archive(path, size, mtime, textures)
+                    self.archives[path] = archive
+                    dirty = True
+
+                for texture in archive.textures:
+                    self.texture_locations.setdefault(texture.name, (archive, texture))
+
+        # forget archives that have been deleted
+        for path in [ path for path in self.archives if not os.path.isfile(path) ]:
+            del self.archives[path]
+            dirty = True
+
+        if dirty:
+            self.save()
+
+    def find(self, texture_name):
+        """ (Archive, Texture) holding the named texture, or None """
+        return self.texture_locations.get(texture_name)
+
+    @staticmethod
+    def is_logo_archive(archive_path):
+        # as 3do2scm: all gafs found in logos.gaf are coloured by team
+        return "logo" in archive_path.lower()
@@ -0,0 +1,106 @@
+#**************************************************************************************************
+# Pure Python reader for what convertallunits needs of a Total Annihilation .3do model before converting it:
+# where it is, and the textures it uses.  The object hierarchy is walked as rwe::parse3doObjects (rwe/_3do.cpp)
+# walks it, decoding the _3doObject and _3doPrimitive records (rwe/_3do.h) with numpy.frombuffer.
+#**************************************************************************************************
+
+import numpy
+import os
+
+_3DO_MAGIC_NUMBER = 1
+
+_3DO_OBJECT_DTYPE = numpy.dtype([
+    ('magicNumber', '<u4'),
+    ('numberOfVertices', '<u4'),
+    ('numberOfPrimitives', '<u4'),
+    ('selectionPrimitiveOffset', '<i4'),
+    ('xFromParent', '<i4'),
+    ('yFromParent', '<i4'),
+    ('zFromParent', '<i4'),
+    ('nameOffset', '<u4'),
+    ('unknown1', '<u4'),
+    ('verticesOffset', '<u4'),
+    ('primitivesOffset', '<u4'),
+    ('siblingOffset', '<u4'),
+    ('firstChildOffset', '<u4')])
+
+_3DO_PRIMITIVE_DTYPE = numpy.dtype([
+    ('colorIndex', '<u4'),
+    ('numberOfVertices', '<u4'),
+    ('unknown1', '<u4'),
+    ('verticesOffset', '<u4'),
+    ('textureNameOffset', '<u4'),
+    ('unknown2', '<u4'),
+    ('unknown3', '<u4'),
+    ('isColored', '<u4')])
+
+COLOR_INDEX_NAME_PREFIX = "__colorIndex"
+
+
+class Format3doError(ValueError):
+    pass
+
+
+def _read_string(buffer, offset):
+    end = buffer.find(b'\0', offset)
+    if end < 0:
+        end = len(buffer)
+    return bytes(buffer[offset:end]).decode('utf-8', errors='replace')
+
+
+def _read_object(buffer, offset):
+    obj = numpy.frombuffer(buffer, dtype=_3DO_OBJECT_DTYPE, count=1, offset=offset)[0]
+    if obj['magicNumber'] != _3DO_MAGIC_NUMBER:
+        raise Format3doError("bad 3do object magic number at offset {}".format(offset))
+    return obj
+
+
+def iter_pieces(buffer, offset=0):
+    """
+    Walk the object hierarchy starting at offset in depth first pre-order.  Yields (object record, primitives)
+    where primitives is a structured array view of the buffer
+    """
+
+    stack = [ offset ]
+    while stack:
+        obj = _read_object(buffer, stack.pop())
+        primitives = numpy.frombuffer(buffer, dtype=_3DO_PRIMITIVE_DTYPE, count=int(obj['numberOfPrimitives']), offset=int(obj['primitivesOffset']))
+        yield obj, primitives
+
+        # siblings of this piece come after all of its descendants
+        if obj['siblingOffset'] != 0:
+            stack.append(int(obj['siblingOffset']))
+        if obj['firstChildOffset'] != 0:
+            stack.append(int(obj['firstChildOffset']))
+
+
+def primitive_texture_name(buffer, primitive):
+    """ texture name of the primitive, its colour index name, or None """
+
+    if primitive['textureNameOffset'] != 0:
+        return _read_string(buffer, int(primitive['textureNameOffset']))
+    elif primitive['isColored']:
+        return COLOR_INDEX_NAME_PREFIX + str(int(primitive['colorIndex']))
+    return None
+
+
+def texture_names(buffer):
+    """ names of all textures and colour indices the model uses, as 3do2scm collects them for its atlas """
+
+    names = set()
+    for _, primitives in iter_pieces(buffer):
+        for primitive in primitives:
+            name = primitive_texture_name(buffer, primitive)
+            if name is not None:
+                names.add(name)
+    return names
+
+
+def find_3do(unitname, tadata_paths):
+    """ path of unitname's .3do, searched for as 3do2scm does, or None """
+
+    for tadata in tadata_paths:
+        candidate = os.path.join(tadata, "objects3d", unitname + ".3do")
+        if os.path.isfile(candidate):
+            return candidate
+    return None
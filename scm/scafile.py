@@ -0,0 +1,363 @@
+#**************************************************************************************************
+# Reader and writer for Supreme Commander animation (.sca) files.  Layout is described in ScaFile_format.h
+#
+# ScaFile maps a file (or wraps any buffer) and exposes the keyframes as numpy views of the mapping, so
+# nothing is copied:
+#
+#   with scm.scafile.open_sca("UNITS/ARMCOM/ARMCOM_walk.sca") as anim:
+#       keys = anim.keys            # (frames, bones, 7): x,y,z position then w,x,y,z rotation
+#
+# The functions below it work on whole animations at once, as arrays of times (frames,) and keys
+# (frames, bones, 7): resample to another fps, trim, make the end meet the start for looping, drop frames
+# interpolation reproduces, and concatenate.  write_sca writes the result.
+#**************************************************************************************************
+
+import mmap
+import numpy
+
+SCA_MAGIC = b'ANIM'
+SCA_VERSION = 5
+
+SCA_HEADER_DTYPE = numpy.dtype([
+    ('mMagic', 'S4'),
+    ('mVersion', '<u4'),
+    ('mNumFrames', '<u4'),
+    ('mDuration', '<f4'),
+    ('mNumBones', '<u4'),
+    ('mBoneNamesOffset', '<u4'),
+    ('mBoneLinksOffset', '<u4'),
+    ('mFirstFrameOffset', '<u4'),
+    ('mFrameSize', '<u4')])
+
+SCA_ANIM_HEAD_DTYPE = numpy.dtype([
+    ('mPositionDelta', '<f4', (3,)),
+    ('mOrientDelta', '<f4', (4,))])
+
+KEY_SIZE = 7
+
+
+def sca_frame_dtype(num_bones):
+    return numpy.dtype([
+        ('mTime', '<f4'),
+        ('mFlags', '<u4'),
+        ('mBones', '<f4', (num_bones, KEY_SIZE))])
+
+
+class ScaFormatError(ValueError):
+    pass
+
+
+class ScaFile:
+    """
+    The contents of an SCA file, as views of buffer (bytes, mmap, ...):
+      header          SCA_HEADER_DTYPE record
+      bone_names      list of strings
+      bone_links      parent index of each bone, -1 for none
+      position_delta  root position delta between the first and last frames
+      orient_delta    root orientation delta, quaternion (w,x,y,z)
+      times, flags    per frame
+      keys            (frames, bones, 7) float32: position (x,y,z), then rotation (w,x,y,z)
+    """
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        view = memoryview(buffer).cast('B')
+        if len(view) < SCA_HEADER_DTYPE.itemsize:
+            raise ScaFormatError("file too short for an SCA header")
+
+        header = self.header = numpy.frombuffer(view, dtype=SCA_HEADER_DTYPE, count=1)[0]
+        if header['mMagic'] != SCA_MAGIC:
+            raise ScaFormatError("not an SCA file")
+        if header['mVersion'] != SCA_VERSION:
+            raise ScaFormatError("unsupported SCA version {}".format(int(header['mVersion'])))
+
+        num_bones = int(header['mNumBones'])
+        num_frames = int(header['mNumFrames'])
+        frame_dtype = sca_frame_dtype(num_bones)
+        if header['mFrameSize'] != frame_dtype.itemsize:
+            raise ScaFormatError("frame size {} does not match {} bones".format(int(header['mFrameSize']), num_bones))
+        first_frame = int(header['mFirstFrameOffset'])
+        links_offset = int(header['mBoneLinksOffset'])
+        names_offset = int(header['mBoneNamesOffset'])
+        if first_frame + SCA_ANIM_HEAD_DTYPE.itemsize + num_frames*frame_dtype.itemsize > len(view) \
+                or links_offset + 4*num_bones > len(view) or names_offset > links_offset:
+            raise ScaFormatError("sections extend past the end of the file")
+
+        names = bytes(view[names_offset:links_offset]).split(b'\0')
+        if len(names) <= num_bones:
+            raise ScaFormatError("too few bone names")
+        try:
+            self.bone_names = [ name.decode('utf-8') for name in names[0:num_bones] ]
+        except UnicodeDecodeError:
+            raise ScaFormatError("bone name is not valid utf-8")
+        self.bone_links = numpy.frombuffer(view, dtype='<i4', count=num_bones, offset=links_offset)
+
+        anim_head = numpy.frombuffer(view, dtype=SCA_ANIM_HEAD_DTYPE, count=1, offset=first_frame)[0]
+        self.position_delta = anim_head['mPositionDelta']
+        self.orient_delta = anim_head['mOrientDelta']
+        self.frames = numpy.frombuffer(view, dtype=frame_dtype, count=num_frames, offset=first_frame+SCA_ANIM_HEAD_DTYPE.itemsize)
+        self.times = self.frames['mTime']
+        self.flags = self.frames['mFlags']
+        self.keys = self.frames['mBones']
+        self._view = view
+
+    def close(self):
+        """
+        Release the file.  Arrays taken from this ScaFile are views of the mapping: if any are still alive, the
+        file stays mapped until they are released
+        """
+
+        self.header = self.bone_links = self.position_delta = self.orient_delta = None
+        self.frames = self.times = self.flags = self.keys = None
+        try:
+            if self._view is not None:
+                self._view.release()
+                self._view = None
+            if isinstance(self.buffer, mmap.mmap):
+                self.buffer.close()
+        except BufferError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_sca(filename):
+    """ map filename read only.  returns an ScaFile, to be closed, or used in a with statement """
+
+    with open(filename, 'rb') as file:
+        try:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # an empty file can't be mapped
+            raise ScaFormatError("file too short for an SCA header")
+    # if the file isn't valid, the exception's traceback holds views of the mapping, so it can't be closed
+    # here.  it is unmapped when they are released
+    return ScaFile(buffer)
+
+
+def write_sca(file, bone_names, bone_links, times, keys, position_delta=(0., 0., 0.), orient_delta=(1., 0., 0., 0.)):
+    """
+    Write an animation to a binary file object.
+    @param times: (frames,) seconds
+    @param keys: (frames, bones, 7) position (x,y,z) and rotation (w,x,y,z) of each bone in each frame
+    """
+
+    num_frames, num_bones = len(keys), len(bone_names)
+    names = b''.join(name.encode('utf-8') + b'\0' for name in bone_names)
+
+    header = numpy.zeros(1, dtype=SCA_HEADER_DTYPE)
+    header['mMagic'] = SCA_MAGIC
+    header['mVersion'] = SCA_VERSION
+    header['mNumFrames'] = num_frames
+    header['mDuration'] = times[-1] - times[0] if num_frames > 0 else 0.
+    header['mNumBones'] = num_bones
+    header['mBoneNamesOffset'] = SCA_HEADER_DTYPE.itemsize
+    header['mBoneLinksOffset'] = SCA_HEADER_DTYPE.itemsize + len(names)
+    header['mFirstFrameOffset'] = SCA_HEADER_DTYPE.itemsize + len(names) + 4*num_bones
+
+    anim_head = numpy.zeros(1, dtype=SCA_ANIM_HEAD_DTYPE)
+    anim_head['mPositionDelta'] = position_delta
+    anim_head['mOrientDelta'] = orient_delta
+
+    frames = numpy.zeros(num_frames, dtype=sca_frame_dtype(num_bones))
+    header['mFrameSize'] = frames.dtype.itemsize
+    frames['mTime'] = times
+    frames['mBones'] = keys
+
+    for buffer in (header, names, numpy.asarray(bone_links, dtype='<i4'), anim_head, frames):
+        file.write(buffer if isinstance(buffer, bytes) else buffer.tobytes())
+
+
+######################################################
+# Quaternions (w,x,y,z) in the last axis of an array
+######################################################
+
+def quaternion_multiply(q1, q2):
+    w1, x1, y1, z1 = numpy.moveaxis(q1, -1, 0)
+    w2, x2, y2, z2 = numpy.moveaxis(q2, -1, 0)
+    return numpy.stack([
+        w1*w2 - x1*x2 - y1*y2 - z1*z2,
+        w1*x2 + x1*w2 + y1*z2 - z1*y2,
+        w1*y2 - x1*z2 + y1*w2 + z1*x2,
+        w1*z2 + x1*y2 - y1*x2 + z1*w2], axis=-1)
+
+
+def quaternion_conjugate(q):
+    return q * numpy.array([1., -1., -1., -1.])
+
+
+def slerp(q1, q2, t):
+    """ spherical interpolation from q1 (t=0) to q2 (t=1), along the shorter arc.  t broadcasts against q[...,0] """
+
+    t = numpy.asarray(t, dtype=numpy.float64)[...,None]
+    dot = (q1*q2).sum(axis=-1, keepdims=True)
+    q2 = numpy.where(dot < 0., -q2, q2)
+    dot = numpy.abs(dot)
+
+    angle = numpy.arccos(numpy.minimum(dot, 1.))
+    sin_angle = numpy.sin(angle)
+    # nearly parallel: sin_angle ~ 0, so interpolate linearly
+    linear = sin_angle < 1e-6
+    safe_sin = numpy.where(linear, 1., sin_angle)
+    w1 = numpy.where(linear, 1.-t, numpy.sin((1.-t)*angle) / safe_sin)
+    w2 = numpy.where(linear, t, numpy.sin(t*angle) / safe_sin)
+    q = w1*q1 + w2*q2
+    return q / numpy.linalg.norm(q, axis=-1, keepdims=True)
+
+
+######################################################
+# Post-processing of whole animations
+######################################################
+
+def sample(times, keys, sample_times):
+    """
+    Keys at sample_times, interpolated between the neighbouring frames: linearly for positions, by slerp for
+    rotations.  Times outside the animation take its first or last frame
+    """
+
+    times = numpy.asarray(times, dtype=numpy.float64)
+    keys = numpy.asarray(keys, dtype=numpy.float64)
+    sample_times = numpy.clip(numpy.asarray(sample_times, dtype=numpy.float64), times[0], times[-1])
+    if len(times) == 1:
+        return numpy.repeat(keys, len(sample_times), axis=0)
+
+    before = numpy.clip(numpy.searchsorted(times, sample_times, side='right') - 1, 0, len(times) - 2)
+    span = times[before+1] - times[before]
+    t = numpy.where(span > 0., (sample_times - times[before]) / numpy.where(span > 0., span, 1.), 0.)
+
+    k1, k2 = keys[before], keys[before+1]
+    result = numpy.empty((len(sample_times),) + keys.shape[1:])
+    result[...,0:3] = k1[...,0:3] + t[:,None,None] * (k2[...,0:3] - k1[...,0:3])
+    result[...,3:7] = slerp(k1[...,3:7], k2[...,3:7], numpy.broadcast_to(t[:,None], k1.shape[:-1]))
+    return result
+
+
+def resample(times, keys, fps):
+    """
+    The animation at fps frames per second, over the same duration (rounded to a whole number of frames).
+    @return: (times, keys)
+    """
+
+    duration = float(times[-1] - times[0])
+    num_frames = int(round(duration * fps)) + 1
+    new_times = numpy.arange(num_frames) / float(fps)
+    return new_times, sample(numpy.asarray(times) - times[0], keys, new_times)
+
+
+def trim(times, keys, start, end):
+    """
+    The frames from start to end seconds, inclusive.  Times are rebased to start at 0.
+    @return: (times, keys)
+    """
+
+    times = numpy.asarray(times, dtype=numpy.float64)
+    first = numpy.searchsorted(times, start, side='left')
+    last = numpy.searchsorted(times, end, side='right')
+    if last <= first:
+        raise ValueError("no frames between {}s and {}s".format(start, end))
+    return times[first:last] - times[first], numpy.asarray(keys)[first:last]
+
+
+def loop_fix(times, keys):
+    """
+    Make the last frame match the first, so the animation loops without a jump, by spreading the difference
+    between them over the animation in proportion to time.
+    @return: keys
+    """
+
+    times = numpy.asarray(times, dtype=numpy.float64)
+    keys = numpy.array(keys, dtype=numpy.float64)
+    duration = times[-1] - times[0]
+    if duration <= 0.:
+        return keys
+    weight = (times - times[0]) / duration
+
+    keys[...,0:3] += weight[:,None,None] * (keys[0,:,0:3] - keys[-1,:,0:3])
+
+    # rotation carrying the last frame onto the first, applied in part to each frame
+    correction = quaternion_multiply(keys[0,:,3:7], quaternion_conjugate(keys[-1,:,3:7]))
+    identity = numpy.broadcast_to(numpy.array([1., 0., 0., 0.]), correction.shape)
+    partial = slerp(identity[None], correction[None], numpy.broadcast_to(weight[:,None], keys.shape[:-1]))
+    keys[...,3:7] = quaternion_multiply(partial, keys[...,3:7])
+    return keys
+
+
+def keyframe_errors(times, keys, first, last):
+    """
+    How far frames first+1 .. last-1 are from interpolating between frames first and last.
+    @return: (largest position error, largest rotation error in degrees), over all bones of those frames
+    """
+
+    if last - first < 2:
+        return 0., 0.
+    k1, k2, between = keys[first], keys[last], keys[first+1:last]
+    span = times[last] - times[first]
+    t = (times[first+1:last] - times[first]) / span if span > 0. else numpy.zeros(last-first-1)
+
+    positions = k1[...,0:3] + t[:,None,None] * (k2[...,0:3] - k1[...,0:3])
+    position_error = numpy.linalg.norm(positions - between[...,0:3], axis=-1).max()
+
+    rotations = slerp(k1[...,3:7], k2[...,3:7], numpy.broadcast_to(t[:,None], between.shape[:-1]))
+    dot = numpy.abs((rotations * between[...,3:7]).sum(axis=-1)) / numpy.linalg.norm(between[...,3:7], axis=-1)
+    angle_error = numpy.degrees(2.*numpy.arccos(numpy.minimum(dot, 1.))).max()
+    return float(position_error), float(angle_error)
+
+
+def reduce_keyframes(times, keys, position_tolerance, angle_tolerance):
+    """
+    Choose frames to drop where interpolating between the frames kept either side reproduces them, for every
+    bone, to within position_tolerance and angle_tolerance (degrees).  The first and last frames are always
+    kept, so a stretch in which nothing moves reduces to its two ends.
+    @return: indices of the frames to keep, ascending
+    """
+
+    times = numpy.asarray(times, dtype=numpy.float64)
+    keys = numpy.asarray(keys, dtype=numpy.float64)
+    last_frame = len(times) - 1
+
+    def fits(first, last):
+        position_error, angle_error = keyframe_errors(times, keys, first, last)
+        return position_error <= position_tolerance and angle_error <= angle_tolerance
+
+    keep = [ 0 ]
+    while keep[-1] < last_frame:
+        # the furthest frame that fits: gallop out from the last kept frame, then bisect
+        first = keep[-1]
+        good, step = first + 1, 2
+        while first + step <= last_frame and fits(first, first + step):
+            good, step = first + step, step*2
+        bad = min(first + step, last_frame + 1)
+        while bad - good > 1:
+            middle = (good + bad) // 2
+            if fits(first, middle):
+                good = middle
+            else:
+                bad = middle
+        keep.append(good)
+    return numpy.array(keep)
+
+
+def concatenate(animations):
+    """
+    Play animations one after the other.  Each is (bone names, times, keys); later animations must have the
+    same bones as the first, in any order.  Each starts one frame interval of the one before after that ends
+    @return: (times, keys), with the bones in the first animation's order
+    """
+
+    bone_names = animations[0][0]
+    all_times, all_keys = [], []
+    start = 0.
+    for names,times,keys in animations:
+        if sorted(names) != sorted(bone_names):
+            raise ValueError("animations do not have the same bones")
+        order = [ names.index(name) for name in bone_names ]
+        times = numpy.asarray(times, dtype=numpy.float64)
+        all_times.append(times - times[0] + start)
+        all_keys.append(numpy.asarray(keys, dtype=numpy.float64)[:,order])
+        interval = times[1] - times[0] if len(times) > 1 else 0.
+        start = all_times[-1][-1] + interval
+    return numpy.concatenate(all_times), numpy.concatenate(all_keys)
@@ -0,0 +1,71 @@
+#**************************************************************************************************
+# Post-processing of existing .sca animations:
+#
+#   python scm/scatool.py resample --fps 30 -o walk30.sca walk.sca
+#   python scm/scatool.py trim --start 0.5 --end 2 -o part.sca walk.sca
+#   python scm/scatool.py loopfix -o walk_loop.sca walk.sca
+#   python scm/scatool.py reduce --position-tolerance 0.001 --angle-tolerance 0.1 -o small.sca walk.sca
+#   python scm/scatool.py concat -o all.sca start.sca walk.sca stop.sca
+#**************************************************************************************************
+
+import argparse
+import sys
+
+import scafile
+
+
+def read(filename):
+    """ (bone names, bone links, times, keys, position delta, orient delta), copied out of the file """
+    with scafile.open_sca(filename) as anim:
+        return (anim.bone_names, anim.bone_links.copy(), anim.times.astype(float), anim.keys.astype(float),
+            anim.position_delta.copy(), anim.orient_delta.copy())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resample, trim, loop-fix, reduce or concatenate .sca animations")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    resample = commands.add_parser('resample', help='change the frame rate')
+    resample.add_argument('--fps', help='new frames per second', type=float, required=True)
+    trim = commands.add_parser('trim', help='keep only the frames between two times')
+    trim.add_argument('--start', help='seconds.  default=0', type=float, default=0.)
+    trim.add_argument('--end', help='seconds.  default=the end', type=float, default=float('inf'))
+    commands.add_parser('loopfix', help='spread the difference between the last and first frames over the animation, so it loops smoothly')
+    reduce = commands.add_parser('reduce', help='drop the frames that interpolating between their neighbours reproduces')
+    reduce.add_argument('--position-tolerance', help='largest position error allowed in a dropped frame.  default=0.001', type=float, default=0.001)
+    reduce.add_argument('--angle-tolerance', help='largest rotation error allowed in a dropped frame, degrees.  default=0.1', type=float, default=0.1)
+    commands.add_parser('concat', help='play the input animations one after another')
+
+    for command in commands.choices.values():
+        command.add_argument('-o', '--output', help='.sca file to write', required=True)
+        command.add_argument('input', help='.sca file(s) to read', nargs='+' if command is commands.choices['concat'] else 1)
+    args = parser.parse_args()
+
+    bone_names, bone_links, times, keys, position_delta, orient_delta = read(args.input[0])
+    if args.command == 'resample':
+        times, keys = scafile.resample(times, keys, args.fps)
+    elif args.command == 'trim':
+        times, keys = scafile.trim(times, keys, args.start, args.end)
+    elif args.command == 'loopfix':
+        keys = scafile.loop_fix(times, keys)
+    elif args.command == 'reduce':
+        keep = scafile.reduce_keyframes(times, keys, args.position_tolerance, args.angle_tolerance)
+        print("{}: kept {} of {} frames".format(args.input[0], len(keep), len(times)))
+        times, keys = times[keep], keys[keep]
+    elif args.command == 'concat':
+        animations = [ (bone_names, times, keys) ]
+        for filename in args.input[1:]:
+            names, _, more_times, more_keys, _, _ = read(filename)
+            animations.append((names, more_times, more_keys))
+        times, keys = scafile.concatenate(animations)
+
+    with open(args.output, 'wb') as file:
+        scafile.write_sca(file, bone_names, bone_links, times, keys, position_delta, orient_delta)
+    print("{}: {} frames, {:.3f}s".format(args.output, len(times), times[-1] - times[0]))
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except (OSError, ValueError) as e:
+        sys.exit("error: {}".format(e))
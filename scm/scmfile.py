@@ -0,0 +1,207 @@
+#**************************************************************************************************
+# Reader for Supreme Commander model (.scm) files.  Layout is described in ScmFile_format.h
+#
+# ScmFile maps a file (or wraps any buffer) and exposes its sections as numpy structured arrays that are
+# views of the mapping, so nothing is copied and pages are only read as they are touched:
+#
+#   with scm.scmfile.open_scm("UNITS/ARMCOM/ARMCOM_lod0.scm") as model:
+#       positions = model.vertices['mPosition']
+#
+# read_skeleton reads just the header and the NAME and SKEL sections, for tools that only want the bones.
+#**************************************************************************************************
+
+import mmap
+import numpy
+
+SCM_MAGIC = b'MODL'
+SCM_VERSION = 5
+
+SCM_HEADER_DTYPE = numpy.dtype([
+    ('mMagic', 'S4'),
+    ('mVersion', '<u4'),
+    ('mBoneOffset', '<u4'),
+    ('mWeightedBoneCount', '<u4'),
+    ('mVertexOffset', '<u4'),
+    ('mVertexExtraOffset', '<u4'),
+    ('mVertexCount', '<u4'),
+    ('mIndexOffset', '<u4'),
+    ('mIndexCount', '<u4'),
+    ('mInfoOffset', '<u4'),
+    ('mInfoCount', '<u4'),
+    ('mTotalBoneCount', '<u4')])
+
+SCM_BONE_DTYPE = numpy.dtype([
+    ('mRestPoseInverse', '<f4', (4,4)),
+    ('mPosition', '<f4', (3,)),
+    ('mRotation', '<f4', (4,)),
+    ('mNameOffset', '<u4'),
+    ('mParentBoneIndex', '<i4'),
+    ('RESERVED_0', '<u4'),
+    ('RESERVED_1', '<u4')])
+
+SCM_VERTEX_DTYPE = numpy.dtype([
+    ('mPosition', '<f4', (3,)),
+    ('mNormal', '<f4', (3,)),
+    ('mTangent', '<f4', (3,)),
+    ('mBinormal', '<f4', (3,)),
+    ('mUV0', '<f4', (2,)),
+    ('mUV1', '<f4', (2,)),
+    ('mBoneIndex', 'u1', (4,))])
+
+# VEXT is unused by SupCom 1.0.  read as dumpscm does
+SCM_VERTEX_EXTRA_DTYPE = numpy.dtype([
+    ('mUV', '<f4', (2,))])
+
+SCM_TRIANGLE_DTYPE = numpy.dtype([
+    ('triIndices', '<u2', (3,))])
+
+
+class ScmFormatError(ValueError):
+    pass
+
+
+def _check_header(header, size):
+    """ validate a header against a file of size bytes """
+
+    if header['mMagic'] != SCM_MAGIC:
+        raise ScmFormatError("not an SCM file")
+    if header['mVersion'] != SCM_VERSION:
+        raise ScmFormatError("unsupported SCM version {}".format(int(header['mVersion'])))
+    if header['mIndexCount'] % 3 != 0:
+        raise ScmFormatError("index count {} is not a whole number of triangles".format(int(header['mIndexCount'])))
+
+    for name,offset,count,itemsize in (
+            ("SKEL", header['mBoneOffset'], header['mTotalBoneCount'], SCM_BONE_DTYPE.itemsize),
+            ("VTXL", header['mVertexOffset'], header['mVertexCount'], SCM_VERTEX_DTYPE.itemsize),
+            ("VEXT", header['mVertexExtraOffset'], header['mVertexCount'], SCM_VERTEX_EXTRA_DTYPE.itemsize),
+            ("TRIS", header['mIndexOffset'], header['mIndexCount'] // 3, SCM_TRIANGLE_DTYPE.itemsize),
+            ("INFO", header['mInfoOffset'], header['mInfoCount'], 1)):
+        if offset == 0:
+            # omitted
+            continue
+        if offset < SCM_HEADER_DTYPE.itemsize or int(offset) + int(count)*itemsize > size:
+            raise ScmFormatError("{} section extends past the end of the file".format(name))
+
+
+def _bone_names(buffer, bones, base_offset=0):
+    """ names of bones, read from buffer, which holds the file from base_offset on """
+
+    names = []
+    for bone in bones:
+        start = int(bone['mNameOffset']) - base_offset
+        end = buffer.find(b'\0', start)
+        if start < 0 or end < 0:
+            raise ScmFormatError("bone name outside the NAME section")
+        try:
+            names.append(bytes(buffer[start:end]).decode('utf-8'))
+        except UnicodeDecodeError:
+            raise ScmFormatError("bone name is not valid utf-8")
+    return names
+
+
+class ScmFile:
+    """
+    The sections of an SCM file, as views of buffer (bytes, mmap, ...):
+      header     SCM_HEADER_DTYPE record
+      bones      SCM_BONE_DTYPE array
+      vertices   SCM_VERTEX_DTYPE array
+      extra      SCM_VERTEX_EXTRA_DTYPE array, or None if the file has no VEXT section
+      triangles  SCM_TRIANGLE_DTYPE array
+      info       memoryview of the INFO section's null terminated strings
+    """
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        view = memoryview(buffer).cast('B')
+        if len(view) < SCM_HEADER_DTYPE.itemsize:
+            raise ScmFormatError("file too short for an SCM header")
+
+        self.header = numpy.frombuffer(view, dtype=SCM_HEADER_DTYPE, count=1)[0]
+        _check_header(self.header, len(view))
+
+        def section(offset, dtype, count):
+            return numpy.frombuffer(view, dtype=dtype, count=int(count), offset=int(offset)) if offset else numpy.zeros(0, dtype=dtype)
+
+        header = self.header
+        self.bones = section(header['mBoneOffset'], SCM_BONE_DTYPE, header['mTotalBoneCount'])
+        self.vertices = section(header['mVertexOffset'], SCM_VERTEX_DTYPE, header['mVertexCount'])
+        self.extra = section(header['mVertexExtraOffset'], SCM_VERTEX_EXTRA_DTYPE, header['mVertexCount']) if header['mVertexExtraOffset'] else None
+        self.triangles = section(header['mIndexOffset'], SCM_TRIANGLE_DTYPE, header['mIndexCount'] // 3)
+        info_offset = int(header['mInfoOffset'])
+        self.info = view[info_offset:info_offset+int(header['mInfoCount'])] if info_offset else view[0:0]
+        self._view = view
+
+    def indices(self):
+        """ the triangles as an (n,3) array of vertex indices """
+        return self.triangles['triIndices']
+
+    def bone_names(self):
+        return _bone_names(self.buffer if hasattr(self.buffer, 'find') else bytes(self._view), self.bones)
+
+    def info_strings(self):
+        try:
+            return [ info.decode('ascii') for info in bytes(self.info).split(b'\0') if info ]
+        except UnicodeDecodeError:
+            raise ScmFormatError("INFO section is not ascii")
+
+    def close(self):
+        """
+        Release the file.  Arrays taken from this ScmFile are views of the mapping: if any are still alive, the
+        file stays mapped until they are released
+        """
+
+        self.header = self.bones = self.vertices = self.extra = self.triangles = self.info = None
+        try:
+            if self._view is not None:
+                self._view.release()
+                self._view = None
+            if isinstance(self.buffer, mmap.mmap):
+                self.buffer.close()
+        except BufferError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_scm(filename):
+    """ map filename read only.  returns an ScmFile, to be closed, or used in a with statement """
+
+    with open(filename, 'rb') as file:
+        try:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # an empty file can't be mapped
+            raise ScmFormatError("file too short for an SCM header")
+    # if the file isn't valid, the exception's traceback holds views of the mapping, so it can't be closed
+    # here.  it is unmapped when they are released
+    return ScmFile(buffer)
+
+
+def read_skeleton(file):
+    """
+    Read only the header and the NAME and SKEL sections from a binary file object (which must be seekable).
+    @return: (bone names, SCM_BONE_DTYPE array)
+    """
+
+    data = file.read(SCM_HEADER_DTYPE.itemsize)
+    if len(data) < SCM_HEADER_DTYPE.itemsize:
+        raise ScmFormatError("file too short for an SCM header")
+    header = numpy.frombuffer(data, dtype=SCM_HEADER_DTYPE, count=1)[0]
+    file.seek(0, 2)
+    _check_header(header, file.tell())
+
+    # NAME lies between the header and SKEL, so both sections come in a single read
+    start = SCM_HEADER_DTYPE.itemsize
+    bone_count = int(header['mTotalBoneCount'])
+    end = int(header['mBoneOffset']) + bone_count*SCM_BONE_DTYPE.itemsize
+    file.seek(start)
+    data = bytearray(end - start)
+    if file.readinto(data) < len(data):
+        raise ScmFormatError("truncated SCM file")
+
+    bones = numpy.frombuffer(data, dtype=SCM_BONE_DTYPE, count=bone_count, offset=int(header['mBoneOffset'])-start)
+    return _bone_names(data, bones, start), bones
@@ -56,13 +56,27 @@ from string import *
 from struct import *
 
 import binascii
+import collections
+import heapq
 import json
+import numpy
 import png
 import sys
+import time
 
-LOG_VERT = False
-LOG_BONE = False
 VERTEX_OPTIMIZE=True
+# grid size for epsilon welding of near-duplicate vertices. None welds exact matches only
+VERTEX_WELD_EPSILON=None
+# reorder triangles and vertices for the GPU's post-transform vertex cache, of VERTEX_CACHE_SIZE entries
+VERTEX_CACHE_OPTIMIZE=True
+VERTEX_CACHE_SIZE=16
+# triangle budget of each reduced level of detail written after lod0: _lod1.scm, _lod2.scm, ...  an int is a
+# number of triangles, a float a fraction of lod0's triangles.  eg [ 0.5, 0.25 ]
+LOD_TRIANGLE_BUDGETS=[]
+# also write each level's atlases at half the size of the level before's
+LOD_DOWNSCALE_ATLASES=False
+# weight of the planes that keep borders and uv seams in place when decimating, relative to the surface
+LOD_SEAM_WEIGHT=10.
 
 
 ######################################################
@@ -77,18 +91,6 @@ def cross(a, b):
     return c
 
 
-def mag(v):
-    return math.sqrt(v[0]*v[0] + v[1]*v[1] + v[2]*v[2])
-
-
-def normalize(v):
-    magv = mag(v)
-    if magv>0.:
-        return [ float(vi)/magv for vi in v ]
-    else:
-        return v
-
-
 class scm_bone :
 
     rest_pose = []
@@ -109,195 +111,7 @@ class scm_bone :
         self.name = name
 
 
-    def save(self, file):
-        bonestruct = '16f3f4f4i'
-        #bonestruct = '16f3f4f4L' #Deprecation warning L and mistyrious binary output
-        rp_inv = [0] * 16
-
-        icount = 0
-        for irow in range(4):
-            #rest pose_inv
-            for icol in range(4):
-                rp_inv[icount] = self.rest_pose_inv[irow][icol]
-                icount = icount + 1
-
-        bonedata = struct.pack(bonestruct,
-            rp_inv[0], rp_inv[1], rp_inv[2], rp_inv[3],
-            rp_inv[4], rp_inv[5], rp_inv[6], rp_inv[7],
-            rp_inv[8], rp_inv[9], rp_inv[10],rp_inv[11],
-            rp_inv[12],rp_inv[13],rp_inv[14],rp_inv[15],
-            self.position[0],self.position[1],self.position[2],
-            self.rotation[0],self.rotation[1],self.rotation[2],self.rotation[3], #Quaternion (w,x,y,z)#w,x,y,z
-            self.name_offset, self.parent_index,
-            0,0)
-
-
-        if LOG_BONE :
-            print(" %s rp_inv: [%.3f, %.3f, %.3f, %.3f],\t [%.3f, %.3f, %.3f, %.3f],\t [%.3f, %.3f, %.3f, %.3f],\t [%.3f, %.3f, %.3f, %.3f] \tpos: [%.3f, %.3f, %.3f] \trot: [%.3f, %.3f, %.3f, %.3f] %d"
-            % ( self.name, rp_inv[0], rp_inv[1], rp_inv[2], rp_inv[3],
-                rp_inv[4], rp_inv[5], rp_inv[6], rp_inv[7],
-                rp_inv[8], rp_inv[9], rp_inv[10],rp_inv[11],
-                rp_inv[12],rp_inv[13],rp_inv[14],rp_inv[15],
-                self.position[0],self.position[1],self.position[2],
-                self.rotation[0],self.rotation[1],self.rotation[2],self.rotation[3], self.parent_index))
-
-
-        file.write(bonedata)
-
-
-class scm_vertex :
-
-    position = []
-    tangent  = []
-    normal   = []
-    binormal = []
-    uvc = 0
-    uv1 = []
-    uv2 = []
-    bone_index = []
-
-    def __init__(self, pos , no , uv1, bone_index):
-
-        self.position = pos
-        self.normal   = no
-
-        #tangent and binormal wil be calculated by face
-        self.tangent  = [ 0, 0, 0 ]
-        self.binormal = [ 0, 0, 0 ]
-
-        self.uvc = 1
-        self.uv1 = uv1
-        self.uv2 = uv1# Vector(0,0) #uv1 #better results with copy ... strange, where is the use of that?
-
-        self.bone_index = bone_index
-
-
-    def save(self, file):
-
-        vertstruct = '3f3f3f3f2f2f4B'
-
-        #so finaly we can norm because here it is sure that no tang norm will be added
-        #self.normal = CrossVecs(self.tangent, self.binormal).normalize()
-        self.tangent = normalize(self.tangent)
-        self.binormal = normalize(self.binormal)
-        self.normal = normalize(self.normal)
-
-        if LOG_VERT :
-            print( " pos: [%.3f, %.3f, %.3f] \tn: [%.3f, %.3f, %.3f] \tt: [%.3f, %.3f, %.3f] \tb: [%.3f, %.3f, %.3f] \tuv [ %.3f, %.3f | %.3f, %.3f ] \tbi: [%d, %d, %d, %d]"
-
-            % (
-                self.position[0], self.position[1], self.position[2],
-                self.normal[0],   self.normal[1],   self.normal[2],
-                self.tangent[0],  self.tangent[1],  self.tangent[2],
-                self.binormal[0], self.binormal[1], self.binormal[2],
-                self.uv1[0], self.uv1[1],
-                self.uv2[0], self.uv2[1],
-                self.bone_index[0], self.bone_index[1],
-                self.bone_index[2], self.bone_index[3]) )
-
-        # so you store in this order:
-        # pos, normal, tangent, binormal, uv1, uv2, ibone
-        vertex = struct.pack(vertstruct,
-            self.position[0], self.position[1], self.position[2],
-            self.normal[0],   self.normal[1],   self.normal[2],
-            self.tangent[0],  self.tangent[1],  self.tangent[2],
-            self.binormal[0], self.binormal[1], self.binormal[2],
-            self.uv1[0], self.uv1[1],
-            self.uv2[0], self.uv2[1],
-            self.bone_index[0] or 0, self.bone_index[1] or 0,
-            self.bone_index[2] or 0, self.bone_index[3] or 0)
-
-
-        file.write(vertex)
-
-
-#helper the real scm face 'tupel is stored in mesh
-#quad face
-class qFace :
-
-        vertex_cont = []
-
-        def __init__(self):
-            self.vertex_cont = []
-
-        def addVert(self, vertex):
-            self.vertex_cont.extend( vertex )
-
-        def addToMesh(self, mesh):
-
-            face1 = Face()
-            face1.addVert([ self.vertex_cont[0], self.vertex_cont[1], self.vertex_cont[2] ])
-            face1.CalcTB()
-
-            face2 = Face()
-            face2.addVert([ self.vertex_cont[2], self.vertex_cont[3], self.vertex_cont[0] ])
-            face2.CalcTB()
-
-            mesh.addQFace(face1, face2)
-
-
-#helper the real scm face 'tupel is stored in mesh
-#tri face
-class Face :
-
-    vertex_cont = []
-
-    def __init__(self):
-        self.vertex_cont = []
-
-    def addVert(self, vertex):
-        self.vertex_cont.extend(vertex)
-
-    #now contains 3 vertexes calculate bi and ta and add to mesh
-
-    def CalcTB( self ) :
-        vert1 = self.vertex_cont[0]
-        vert2 = self.vertex_cont[1]
-        vert3 = self.vertex_cont[2]
-
-        uv = [ vert1.uv1, vert2.uv1, vert3.uv1]
-
-        # Calculate Tangent and Binormal
-        #       (v3 - v1).(p2 - p1) - (v2 - v1).(p3 - p1)
-        #   T  =  ------------------------------------------------
-        #       (u2 - u1).(v3 - v1) - (v2 - v1).(u3 - u1)
-        #       (u3 - u1).(p2 - p1) - (u2 - u1).(p3 - p1)
-        #   B  =  -------------------------------------------------
-        #       (v2 - v1).(u3 - u1) - (u2 - u1).(v3 - v1)
-
-        P2P1 = diff(vert2.position, vert1.position)
-        P3P1 = diff(vert3.position, vert1.position)
-
-        #UV2UV1 = [ uv[1][0]-uv[0][0], uv[1][1]-uv[0][1] ]
-        #UV3UV1 = [ uv[2][0]-uv[0][0], uv[2][1]-uv[0][1] ]
-
-        UV2UV1 = diff(uv[1], uv[0])
-        UV3UV1 = diff(uv[2], uv[0])
-        divide = (UV2UV1[1]*UV3UV1[0] - UV2UV1[0]*UV3UV1[1])
-
-        if ( divide != 0.0 ) :
-            tangent = [  UV3UV1[1]*p/divide - UV2UV1[1]*q/divide for p,q in zip(P2P1,P3P1) ]
-            binormal =[ -UV3UV1[0]*p/divide + UV2UV1[0]*q/divide for p,q in zip(P2P1,P3P1) ]
-            #tangent = Vector((UV3UV1[1]*P2P1 - UV2UV1[1]*P3P1)/(divide))
-            #binormal =Vector((UV3UV1[0]*P2P1 - UV2UV1[0]*P3P1)/(-divide))
-
-        else :
-            #print("Vertex-T-B divided through zero")
-            #print("  vert1.uv1:{}, vert2.uv1:{}, vert3.uv1:{}".format(vert1.uv1, vert2.uv1, vert3.uv1))
-            tangent = [0.,0.,0.]
-            binormal = [0.,0.,0.]
-
-        #add calculated tangent and binormal to vertices
-        for ind in range(3):
-            self.vertex_cont[ind].tangent = tangent
-            self.vertex_cont[ind].binormal =  binormal
-
-    def addToMesh( self, mesh ) :
-        self.CalcTB()
-        mesh.addFace( self )
-
-
-
+######################################################
 # Helper methods
 ######################################################
 
@@ -308,179 +122,203 @@ def pad(size):
 
     return val
 
-def pad_file(file, s4comment):
-    N = pad(file.tell()) - 4
+def padding(size, s4comment):
+    N = pad(size) - 4
     filldata = b'XXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXX'
-    padding = struct.pack(str(N)+'s4s', filldata[0:N], s4comment)
-
-    file.write(padding)
-
-    return file.tell()
+    return struct.pack(str(N)+'s4s', filldata[0:N], s4comment)
 
 #
 ######################################################
 
 
-class scm_mesh :
-
-    bones = []
-    vertices = []
-    vertcounter = 0
-    faces = []
-    info = []
-
-    def __init__(self):
-        self.bones = []
-        self.vertices = []
-        self.faces = []
-        self.info = []
-        self.vertcounter = 0
-
-    def _addVert( self, nvert ):
-        if VERTEX_OPTIMIZE :
-            #search for vertex already in list
-            vertind = 0
-            fiddleVertex = True
-            for vert in self.vertices :
-                if nvert.uv1 == vert.uv1 and nvert.position == vert.position :
-                    if nvert.bone_index == vert.bone_index:
-                        break   #found vert in list keep that index
-                    else:
-                        fiddleVertex = True
-                vertind += 1 #hmm not that one
-
-            if vertind == len(self.vertices):
-                if fiddleVertex:
-                    nvert = scm_vertex(
-                        [x+float(vertind)/100000. for x in nvert.position],
-                        nvert.normal, nvert.uv1, nvert.bone_index)
-                self.vertices.append(nvert)
-            else:
-                vert = self.vertices[vertind]
-
-                vert.tangent = [ t1+t2 for t1,t2 in zip(vert.tangent,nvert.tangent) ]
-                vert.binormal = [ b1+b2 for b1,b2 in zip(vert.binormal,nvert.binormal) ]
-                vert.normal = [ n1+n2 for n1,n2 in zip(vert.normal,nvert.normal) ]
-                self.vertices[vertind] = vert
-
-            return vertind
-        else:
-            self.vertices.append(nvert)
-            return len(self.vertices)-1
-
-    def addFace( self, face ):
-
-        facein = [ self._addVert(nvert) for nvert in face.vertex_cont]
-        self.faces.append(facein)
-
-    def addQFace( self, face1, face2):
-
-        facein = [ self._addVert(nvert) for nvert in face1.vertex_cont]
-        self.faces.append(facein)
-
-        facein = [ facein[2], self._addVert(face2.vertex_cont[1]), facein[0]]
-        self.faces.append(facein)
-
-
-    def save(self, filename):
-
-        scm = open(filename, 'wb')
-
-
-        #headerstruct = '12L' #Deprecation warning L and mistyrious binary output
-
-        headerstruct = '4s11I'
-        headersize = struct.calcsize(headerstruct)
-
-        #marker = 'MODL'
-        marker = b'MODL'
-        version = 5
-        boneoffset = 0
-        bonecount = 0
-        vertoffset = 0
-        extravertoffset = 0
-        vertcount = len(self.vertices)
-        indexoffset = 0
-        indexcount = len(self.faces) * 3
-        infooffset = 0
-        infosize = 0
-        totalbonecount = len(self.bones)
-
-
-
-        # Write dummy header
-        header = struct.pack(headerstruct + '',
-            marker, version, boneoffset, bonecount, vertoffset,
-            extravertoffset, vertcount, indexoffset, indexcount,
-            infooffset, infosize, totalbonecount)
-
-        scm.write(header)
-
+# SCM section records as NumPy structured arrays.  Layouts match scm/ScmFile_format.h
+SCM_HEADER_DTYPE = numpy.dtype([
+    ('mMagic', 'S4'),
+    ('mVersion', '<u4'),
+    ('mBoneOffset', '<u4'),
+    ('mWeightedBoneCount', '<u4'),
+    ('mVertexOffset', '<u4'),
+    ('mVertexExtraOffset', '<u4'),
+    ('mVertexCount', '<u4'),
+    ('mIndexOffset', '<u4'),
+    ('mIndexCount', '<u4'),
+    ('mInfoOffset', '<u4'),
+    ('mInfoCount', '<u4'),
+    ('mTotalBoneCount', '<u4')])
+
+SCM_BONE_DTYPE = numpy.dtype([
+    ('mRestPoseInverse', '<f4', (4,4)),
+    ('mPosition', '<f4', (3,)),
+    ('mRotation', '<f4', (4,)),
+    ('mNameOffset', '<u4'),
+    ('mParentBoneIndex', '<i4'),
+    ('RESERVED_0', '<u4'),
+    ('RESERVED_1', '<u4')])
+
+SCM_VERTEX_DTYPE = numpy.dtype([
+    ('mPosition', '<f4', (3,)),
+    ('mNormal', '<f4', (3,)),
+    ('mTangent', '<f4', (3,)),
+    ('mBinormal', '<f4', (3,)),
+    ('mUV0', '<f4', (2,)),
+    ('mUV1', '<f4', (2,)),
+    ('mBoneIndex', 'u1', (4,))])
+
+SCM_TRIANGLE_DTYPE = numpy.dtype([
+    ('triIndices', '<u2', (3,))])
+
+# triangles index vertices with 16 bits.  assigning larger indices to SCM_TRIANGLE_DTYPE would wrap silently
+SCM_MAX_VERTICES = 65535
 
-        # Write bone names
-        pad_file(scm, b'NAME')
-
-        for bone in self.bones:
-            bone.name_offset = scm.tell()
-            name = bone.name
-            buffer = struct.pack(str(len(name) + 1)+'s', name.encode('utf-8')) #bytearray(name,'ascii'))
-            scm.write(buffer)
-            #Log(buffer)
-
-        # Write bones
-        boneoffset = pad_file(scm, b'SKEL')
 
+class scm_mesh :
+    """
+    A model's bones, and its vertices as NumPy arrays with one row per vertex.  faces is an (n,3) array of
+    vertex indices.  vertcounter is the number of face vertices before welding
+    """
+
+    def __init__(self, bones, positions, normals, tangents, binormals, uv1, bone_index, faces, vertcounter):
+        self.bones = bones
+        self.positions = positions
+        self.normals = normals
+        self.tangents = tangents
+        self.binormals = binormals
+        self.uv1 = uv1
+        self.bone_index = bone_index
+        self.faces = faces
+        self.info = []
+        self.vertcounter = vertcounter
+
+    def dedupRatio( self ):
+        # fraction of incoming face vertices that were welded onto an existing vertex
+        if self.vertcounter == 0:
+            return 0.
+        return 1. - float(self.vertexCount()) / float(self.vertcounter)
+
+    def vertexCount( self ):
+        return len(self.positions)
+
+    def boneArray(self):
+        bones = numpy.zeros(len(self.bones), dtype=SCM_BONE_DTYPE)
+        for n,bone in enumerate(self.bones):
+            bones[n]['mRestPoseInverse'] = bone.rest_pose_inv
+            bones[n]['mPosition'] = bone.position
+            bones[n]['mRotation'] = bone.rotation   #Quaternion (w,x,y,z)
+            bones[n]['mNameOffset'] = bone.name_offset
+            bones[n]['mParentBoneIndex'] = bone.parent_index
+        return bones
+
+    def vertexArray(self):
+        vertices = numpy.zeros(len(self.positions), dtype=SCM_VERTEX_DTYPE)
+        vertices['mPosition'] = self.positions
+        vertices['mNormal'] = normalize_rows(self.normals)
+        vertices['mTangent'] = normalize_rows(self.tangents)
+        vertices['mBinormal'] = normalize_rows(self.binormals)
+        vertices['mUV0'] = self.uv1
+        vertices['mUV1'] = self.uv1
+        vertices['mBoneIndex'][:,0] = self.bone_index
+        return vertices
+
+    def faceArray(self):
+        faces = numpy.zeros(len(self.faces), dtype=SCM_TRIANGLE_DTYPE)
+        faces['triIndices'] = self.faces
+        return faces
+
+    def _permuteVertices(self, new_to_old):
+        self.positions = self.positions[new_to_old]
+        self.normals = self.normals[new_to_old]
+        self.tangents = self.tangents[new_to_old]
+        self.binormals = self.binormals[new_to_old]
+        self.uv1 = self.uv1[new_to_old]
+        self.bone_index = self.bone_index[new_to_old]
+
+    def optimizeVertexCache(self, cache_size=None):
+        """
+        Reorder the triangles for vertex cache reuse (tipsify), then the vertices in order of first use by
+        the reordered triangles.  Call once the mesh is complete: no faces may be added afterwards
+        @return: (acmr before, acmr after) for a FIFO cache of cache_size entries
+        """
+
+        cache_size = cache_size or VERTEX_CACHE_SIZE
+        faces = numpy.array(self.faces, dtype=numpy.int64).reshape(-1,3)
+        acmr_before = simulate_acmr(faces, cache_size)
+
+        faces = faces[tipsify(faces, self.vertexCount(), cache_size)]
+        new_to_old, old_to_new = first_use_order(faces, self.vertexCount())
+        self._permuteVertices(new_to_old)
+        faces = old_to_new[faces]
+        self.faces = faces
+
+        return acmr_before, simulate_acmr(faces, cache_size)
+
+    def decimated(self, max_triangles):
+        """ a copy of the mesh reduced to at most max_triangles triangles, as far as decimate_faces can """
+
+        faces = decimate_faces(self.positions, self.bone_index, self.faces, max_triangles)
+        used, faces = numpy.unique(faces, return_inverse=True)
+        return scm_mesh(self.bones,
+            self.positions[used], self.normals[used], self.tangents[used], self.binormals[used],
+            self.uv1[used], self.bone_index[used], faces.reshape(-1,3), len(used))
+
+    def sections(self):
+        """
+        Lay out the file and build each section.  Returns the list of byte buffers that make up the
+        file, in order: header, then each section preceded by its padding and FOURCC
+        """
+
+        if self.vertexCount() > SCM_MAX_VERTICES:
+            raise ValueError("{} vertices: an .scm can have at most {}".format(self.vertexCount(), SCM_MAX_VERTICES))
+
+        header = numpy.zeros(1, dtype=SCM_HEADER_DTYPE)
+        header['mMagic'] = b'MODL'
+        header['mVersion'] = 5
+        header['mVertexCount'] = self.vertexCount()
+        header['mIndexCount'] = len(self.faces) * 3
+        header['mTotalBoneCount'] = len(self.bones)
+
+        buffers = [ header ]
+        pos = header.nbytes
+
+        def add_section(s4comment, data):
+            nonlocal pos
+            section_padding = padding(pos, s4comment)
+            buffers.extend([section_padding, data])
+            pos += len(section_padding)
+            offset = pos
+            pos += len(data) if isinstance(data, bytes) else data.nbytes
+            return offset
+
+        # bone names
+        names = b''
+        nameoffset = pos + len(padding(pos, b'NAME'))
         for bone in self.bones:
-            bone.save(scm)
-            # if bone.used == True:
-            bonecount = bonecount + 1
-
-
-
-
-        # Write vertices
-        vertoffset = pad_file(scm, b'VTXL')
-
-        for vertex in self.vertices:
-            vertex.save(scm)
-
-
-
-        # Write Faces
-        indexoffset = pad_file(scm, b'TRIS')
-
-        for f in range(len(self.faces)):
-            face = struct.pack('3H', self.faces[f][0], self.faces[f][1], self.faces[f][2])
-            #face = struct.pack('3h', self.faces[f][0], self.faces[f][1], self.faces[f][2])
-            scm.write(face)
-
+            bone.name_offset = nameoffset + len(names)
+            names += bone.name.encode('utf-8') + b'\0'
+        add_section(b'NAME', names)
 
-        #print( "Bones: %d, Vertices: %d, Faces: %d; \n" % (bonecount, len(self.vertices), len(self.faces)))
+        header['mBoneOffset'] = add_section(b'SKEL', self.boneArray())
+        header['mWeightedBoneCount'] = len(self.bones)
+        header['mVertexOffset'] = add_section(b'VTXL', self.vertexArray())
+        header['mIndexOffset'] = add_section(b'TRIS', self.faceArray())
 
-        #Write Info
         if len(self.info) > 0:
+            info = b''.join(bytes(info,'ascii') + b'\0' for info in self.info)
+            header['mInfoOffset'] = add_section(b'INFO', info)
+            header['mInfoCount'] = len(info)
 
-            infooffset = pad_file(scm, b'INFO')
+        return buffers
 
-            for i in range(len(self.info)):
-                info = self.info[i]
-                infolen = len(info) + 1
-                buffer = struct.pack(str(infolen)+'s', bytearray(info,'ascii'))
-                scm.write(buffer)
+    def write(self, file):
+        # one write per section.  file need not be seekable, so can be eg a zip member or a socket
+        for buffer in self.sections():
+            file.write(buffer if isinstance(buffer, bytes) else buffer.tobytes())
 
-            infosize = scm.tell() - infooffset;
+    def tobytes(self):
+        return b''.join(buffer if isinstance(buffer, bytes) else buffer.tobytes() for buffer in self.sections())
 
-        # Now we can update the header
-        scm.seek(0, 0)
-
-        header = struct.pack(headerstruct,
-            marker, version, boneoffset, bonecount, vertoffset,
-            extravertoffset, vertcount, indexoffset, indexcount,
-            infooffset, infosize, totalbonecount)
-
-        scm.write(header)
-
-        scm.close()
+    def save(self, filename):
+        with open(filename, 'wb') as scm:
+            self.write(scm)
 
 
 
@@ -517,120 +355,629 @@ def diff(x1,x2):
     return [ u-v for u,v in zip(x1,x2) ]
 
 
-def get_face_normal(vert1, vert2, vert3, vert4=None):
-
-    if vert4 is None:
-        try_pairs = [
-            [diff(vert2,vert1),diff(vert3,vert2)],
-            [diff(vert3,vert2),diff(vert1,vert3)],
-            [diff(vert1,vert3),diff(vert2,vert1)] ]
-
-    else:
-        try_pairs = [
-            [diff(vert2,vert1),diff(vert3,vert2)],
-            [diff(vert3,vert2),diff(vert4,vert3)],
-            [diff(vert4,vert3),diff(vert1,vert4)],
-            [diff(vert1,vert4),diff(vert2,vert1)] ]
-
-    for u,v in try_pairs:
-        uxv = cross(u,v)
-        uvMag = mag(uxv)
-        uMag = mag(u)
-        vMag = mag(v)
-        if uvMag<=1e-3*uMag or uvMag<=1e-3*vMag:
-            continue
-
-        return [float(uxv[0])/uvMag, float(uxv[1])/uvMag, float(uxv[2])/uvMag]
-
-    return [0.,0.,1.]
-
-
-def get_obj_vertices_list(_3do_vertices, offset_position):
-    return [
-        [offset_position[0]+vertex['x'], offset_position[1]+vertex['y'], offset_position[2]+vertex['z']]
-        for vertex in _3do_vertices
-    ]
-
-
-def make_scm_face(object_vertex_list, face_vertex_indices, uvmin, uvmax, parent_bone_index):
+######################################################
+# Mesh builder.  Array operations over the whole model, rather than per facet and per vertex
+######################################################
 
-    umin,vmin = uvmin
-    umax,vmax = uvmax
+# per-corner uv selection (0=min, 1=max) for triangle and quad facets: v is flipped, so the first corner
+# takes (umin,vmax)
+TRI_UV_CORNERS = [[0,1], [1,1], [0,0]]
+QUAD_UV_CORNERS = [[0,1], [1,1], [1,0], [0,0]]
 
-    if len(face_vertex_indices) == 4:
-        new_scm_face = qFace()
-        uv_list = [[umin,vmax], [umax,vmax], [umax,vmin], [umin,vmin]]
 
-    elif len(face_vertex_indices) == 3:
-        new_scm_face = Face()
-        uv_list = [[umin,vmax], [umax,vmax], [umin,vmin]]
+def normalize_rows(v):
+    # zero length rows are returned unchanged
+    magv = numpy.sqrt(v[:,0]*v[:,0] + v[:,1]*v[:,1] + v[:,2]*v[:,2])
+    safe = numpy.where(magv>0., magv, 1.)
+    return numpy.where((magv>0.)[:,None], v / safe[:,None], v)
 
-    else:
-        raise ValueError("unexpected number of vertices in facet: {}".format(len(face_vertex_indices)))
 
-    normal = get_face_normal(*[object_vertex_list[i] for i in face_vertex_indices])
+def cross_rows(a, b):
+    return numpy.stack([
+        a[...,1]*b[...,2] - a[...,2]*b[...,1],
+        a[...,2]*b[...,0] - a[...,0]*b[...,2],
+        a[...,0]*b[...,1] - a[...,1]*b[...,0]], axis=-1)
 
-    scm_vertex_list = [
-        scm_vertex(object_vertex_list[idxVert], normal, uv, [parent_bone_index,0,0,0])
-        for idxVert,uv in zip(face_vertex_indices,uv_list) ]
 
-    new_scm_face.addVert(scm_vertex_list)
-    return new_scm_face
+def mag_rows(v):
+    return numpy.sqrt(v[...,0]*v[...,0] + v[...,1]*v[...,1] + v[...,2]*v[...,2])
 
 
-def recursive_count_faces(_3do_obj):
+def flatten_3do(_3do_obj):
+    """
+    Walk the 3DO hierarchy once, flattening all pieces into arrays.
+    Returns (bones, positions, prim_sizes, prim_vertices, prim_bone, uvmin, uvmax) where positions are
+    the mesh-relative positions of every vertex of every piece and prim_vertices is the concatenation
+    of each primitive's vertex indices into positions
+    """
 
-    this_object_face_count = len(_3do_obj["primitives"])
-    children_face_count = [ recursive_count_faces(_3do_child) for _3do_child in _3do_obj["children"] ]
-    return sum(children_face_count) + this_object_face_count
+    bones = []
+    positions = []
+    prim_sizes = []
+    prim_vertices = []
+    prim_bone = []
+    uvmin = []
+    uvmax = []
+
+    def recurse(_3do_obj, parent_bone, parent_bone_index):
+        bone_index = len(bones)
+        bone = make_scm_bone(_3do_obj, parent_bone, parent_bone_index)
+        bones.append(bone)
+
+        vertex_base = len(positions)
+        offset_position = [ -x for x in bone.rest_pose_inv[-1][0:3] ]
+        positions.extend(
+            [offset_position[0]+vertex['x'], offset_position[1]+vertex['y'], offset_position[2]+vertex['z']]
+            for vertex in _3do_obj["vertices"])
+
+        for _3do_primitive in _3do_obj["primitives"]:
+            vertex_indices = _3do_primitive["vertices"]
+            prim_sizes.append(len(vertex_indices))
+            prim_vertices.extend(vertex_base + idx for idx in vertex_indices)
+            prim_bone.append(bone_index)
+            uvmin.append(_3do_primitive["uvmin"])
+            uvmax.append(_3do_primitive["uvmax"])
 
+        for _3do_child in _3do_obj["children"]:
+            recurse(_3do_child, bone, bone_index)
 
-def nfacet_to_quads_and_triangles(vertex_indices, new_facets=[]):
+    recurse(_3do_obj, None, -1)
 
-    if len(vertex_indices)>4:
-        quad = [ vertex_indices[n] for n in (0,1,2,-1) ]
-        new_facets = new_facets + [quad]
-        return nfacet_to_quads_and_triangles(vertex_indices[2:], new_facets)
+    return (bones,
+        numpy.array(positions, dtype=numpy.float64).reshape(-1,3),
+        numpy.array(prim_sizes, dtype=numpy.int64),
+        numpy.array(prim_vertices, dtype=numpy.int64),
+        numpy.array(prim_bone, dtype=numpy.int64),
+        numpy.array(uvmin, dtype=numpy.float64).reshape(-1,2),
+        numpy.array(uvmax, dtype=numpy.float64).reshape(-1,2))
 
-    elif len(vertex_indices)>=3:
-        return new_facets + [ vertex_indices ]
 
-    else:
-        return new_facets
+def flatten_3do_arrays(model, root_name=None):
+    """
+    flatten_3do for a model read by binary_3do.load: builds the same arrays straight from the converter's
+    piece, vertex, primitive and index sections, applying recursive_coordinate_transform on the way
+    """
 
+    pieces = model["pieces"]
+    scale = numpy.array([2.5, 2.5, -2.5]) * 65536.
 
-def recursive_append_3do(scm_mesh, _3do_obj, parent_bone, parent_bone_index):
+    bones = []
+    for n,piece in enumerate(pieces):
+        x,y,z = (piece['mPosition'] / scale).tolist()
+        start = int(piece['mNameOffset'])
+        name = bytes(model["names"][start:start+int(piece['mNameLength'])]).decode('utf-8')
+        if n == 0 and root_name is not None:
+            name = root_name
+        parent_index = int(piece['mParentIndex'])
+        parent_bone = bones[parent_index] if parent_index >= 0 else None
+        bones.append(make_scm_bone({ "x": x, "y": y, "z": z, "name": name }, parent_bone, parent_index))
+
+    abs_positions = numpy.array([ [ -x for x in bone.rest_pose_inv[-1][0:3] ] for bone in bones ], dtype=numpy.float64).reshape(-1,3)
+    vertex_piece = numpy.repeat(numpy.arange(len(pieces)), pieces['mNumVertices'])
+    positions = model["vertices"]['mPosition'] / scale + abs_positions[vertex_piece]
+
+    primitives = model["primitives"]
+    prim_sizes = primitives['mNumIndices'].astype(numpy.int64)
+    prim_bone = numpy.repeat(numpy.arange(len(pieces)), pieces['mNumPrimitives'])
+
+    # primitive vertex lists, reversed as recursive_coordinate_transform does and offset to the piece's first vertex
+    index_prim = numpy.repeat(numpy.arange(len(primitives)), prim_sizes)
+    index_in_prim = numpy.arange(len(index_prim)) - (numpy.cumsum(prim_sizes) - prim_sizes)[index_prim]
+    reversed_index = primitives['mFirstIndex'].astype(numpy.int64)[index_prim] + prim_sizes[index_prim] - 1 - index_in_prim
+    prim_vertices = model["indices"][reversed_index].astype(numpy.int64) + pieces['mFirstVertex'].astype(numpy.int64)[prim_bone[index_prim]]
+
+    return (bones, positions, prim_sizes, prim_vertices, prim_bone,
+        primitives['mUVMin'].copy(), primitives['mUVMax'].copy())
+
+
+def fan_triangulate(prim_sizes, prim_vertices):
+    """
+    Splits every n-gon into a fan of quads around its last vertex, closed by a final quad or triangle.  Primitives with fewer than 3 vertices are dropped.
+    Returns facets (n,4) with -1 in the last column of triangles, and the index of each facet's primitive.
+    Facets are in primitive order
+    """
+
+    prim_start = numpy.cumsum(prim_sizes) - prim_sizes
+    facets = []
+    facet_prim = []
+    facet_seq = []
+
+    for n in numpy.unique(prim_sizes):
+        if n < 3:
+            continue
+        prims = numpy.nonzero(prim_sizes == n)[0]
+        corners = prim_vertices[prim_start[prims][:,None] + numpy.arange(n)]
+
+        num_quads = max(0, (int(n)-3)//2)
+        for k in range(num_quads):
+            facets.append(corners[:, [2*k, 2*k+1, 2*k+2, n-1]])
+            facet_prim.append(prims)
+            facet_seq.append(numpy.full(len(prims), k))
+
+        last = corners[:, 2*num_quads:]
+        if last.shape[1] == 3:
+            last = numpy.concatenate([last, numpy.full((len(prims),1), -1)], axis=1)
+        facets.append(last)
+        facet_prim.append(prims)
+        facet_seq.append(numpy.full(len(prims), num_quads))
+
+    if len(facets) == 0:
+        return numpy.zeros((0,4), dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+
+    facets = numpy.concatenate(facets)
+    facet_prim = numpy.concatenate(facet_prim)
+    facet_seq = numpy.concatenate(facet_seq)
+    order = numpy.lexsort((facet_seq, facet_prim))
+    return facets[order], facet_prim[order]
+
+
+def get_face_normals(positions, facets):
+    """
+    For each facet, the normal from the first pair of consecutive edges that is not degenerate, or [0,0,1]
+    """
+
+    is_tri = facets[:,3] < 0
+    num_corners = numpy.where(is_tri, 3, 4)
+    corner = numpy.arange(4)
+    next_corner = (corner[None,:] + 1) % num_corners[:,None]
+
+    rows = numpy.arange(len(facets))[:,None]
+    points = positions[numpy.where(facets<0, facets[:,:1], facets)]
+    edges = points[rows, next_corner] - points
+
+    u = edges
+    v = edges[rows, next_corner]
+    uxv = cross_rows(u, v)
+    uvMag = mag_rows(uxv)
+    valid = ~((uvMag <= 1e-3*mag_rows(u)) | (uvMag <= 1e-3*mag_rows(v)))
+    valid &= corner[None,:] < num_corners[:,None]
+
+    first = numpy.argmax(valid, axis=1)
+    found = valid[rows[:,0], first]
+    uxv = uxv[rows[:,0], first]
+    uvMag = numpy.where(found, uvMag[rows[:,0], first], 1.)
+    normals = uxv / uvMag[:,None]
+    normals[~found] = [0.,0.,1.]
+    return normals
+
+
+def get_tangents_binormals(p1, p2, p3, uv1, uv2, uv3):
+    """
+    Tangent and binormal of each row of triangle corner positions and uvs, or zero where the uvs are degenerate
+    """
+
+    P2P1 = p2 - p1
+    P3P1 = p3 - p1
+    UV2UV1 = uv2 - uv1
+    UV3UV1 = uv3 - uv1
+    divide = UV2UV1[:,1]*UV3UV1[:,0] - UV2UV1[:,0]*UV3UV1[:,1]
+
+    nonzero = divide != 0.
+    d = numpy.where(nonzero, divide, 1.)[:,None]
+    tangent = UV3UV1[:,1:2]*P2P1/d - UV2UV1[:,1:2]*P3P1/d
+    binormal = -UV3UV1[:,0:1]*P2P1/d + UV2UV1[:,0:1]*P3P1/d
+    tangent[~nonzero] = 0.
+    binormal[~nonzero] = 0.
+    return tangent, binormal
+
+
+def unique_rows(keys):
+    """
+    Group identical rows of keys.  Returns (row of first appearance per group, group index per row).
+    Groups are numbered in sort order
+    """
+
+    order = numpy.lexsort(keys.T[::-1])
+    sorted_keys = keys[order]
+    new_group = numpy.ones(len(keys), dtype=bool)
+    new_group[1:] = (sorted_keys[1:] != sorted_keys[:-1]).any(axis=1)
+
+    inverse = numpy.empty(len(keys), dtype=numpy.int64)
+    inverse[order] = numpy.cumsum(new_group) - 1
+    # lexsort is stable, so the first row of each group in sort order is its first appearance
+    return order[new_group], inverse
+
+
+def weld_vertices(keys, weld_positions_uvs):
+    """
+    Assign a vertex index to each row of keys, in order of first appearance.
+    Returns (vertex index per row, row of first appearance per vertex, whether each vertex shares its
+    position/uv key with an earlier vertex)
+    """
+
+    first_row, inverse = unique_rows(keys)
+    order = numpy.argsort(first_row)
+    rank = numpy.empty_like(order)
+    rank[order] = numpy.arange(len(order))
+    first_row = first_row[order]
+
+    first_vertex, position_uv_group = unique_rows(weld_positions_uvs[first_row])
+    coincident = first_vertex[position_uv_group] < numpy.arange(len(first_row))
+
+    return rank[inverse], first_row, coincident
+
+
+def make_scm_flattened(flattened, weld_epsilon=None):
+    """
+    Build an scm_mesh from the arrays returned by flatten_3do or flatten_3do_arrays
+    """
+
+    bones, positions, prim_sizes, prim_vertices, prim_bone, uvmin, uvmax = flattened
+    facets, facet_prim = fan_triangulate(prim_sizes, prim_vertices)
+
+    is_tri = facets[:,3] < 0
+    facet_normals = get_face_normals(positions, facets)
+    facet_uvmin = uvmin[facet_prim]
+    facet_uvmax = uvmax[facet_prim]
+
+    # per-corner uvs
+    uv_select = numpy.where(is_tri[:,None,None],
+        numpy.array(TRI_UV_CORNERS + [[0,0]]), numpy.array(QUAD_UV_CORNERS))
+    corner_uvs = numpy.where(uv_select==1, facet_uvmax[:,None,:], facet_uvmin[:,None,:])
+    corner_positions = positions[numpy.where(facets<0, facets[:,:1], facets)]
+
+    # tangents and binormals.  quads are split as (0,1,2),(2,3,0); corners shared by both triangles take
+    # the second triangle's tangent and binormal
+    t1, b1 = get_tangents_binormals(
+        corner_positions[:,0], corner_positions[:,1], corner_positions[:,2],
+        corner_uvs[:,0], corner_uvs[:,1], corner_uvs[:,2])
+    t2, b2 = get_tangents_binormals(
+        corner_positions[:,2], corner_positions[:,3], corner_positions[:,0],
+        corner_uvs[:,2], corner_uvs[:,3], corner_uvs[:,0])
+    use_first = is_tri[:,None] | (numpy.arange(4) == 1)[None,:]
+    corner_tangents = numpy.where(use_first[:,:,None], t1[:,None,:], t2[:,None,:])
+    corner_binormals = numpy.where(use_first[:,:,None], b1[:,None,:], b2[:,None,:])
+
+    # flatten to the stream of face vertices: each facet's corners in order, a quad's fourth corner last
+    valid = facets >= 0
+    stream_positions = corner_positions[valid]
+    stream_uvs = corner_uvs[valid]
+    stream_normals = numpy.broadcast_to(facet_normals[:,None,:], corner_positions.shape)[valid]
+    stream_tangents = corner_tangents[valid]
+    stream_binormals = corner_binormals[valid]
+    stream_bones = numpy.broadcast_to(prim_bone[facet_prim][:,None], facets.shape)[valid]
+
+    stream_index = numpy.cumsum(valid.reshape(-1)).reshape(facets.shape) - 1
+    tris = stream_index[is_tri][:,0:3]
+    quads = stream_index[~is_tri]
+    triangles_per_facet = numpy.where(is_tri, 1, 2)
+    first_triangle = numpy.cumsum(triangles_per_facet) - triangles_per_facet
+    triangles = numpy.empty((len(facets)+len(quads),3), dtype=numpy.int64)
+    triangles[first_triangle[is_tri]] = tris
+    triangles[first_triangle[~is_tri]] = quads[:,0:3]
+    triangles[first_triangle[~is_tri]+1] = quads[:,[2,3,0]]
+
+    vertcounter = len(stream_positions)
+    if VERTEX_OPTIMIZE and vertcounter > 0:
+        weld_epsilon = weld_epsilon if weld_epsilon is not None else VERTEX_WELD_EPSILON
+        if weld_epsilon:
+            position_uv = numpy.round(numpy.concatenate([stream_positions, stream_uvs], axis=1) / weld_epsilon)
+        else:
+            # +0. folds -0. onto 0., so that they weld as they compare equal
+            position_uv = numpy.concatenate([stream_positions, stream_uvs], axis=1) + 0.
+        keys = numpy.concatenate([position_uv, stream_bones[:,None]], axis=1)
+
+        vertex_of_stream, first_stream, coincident = weld_vertices(keys, position_uv)
+
+        vert_positions = stream_positions[first_stream].copy()
+        vert_positions[coincident] += numpy.nonzero(coincident)[0][:,None] / 100000.
+
+        merged = numpy.ones(vertcounter, dtype=bool)
+        merged[first_stream] = False
+        accumulated = []
+        for values in (stream_normals, stream_tangents, stream_binormals):
+            acc = values[first_stream].copy()
+            numpy.add.at(acc, vertex_of_stream[merged], values[merged])
+            accumulated.append(acc)
+
+        return scm_mesh(bones,
+            vert_positions, accumulated[0], accumulated[1], accumulated[2],
+            stream_uvs[first_stream], stream_bones[first_stream],
+            vertex_of_stream[triangles], vertcounter)
+
+    return scm_mesh(bones,
+        stream_positions, stream_normals.copy(), stream_tangents, stream_binormals,
+        stream_uvs, stream_bones, triangles, vertcounter)
+
+
+def make_scm(_3do_obj, weld_epsilon=None):
+    """ Build an scm_mesh from a 3DO hierarchy """
+
+    return make_scm_flattened(flatten_3do(_3do_obj), weld_epsilon)
+
+
+def simulate_acmr(faces, cache_size):
+    """
+    Average cache miss ratio: vertices transformed per triangle drawing faces, an (n,3) array of vertex
+    indices, through a FIFO post-transform cache of cache_size entries.  0.5 is about the best possible
+    for a regular mesh, 3 the worst
+    """
+
+    if len(faces) == 0:
+        return 0.
+
+    fifo = collections.deque()
+    cached = set()
+    misses = 0
+    for v in faces.ravel().tolist():
+        if v not in cached:
+            misses += 1
+            if len(fifo) == cache_size:
+                cached.discard(fifo.popleft())
+            fifo.append(v)
+            cached.add(v)
+    return float(misses) / len(faces)
+
+
+def tipsify(faces, num_vertices, cache_size):
+    """
+    Triangle order for vertex cache reuse, from Sander, Nehab and Barczak, "Fast Triangle Reordering for
+    Vertex Locality and Reduced Overdraw" (SIGGRAPH 2007).  Linear in the number of triangles.
+    @param faces: (n,3) array of vertex indices
+    @return: array of indices into faces, in the order they should be drawn
+    """
+
+    num_faces = len(faces)
+    if num_faces == 0:
+        return numpy.zeros(0, dtype=numpy.int64)
+
+    # triangles using each vertex: adjacency[offsets[v]:offsets[v+1]]
+    flat = faces.ravel()
+    adjacency = (numpy.argsort(flat, kind='stable') // 3).tolist()
+    counts = numpy.bincount(flat, minlength=num_vertices)
+    offsets = numpy.concatenate(([0], numpy.cumsum(counts))).tolist()
+
+    face_list = faces.tolist()
+    live = counts.tolist()              # uses of each vertex by triangles not yet emitted
+    cache_time = [0] * num_vertices     # time each vertex last entered the cache
+    emitted = [False] * num_faces
+    dead_end = []                       # recently used vertices, to restart from when stuck
+    output = []
+    time_stamp = cache_size + 1
+    cursor = 0                          # vertices before this have no live triangles
+
+    fanning = int(numpy.argmax(counts > 0))
+    while fanning >= 0:
+        candidates = []
+        for t in adjacency[offsets[fanning]:offsets[fanning+1]]:
+            if emitted[t]:
+                continue
+            for v in face_list[t]:
+                dead_end.append(v)
+                candidates.append(v)
+                live[v] -= 1
+                if time_stamp - cache_time[v] > cache_size:
+                    cache_time[v] = time_stamp
+                    time_stamp += 1
+            emitted[t] = True
+            output.append(t)
+
+        # next fanning vertex: the candidate longest in the cache that will still be there once its
+        # remaining triangles are emitted
+        fanning = -1
+        best = -1
+        for v in candidates:
+            if live[v] > 0:
+                age = time_stamp - cache_time[v]
+                priority = age if age + 2*live[v] <= cache_size else 0
+                if priority > best:
+                    best = priority
+                    fanning = v
+
+        if fanning < 0:
+            while dead_end:
+                v = dead_end.pop()
+                if live[v] > 0:
+                    fanning = v
+                    break
+        if fanning < 0:
+            while cursor < num_vertices and live[cursor] == 0:
+                cursor += 1
+            if cursor < num_vertices:
+                fanning = cursor
+
+    return numpy.array(output, dtype=numpy.int64)
+
+
+def first_use_order(faces, num_vertices):
+    """
+    Vertex order in which faces first uses each vertex.  Unused vertices go last, in their original order.
+    @return: (old index per new index, new index per old index)
+    """
+
+    used, first_use = numpy.unique(faces.ravel(), return_index=True)
+    unused = numpy.setdiff1d(numpy.arange(num_vertices), used)
+    new_to_old = numpy.concatenate((used[numpy.argsort(first_use)], unused)).astype(numpy.int64)
+    old_to_new = numpy.empty(num_vertices, dtype=numpy.int64)
+    old_to_new[new_to_old] = numpy.arange(num_vertices)
+    return new_to_old, old_to_new
+
+
+def decimate_faces(positions, bone_index, faces, max_triangles):
+    """
+    Quadric error mesh simplification (Garland and Heckbert, "Surface Simplification Using Quadric Error
+    Metrics", SIGGRAPH 1997) by half edge collapses, until at most max_triangles remain or no collapse is
+    possible.  A vertex only ever moves onto a neighbour, keeping the neighbour's uv, and vertices of
+    different bones are never merged.  Borders and uv seams are kept: a vertex on one may only collapse along
+    it, and a vertex where they meet or branch never moves
+    @param positions: (n,3) array of vertex positions
+    @param bone_index: bone of each vertex
+    @param faces: (m,3) array of vertex indices
+    @return: (k,3) array of vertex indices, the faces that remain with collapsed vertices replaced
+    """
+
+    faces = numpy.asarray(faces, dtype=numpy.int64).reshape(-1,3)
+    if len(faces) <= max_triangles:
+        return faces
+
+    # points: vertices at the same position on the same bone, such as those either side of a uv seam
+    keys = numpy.concatenate([numpy.asarray(positions, dtype=numpy.float64) + 0., numpy.asarray(bone_index)[:,None]], axis=1)
+    _, point_of_vertex = unique_rows(keys)
+    num_points = int(point_of_vertex.max()) + 1
+    point_positions = numpy.zeros((num_points,3))
+    point_positions[point_of_vertex] = positions
+    face_points = point_of_vertex[faces]
+
+    # fundamental error quadric of each face's plane, weighted by area
+    p0, p1, p2 = (point_positions[face_points[:,n]] for n in range(3))
+    normals = cross_rows(p1-p0, p2-p0)
+    areas = mag_rows(normals) / 2.
+    normals = normals / numpy.maximum(2.*areas, 1e-30)[:,None]
+    planes = numpy.concatenate([normals, -(normals*p0).sum(axis=1)[:,None]], axis=1)
+    face_quadrics = areas[:,None,None] * planes[:,:,None] * planes[:,None,:]
+    quadrics = numpy.zeros((num_points,4,4))
+    for n in range(3):
+        numpy.add.at(quadrics, face_points[:,n], face_quadrics)
+
+    tri_vertices = faces.tolist()
+    tri_points = face_points.tolist()
+    alive = [ len(set(tri)) == 3 for tri in tri_points ]
+    point_tris = [ set() for _ in range(num_points) ]
+    edge_tris = { }
+    for tri,(points,live) in enumerate(zip(tri_points, alive)):
+        if live:
+            for n in range(3):
+                point_tris[points[n]].add(tri)
+                edge_tris.setdefault(frozenset((points[n], points[n-2])), []).append(tri)
+
+    def vertex_at(tri, point):
+        return tri_vertices[tri][tri_points[tri].index(point)]
+
+    # border and seam edges, and the constraint planes that hold them in place
+    seam_neighbours = [ set() for _ in range(num_points) ]
+    locked = [ False ] * num_points
+    for edge,tris in edge_tris.items():
+        a, b = edge
+        if len(tris) == 2 and all(vertex_at(tris[0], p) == vertex_at(tris[1], p) for p in edge):
+            continue
+        if len(tris) > 2:
+            locked[a] = locked[b] = True
+        seam_neighbours[a].add(b)
+        seam_neighbours[b].add(a)
+        direction = point_positions[b] - point_positions[a]
+        normal = cross_rows(direction, normals[tris[0]])
+        length = mag_rows(normal)
+        if length > 0:
+            normal /= length
+            plane = numpy.append(normal, -numpy.dot(normal, point_positions[a]))
+            quadric = LOD_SEAM_WEIGHT * numpy.dot(direction, direction) * numpy.outer(plane, plane)
+            quadrics[a] += quadric
+            quadrics[b] += quadric
+    for point,neighbours in enumerate(seam_neighbours):
+        if len(neighbours) not in (0, 2):
+            locked[point] = True
+
+    def neighbours(point):
+        return { p for tri in point_tris[point] for p in tri_points[tri] } - { point }
+
+    homogeneous = numpy.concatenate([point_positions, numpy.ones((num_points,1))], axis=1)
+    corner_positions = point_positions.tolist()
+
+    def collapse_cost(u, t):
+        return float(homogeneous[t] @ (quadrics[u] + quadrics[t]) @ homogeneous[t])
+
+    def may_collapse(u, t):
+        return not locked[u] and (not seam_neighbours[u] or t in seam_neighbours[u])
+
+    def vertex_map_for_collapse(u, t):
+        """ which vertex of t replaces each vertex of u, or None if u may not collapse onto t """
+
+        shared = point_tris[u] & point_tris[t]
+        # link condition: only the faces on the edge lose it, or the mesh pinches
+        if len(neighbours(u) & neighbours(t)) != len(shared):
+            return None
+        if seam_neighbours[u] and not locked[t] and len((seam_neighbours[t] | seam_neighbours[u]) - { u, t }) != 2:
+            return None
+
+        vertex_map = { }
+        for tri in shared:
+            if vertex_map.setdefault(vertex_at(tri, u), vertex_at(tri, t)) != vertex_at(tri, t):
+                return None
+        for tri in point_tris[u] - shared:
+            if vertex_at(tri, u) not in vertex_map:
+                return None
+            # no face may turn over
+            corners = [ corner_positions[p] for p in tri_points[tri] ]
+            before = cross(diff(corners[1], corners[0]), diff(corners[2], corners[0]))
+            corners[tri_points[tri].index(u)] = corner_positions[t]
+            after = cross(diff(corners[1], corners[0]), diff(corners[2], corners[0]))
+            if sum(b*a for b,a in zip(before, after)) <= 0.:
+                return None
+        return vertex_map
+
+    stamps = [ 0 ] * num_points
+    heap = []
+    def push(u, t):
+        if may_collapse(u, t):
+            heapq.heappush(heap, (collapse_cost(u, t), u, t, stamps[u], stamps[t]))
+
+    edges = numpy.array([ tuple(edge) for edge in edge_tris ], dtype=numpy.int64).reshape(-1,2)
+    us = numpy.concatenate([edges[:,0], edges[:,1]]).tolist()
+    ts = numpy.concatenate([edges[:,1], edges[:,0]]).tolist()
+    candidates = [ (u, t) for u,t in zip(us, ts) if may_collapse(u, t) ]
+    if candidates:
+        us, ts = numpy.array(candidates).T
+        costs = numpy.einsum('ni,nij,nj->n', homogeneous[ts], quadrics[us] + quadrics[ts], homogeneous[ts])
+        heap = [ (cost, u, t, 0, 0) for cost,u,t in zip(costs.tolist(), us.tolist(), ts.tolist()) ]
+        heapq.heapify(heap)
+
+    num_alive = sum(alive)
+    while num_alive > max_triangles and heap:
+        _, u, t, stamp_u, stamp_t = heapq.heappop(heap)
+        if stamps[u] != stamp_u or stamps[t] != stamp_t or not point_tris[u]:
+            continue
+        vertex_map = vertex_map_for_collapse(u, t)
+        if vertex_map is None:
+            continue
 
-    new_bone_index = len(scm_mesh.bones)
-    new_scm_bone = make_scm_bone(_3do_obj, parent_bone, parent_bone_index)
-    scm_mesh.bones.append(new_scm_bone)
+        for tri in list(point_tris[u]):
+            points = tri_points[tri]
+            if t in points:
+                alive[tri] = False
+                num_alive -= 1
+                for p in points:
+                    point_tris[p].discard(tri)
+            else:
+                n = points.index(u)
+                points[n] = t
+                tri_vertices[tri][n] = vertex_map[tri_vertices[tri][n]]
+                point_tris[t].add(tri)
+        point_tris[u] = set()
 
-    vertex_list = get_obj_vertices_list(_3do_obj["vertices"], [-x for x in new_scm_bone.rest_pose_inv[-1][0:3]])
+        quadrics[t] += quadrics[u]
+        if seam_neighbours[u]:
+            seam_neighbours[t] = (seam_neighbours[t] | seam_neighbours[u]) - { u, t }
+            for p in seam_neighbours[u] - { t }:
+                seam_neighbours[p].discard(u)
+                seam_neighbours[p].add(t)
 
-    for _3do_primitive in _3do_obj["primitives"]:
-        try:
-            vertex_indices = _3do_primitive["vertices"]
-            uvmin = _3do_primitive["uvmin"]
-            uvmax = _3do_primitive["uvmax"]
+        stamps[t] += 1
+        for p in neighbours(t):
+            push(p, t)
+            push(t, p)
 
-            for facet in nfacet_to_quads_and_triangles(vertex_indices):
-                new_scm_face = make_scm_face(vertex_list, facet, uvmin, uvmax, new_bone_index)
-                new_scm_face.addToMesh(scm_mesh)
+    return numpy.array([ vertices for vertices,live in zip(tri_vertices, alive) if live ], dtype=numpy.int64).reshape(-1,3)
 
-        except ValueError as e:
-            print(repr(e))
 
-    for _3do_child in _3do_obj["children"]:
-        recursive_append_3do(scm_mesh, _3do_child, new_scm_bone, new_bone_index)
+def lod_triangle_budget(budget, lod0_triangles):
+    # an int is a number of triangles, a float a fraction of lod0's
+    return budget if isinstance(budget, int) else int(budget * lod0_triangles)
 
 
-def make_scm(_3do_obj):
+def downscale_atlas(data, tex_dims):
+    """
+    Halve an rgba atlas in each dimension by averaging blocks of 2x2 pixels.  Odd dimensions are rounded up.
+    @return: (atlas, its dimensions)
+    """
 
-    total_face_count = recursive_count_faces(_3do_obj)
-    tileDimension = int(0.5+math.sqrt(total_face_count))
-    supcom_mesh = scm_mesh()
-    recursive_append_3do(supcom_mesh, _3do_obj, None, -1)
-    return supcom_mesh
+    w, h = tex_dims
+    pixels = numpy.frombuffer(data, dtype=numpy.uint8, count=w*h*4).reshape(h,w,4).astype(numpy.uint16)
+    if h % 2:
+        pixels = numpy.concatenate([pixels, pixels[-1:]], axis=0)
+    if w % 2:
+        pixels = numpy.concatenate([pixels, pixels[:,-1:]], axis=1)
+    pixels = pixels[0::2,0::2] + pixels[0::2,1::2] + pixels[1::2,0::2] + pixels[1::2,1::2]
+    return ((pixels + 2) // 4).astype(numpy.uint8).tobytes(), [ (w+1)//2, (h+1)//2 ]
 
 
 def recursive_coordinate_transform(_3do_obj):
@@ -666,29 +1013,141 @@ def save_png(filename, data, tex_dims):
         w.write(file, rows)
 
 
-def export(_3do_data):
+class stage_timer:
+    """
+    Context manager adding the wall and cpu time of its block to stages[name], a dictionary
+    { "wall_s": seconds, "cpu_s": seconds }.  Does nothing if stages is None
+    """
+
+    def __init__(self, stages, name):
+        self.stages = stages
+        self.name = name
+
+    def __enter__(self):
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.stages is not None:
+            stage = self.stages.setdefault(self.name, { "wall_s": 0.0, "cpu_s": 0.0 })
+            stage["wall_s"] += time.perf_counter() - self.wall_start
+            stage["cpu_s"] += time.process_time() - self.cpu_start
+
+
+def export(_3do_data, output_dir=".", metrics=None, lod_budgets=None, lod_atlases=None):
+    """
+    @param _3do_data: { unitname: [model] } as output by 3do2scm, either parsed from its JSON output or read
+    from its binary output by binary_3do.load
+    @param output_dir: directory in which to write the .scm and .png files
+    @param lod_budgets: triangle budget of each reduced level of detail, as LOD_TRIANGLE_BUDGETS (the default)
+    @param lod_atlases: whether to write downscaled atlases for the reduced levels of detail.  default
+    LOD_DOWNSCALE_ATLASES
+    @param metrics: optional dictionary, filled with { unitname: { "stages": { name: { "wall_s", "cpu_s" } },
+    "counts": { name: value } } }
+    @return: paths of the files written
+    """
+
+    lod_budgets = LOD_TRIANGLE_BUDGETS if lod_budgets is None else lod_budgets
+    lod_atlases = LOD_DOWNSCALE_ATLASES if lod_atlases is None else lod_atlases
+    written = []
 
     for unitname,data in _3do_data.items():
         print("processing {}".format(unitname))
-        root = data[0]["root"]
         tex_dims = data[0]["texture_dims"]
         num_bytes = tex_dims[0]*tex_dims[1]*4
-        albedo = binascii.a2b_base64(data[0]["albedo"])[0:num_bytes]
-        specteam = binascii.a2b_base64(data[0]["specteam"])[0:num_bytes]
+        stages = None
+        if metrics is not None:
+            stages = { }
+            metrics[unitname] = { "stages": stages }
 
-        # SCM file format technically doesn't require root bone to be named after unit, but SupCom engine does
-        root["name"] = unitname
+        if "root" in data[0]:
+            root = data[0]["root"]
+            with stage_timer(stages, "decode_atlas"):
+                albedo = binascii.a2b_base64(data[0]["albedo"])[0:num_bytes]
+                specteam = binascii.a2b_base64(data[0]["specteam"])[0:num_bytes]
 
-        recursive_coordinate_transform(root)
-        supcom_mesh = make_scm(root)
-        supcom_mesh.save("{}_lod0.scm".format(unitname))
+            # SCM file format technically doesn't require root bone to be named after unit, but SupCom engine does
+            root["name"] = unitname
 
-        save_png("{}_Albedo.png".format(unitname), albedo, tex_dims)
-        save_png("{}_Specteam.png".format(unitname), specteam, tex_dims)
+            with stage_timer(stages, "coordinate_transform"):
+                recursive_coordinate_transform(root)
+            with stage_timer(stages, "make_scm"):
+                supcom_mesh = make_scm(root)
+
+        else:
+            albedo = data[0]["albedo"][0:num_bytes]
+            specteam = data[0]["specteam"][0:num_bytes]
+            with stage_timer(stages, "flatten"):
+                flattened = flatten_3do_arrays(data[0], unitname)
+            with stage_timer(stages, "make_scm"):
+                supcom_mesh = make_scm_flattened(flattened)
+
+        print("  vertices: {} of {} ({:.1%} welded)".format(
+            supcom_mesh.vertexCount(), supcom_mesh.vertcounter, supcom_mesh.dedupRatio()))
+        if VERTEX_CACHE_OPTIMIZE:
+            with stage_timer(stages, "vertex_cache"):
+                acmr = supcom_mesh.optimizeVertexCache()
+            print("  ACMR: {:.3f} -> {:.3f}".format(*acmr))
+        scm_filename = os.path.join(output_dir, "{}_lod0.scm".format(unitname))
+        albedo_filename = os.path.join(output_dir, "{}_Albedo.png".format(unitname))
+        specteam_filename = os.path.join(output_dir, "{}_Specteam.png".format(unitname))
+        with stage_timer(stages, "save_scm"):
+            supcom_mesh.save(scm_filename)
+        with stage_timer(stages, "save_png"):
+            save_png(albedo_filename, albedo, tex_dims)
+            save_png(specteam_filename, specteam, tex_dims)
+        written += [ scm_filename, albedo_filename, specteam_filename ]
+
+        lod_mesh = supcom_mesh
+        lod_counts = { }
+        for level,budget in enumerate(lod_budgets, 1):
+            with stage_timer(stages, "decimate"):
+                lod_mesh = lod_mesh.decimated(lod_triangle_budget(budget, len(supcom_mesh.faces)))
+            if VERTEX_CACHE_OPTIMIZE:
+                with stage_timer(stages, "vertex_cache"):
+                    lod_mesh.optimizeVertexCache()
+            print("  lod{}: {} triangles".format(level, len(lod_mesh.faces)))
+            lod_counts["lod{}_triangles".format(level)] = len(lod_mesh.faces)
+            lod_filename = os.path.join(output_dir, "{}_lod{}.scm".format(unitname, level))
+            with stage_timer(stages, "save_scm"):
+                lod_mesh.save(lod_filename)
+            written.append(lod_filename)
+
+            if lod_atlases:
+                with stage_timer(stages, "downscale_atlas"):
+                    albedo, lod_dims = downscale_atlas(albedo, tex_dims)
+                    specteam, _ = downscale_atlas(specteam, tex_dims)
+                    tex_dims = lod_dims
+                albedo_filename = os.path.join(output_dir, "{}_lod{}_Albedo.png".format(unitname, level))
+                specteam_filename = os.path.join(output_dir, "{}_lod{}_Specteam.png".format(unitname, level))
+                with stage_timer(stages, "save_png"):
+                    save_png(albedo_filename, albedo, tex_dims)
+                    save_png(specteam_filename, specteam, tex_dims)
+                written += [ albedo_filename, specteam_filename ]
+
+        if metrics is not None:
+            metrics[unitname]["counts"] = {
+                "bones": len(supcom_mesh.bones),
+                "vertices": supcom_mesh.vertexCount(),
+                "input_vertices": supcom_mesh.vertcounter,
+                "triangles": len(supcom_mesh.faces),
+                "dedup_ratio": supcom_mesh.dedupRatio() }
+            if VERTEX_CACHE_OPTIMIZE:
+                metrics[unitname]["counts"]["acmr_before"] = acmr[0]
+                metrics[unitname]["counts"]["acmr_after"] = acmr[1]
+            metrics[unitname]["counts"].update(lod_counts)
 
     print("Done!")
+    return written
 
 
 if __name__ == "__main__":
-    _3do_data = json.load(sys.stdin)
+    import binary_3do
+
+    converter_output = sys.stdin.buffer.read()
+    if converter_output.startswith(binary_3do.BIN_MAGIC):
+        _3do_data = binary_3do.load(converter_output)
+    else:
+        _3do_data = json.loads(converter_output)
     export(_3do_data)
@@ -0,0 +1,309 @@
+#**************************************************************************************************
+# Validate the .scm and .sca files under one or more directories, and optionally compare them with an earlier
+# run's:
+#
+#   python scm/validate_outputs.py UNITS
+#   python scm/validate_outputs.py UNITS --baseline old/UNITS --atol 1e-5 --report report.json
+#
+# Each file is checked in a pool of --jobs processes, reading it through scmfile/scafile:
+#
+#   .scm   header and section bounds, bone names and parent links, triangle indices below the vertex count,
+#          vertex bone indices below the bone count, finite values, unit normals, degenerate triangles
+#   .sca   header and section bounds, bone parent links, increasing times, finite keys, unit rotations
+#
+# Given --baseline, each file is compared with the file at the same relative path there: counts and names
+# exactly, floating point fields within --rtol/--atol.  A summary and corpus statistics are printed; --report
+# also writes every file's results as json.  The exit status is 1 if any file has errors or differs.
+#**************************************************************************************************
+
+import argparse
+import concurrent.futures
+import json
+import os
+import statistics
+import sys
+import time
+
+import numpy
+import scafile
+import scmfile
+
+# |normal| further than this from 1 is reported
+UNIT_TOLERANCE = 1e-3
+
+
+def parent_errors(links):
+    """ problems with an array of bone parent indices (-1 for none) """
+
+    links = numpy.asarray(links, dtype=numpy.int64)
+    count = len(links)
+    errors = []
+    bad = (links < -1) | (links >= count) | (links == numpy.arange(count))
+    if bad.any():
+        errors.append("bone {} has invalid parent {}".format(int(numpy.argmax(bad)), int(links[numpy.argmax(bad)])))
+        return errors
+
+    # follow every bone's parents at once.  after count steps they have all reached a root unless there's a cycle
+    ancestor = links.copy()
+    for _ in range(count):
+        has_parent = ancestor >= 0
+        if not has_parent.any():
+            break
+        ancestor[has_parent] = links[ancestor[has_parent]]
+    if (ancestor >= 0).any():
+        errors.append("bone parent links form a cycle")
+    return errors
+
+
+def check_scm(model):
+    errors, warnings = [], []
+    num_vertices = len(model.vertices)
+    num_bones = len(model.bones)
+
+    try:
+        model.bone_names()
+    except scmfile.ScmFormatError as e:
+        errors.append(str(e))
+    errors += parent_errors(model.bones['mParentBoneIndex'])
+
+    indices = model.indices()
+    if len(indices) > 0 and int(indices.max()) >= num_vertices:
+        errors.append("triangle index {} >= vertex count {}".format(int(indices.max()), num_vertices))
+    degenerate = int(((indices[:,0] == indices[:,1]) | (indices[:,1] == indices[:,2]) | (indices[:,2] == indices[:,0])).sum())
+    if degenerate:
+        warnings.append("{} degenerate triangles".format(degenerate))
+
+    vertices = model.vertices
+    if num_vertices > 0 and int(vertices['mBoneIndex'][:,0].max()) >= num_bones:
+        errors.append("vertex bone index {} >= bone count {}".format(int(vertices['mBoneIndex'][:,0].max()), num_bones))
+    for field in ('mPosition', 'mNormal', 'mTangent', 'mBinormal', 'mUV0', 'mUV1'):
+        if not numpy.isfinite(vertices[field]).all():
+            errors.append("non-finite vertex {}".format(field))
+    if not numpy.isfinite(model.bones['mPosition']).all() or not numpy.isfinite(model.bones['mRotation']).all():
+        errors.append("non-finite bone position or rotation")
+
+    lengths = numpy.sqrt((vertices['mNormal'].astype(numpy.float64)**2).sum(axis=1))
+    degenerate = int((numpy.abs(lengths - 1.) > UNIT_TOLERANCE).sum())
+    if degenerate:
+        errors.append("{} vertices with degenerate normals".format(degenerate))
+
+    stats = { "bones": num_bones, "vertices": num_vertices, "triangles": len(indices) }
+    return errors, warnings, stats
+
+
+def check_sca(anim):
+    errors, warnings = [], []
+    errors += parent_errors(anim.bone_links)
+
+    times = anim.times
+    if len(times) > 1 and (numpy.diff(times) < 0).any():
+        errors.append("frame times decrease")
+    if not numpy.isfinite(anim.keys).all() or not numpy.isfinite(times).all():
+        errors.append("non-finite keys")
+    else:
+        lengths = numpy.sqrt((anim.keys[...,3:7].astype(numpy.float64)**2).sum(axis=-1))
+        bad = int((numpy.abs(lengths - 1.) > UNIT_TOLERANCE).sum())
+        if bad:
+            errors.append("{} keys with non-unit rotations".format(bad))
+        if len(times) > 0 and abs(float(anim.header['mDuration']) - float(times[-1] - times[0])) > 1e-3:
+            warnings.append("duration {} does not match the frame times".format(float(anim.header['mDuration'])))
+
+    stats = { "bones": len(anim.bone_names), "frames": len(times) }
+    return errors, warnings, stats
+
+
+def compare_fields(differences, name, a, b, rtol, atol):
+    """ note in differences if arrays a and b differ: max abs difference if they're float, else exactly """
+
+    if a.shape != b.shape:
+        differences[name] = "shape {} vs {}".format(a.shape, b.shape)
+    elif a.dtype.kind == 'f':
+        if not numpy.allclose(a, b, rtol=rtol, atol=atol, equal_nan=True):
+            differences[name] = "max difference {:.6g}".format(float(numpy.abs(a.astype(numpy.float64) - b).max()))
+    elif not numpy.array_equal(a, b):
+        differences[name] = "differs"
+
+
+def diff_scm(model, baseline, rtol, atol):
+    differences = { }
+    if model.bone_names() != baseline.bone_names():
+        differences["bone names"] = "differ"
+    for field in ('mRestPoseInverse', 'mPosition', 'mRotation', 'mParentBoneIndex'):
+        compare_fields(differences, "bones." + field, model.bones[field], baseline.bones[field], rtol, atol)
+    for field in ('mPosition', 'mNormal', 'mTangent', 'mBinormal', 'mUV0', 'mUV1', 'mBoneIndex'):
+        compare_fields(differences, "vertices." + field, model.vertices[field], baseline.vertices[field], rtol, atol)
+    compare_fields(differences, "triangles", model.indices(), baseline.indices(), rtol, atol)
+    if model.info_strings() != baseline.info_strings():
+        differences["info"] = "differs"
+    return differences
+
+
+def diff_sca(anim, baseline, rtol, atol):
+    differences = { }
+    if anim.bone_names != baseline.bone_names:
+        differences["bone names"] = "differ"
+    compare_fields(differences, "bone links", anim.bone_links, baseline.bone_links, rtol, atol)
+    compare_fields(differences, "times", anim.times, baseline.times, rtol, atol)
+    compare_fields(differences, "positions", anim.keys[...,0:3], baseline.keys[...,0:3], rtol, atol)
+    if anim.keys.shape == baseline.keys.shape:
+        # q and -q are the same rotation
+        sign = numpy.where((anim.keys[...,3:7] * baseline.keys[...,3:7]).sum(axis=-1, keepdims=True) < 0, -1., 1.)
+        compare_fields(differences, "rotations", anim.keys[...,3:7] * sign, baseline.keys[...,3:7], rtol, atol)
+    else:
+        differences["rotations"] = "shape {} vs {}".format(anim.keys[...,3:7].shape, baseline.keys[...,3:7].shape)
+    compare_fields(differences, "root deltas",
+        numpy.concatenate([anim.position_delta, anim.orient_delta]),
+        numpy.concatenate([baseline.position_delta, baseline.orient_delta]), rtol, atol)
+    return differences
+
+
+READERS = {
+    ".scm": (scmfile.open_scm, check_scm, diff_scm),
+    ".sca": (scafile.open_sca, check_sca, diff_sca),
+}
+
+
+def check_file(root, relpath, baseline_root, rtol, atol):
+    """ runs in a worker process.  returns the results for one file as a dictionary """
+
+    open_file, check, diff = READERS[os.path.splitext(relpath)[1].lower()]
+    result = { "path": relpath, "errors": [], "warnings": [], "stats": { } }
+    path = os.path.join(root, relpath)
+    result["stats"]["bytes"] = os.path.getsize(path)
+    try:
+        with open_file(path) as contents:
+            errors, warnings, stats = check(contents)
+    except (OSError, ValueError) as e:
+        # format errors, and whatever else a corrupt file raises, are errors of that file rather than of the run
+        result["errors"].append(str(e))
+        return result
+    result["errors"] += errors
+    result["warnings"] += warnings
+    result["stats"].update(stats)
+
+    if baseline_root is not None:
+        baseline_path = os.path.join(baseline_root, relpath)
+        if not os.path.isfile(baseline_path):
+            result["baseline"] = "new"
+            return result
+        try:
+            with open_file(path) as contents, open_file(baseline_path) as baseline:
+                differences = diff(contents, baseline, rtol, atol)
+        except (OSError, ValueError) as e:
+            # either file may be the unreadable one
+            differences = { "not compared:": str(e) }
+        result["baseline"] = "differs" if differences else "same"
+        result["differences"] = differences
+    return result
+
+
+def find_outputs(root):
+    """ relative paths of the .scm and .sca files under root, sorted """
+
+    found = []
+    for directory, _, files in os.walk(root):
+        for filename in files:
+            if os.path.splitext(filename)[1].lower() in READERS:
+                found.append(os.path.relpath(os.path.join(directory, filename), root))
+    return sorted(found)
+
+
+def distribution(values):
+    if not values:
+        return { }
+    return { "total": sum(values), "min": min(values), "median": statistics.median(values), "max": max(values) }
+
+
+def summarise(results, missing, seconds, jobs):
+    summary = {
+        "files": len(results),
+        "seconds": seconds,
+        "jobs": jobs,
+        "with_errors": sum(1 for result in results if result["errors"]),
+        "with_warnings": sum(1 for result in results if result["warnings"]),
+        "statistics": { },
+    }
+    for kind,keys in ((".scm", ("bytes", "bones", "vertices", "triangles")), (".sca", ("bytes", "bones", "frames"))):
+        of_kind = [ result for result in results if result["path"].lower().endswith(kind) ]
+        summary["statistics"][kind] = { "files": len(of_kind) }
+        for key in keys:
+            summary["statistics"][kind][key] = distribution([ result["stats"][key] for result in of_kind if key in result["stats"] ])
+    if missing is not None:
+        summary["baseline"] = {
+            status: sum(1 for result in results if result.get("baseline") == status) for status in ("same", "differs", "new") }
+        summary["baseline"]["missing"] = len(missing)
+    return summary
+
+
+def print_summary(summary, results, missing, max_listed):
+    print("checked {} files with {} jobs in {:.1f}s".format(summary["files"], summary["jobs"], summary["seconds"]))
+
+    def listing(title, entries):
+        if entries:
+            print("{}: {}".format(title, len(entries)))
+            for entry in entries[0:max_listed]:
+                print("  " + entry)
+            if len(entries) > max_listed:
+                print("  ... and {} more".format(len(entries) - max_listed))
+
+    listing("files with errors", [ "{}: {}".format(r["path"], "; ".join(r["errors"])) for r in results if r["errors"] ])
+    listing("files with warnings", [ "{}: {}".format(r["path"], "; ".join(r["warnings"])) for r in results if r["warnings"] ])
+    if missing is not None:
+        baseline = summary["baseline"]
+        print("compared with baseline: {} same, {} differ, {} new, {} missing".format(
+            baseline["same"], baseline["differs"], baseline["new"], baseline["missing"]))
+        listing("differ", [
+            "{}: {}".format(r["path"], "; ".join("{} {}".format(k, v) for k,v in r["differences"].items()))
+            for r in results if r.get("baseline") == "differs" ])
+        listing("missing", missing)
+
+    for kind,stats in summary["statistics"].items():
+        print("{} files: {}".format(kind, stats["files"]))
+        for key,dist in stats.items():
+            if key != "files" and dist:
+                print("  {:10} total {:>12}  min {:>10}  median {:>10}  max {:>10}".format(
+                    key, dist["total"], dist["min"], dist["median"], dist["max"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Validate .scm and .sca files, and compare them with an earlier run's")
+    parser.add_argument('roots', help='directories to search for .scm and .sca files', nargs='+')
+    parser.add_argument('--baseline', help='directory holding an earlier run, to compare with.  with several roots, they are compared with its subdirectories of the same names')
+    parser.add_argument('--rtol', help='relative tolerance for floating point fields.  default=1e-5', type=float, default=1e-5)
+    parser.add_argument('--atol', help='absolute tolerance for floating point fields.  default=1e-6', type=float, default=1e-6)
+    parser.add_argument('--jobs', help='number of files to check concurrently.  default=number of cpus', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--report', help='file to write every file\'s results and the summary to, as json')
+    parser.add_argument('--max-listed', help='files listed per category in the summary.  default=20', type=int, default=20)
+    args = parser.parse_args()
+
+    tasks, missing = [], None
+    for root in args.roots:
+        baseline_root = None
+        if args.baseline:
+            baseline_root = args.baseline if len(args.roots) == 1 else os.path.join(args.baseline, os.path.basename(os.path.normpath(root)))
+        relpaths = find_outputs(root)
+        tasks += [ (root, relpath, baseline_root) for relpath in relpaths ]
+        if baseline_root is not None:
+            missing = (missing or []) + [
+                os.path.join(baseline_root, relpath) for relpath in sorted(set(find_outputs(baseline_root)) - set(relpaths)) ]
+
+    start = time.perf_counter()
+    jobs = max(1, args.jobs)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [ pool.submit(check_file, root, relpath, baseline_root, args.rtol, args.atol) for root,relpath,baseline_root in tasks ]
+        results = [ future.result() for future in futures ]
+    for (root,_,_),result in zip(tasks, results):
+        result["path"] = os.path.join(root, result["path"])
+
+    summary = summarise(results, missing, time.perf_counter() - start, jobs)
+    print_summary(summary, results, missing, args.max_listed)
+    if args.report:
+        with open(args.report, 'wt') as file:
+            json.dump({ "summary": summary, "files": results, "missing": missing }, file, indent=1)
+
+    if summary["with_errors"] or (missing is not None and (summary["baseline"]["differs"] or missing)):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()